@@ -0,0 +1,8 @@
+#
+# (c) 2021 Yoichi Tanibayashi
+#
+"""
+benchmarks for storgan
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__ = '2021/01'
@@ -0,0 +1,304 @@
+#
+# (c) 2021 Yoichi Tanibayashi
+#
+"""
+benchmark suite: MIDI parse / hole layout / SVG serialization / file write
+
+    $ python -m bench [-c CORPUS ..] [-o REPORT] [-b BASELINE] [-t 0.2]
+
+Each stage is timed separately (best of `--repeat` runs),
+and its peak memory is measured by tracemalloc in a separate run.
+The startup of the CLI (`Storgan rollbook` of the smallest file)
+is timed without (cold) and with (warm) the resident daemon
+('startup' in the report).
+The report is written in JSON.
+With `--baseline`, the report is compared with a saved report,
+and the exit status is 1 if any stage is slower than
+(1 + threshold) times the baseline.
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__ = '2021/01'
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+from midilib import Parser
+from storgan.rollbook import RollBook
+from storgan.model import get_registry
+from storgan import daemon
+from . import midigen
+
+
+DEF_CONF_FILE = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'storgan.conf-sample')
+DEF_MODEL = 'ModelName'
+DEF_REPEAT = 3
+DEF_THRESHOLD = 0.2
+NOISE_SEC = 0.002  # smaller differences are never regressions
+DAEMON_TIMEOUT = 30  # sec
+
+REPORT_VERSION = 1
+
+
+class NullWriter:
+    """ file-like object counting bytes """
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        """ write (count only) """
+        self.size += len(data)
+
+
+def measure(func, repeat):
+    """ measure time and peak memory
+
+    Returns
+    -------
+    result: dict
+        'sec': best time, 'peak_bytes': peak memory (tracemalloc)
+    ret:
+        return value of `func`
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        ret = func()
+        sec = time.perf_counter() - start
+        best = sec if best is None else min(best, sec)
+
+    tracemalloc.start()
+    try:
+        ret = func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {'sec': best, 'peak_bytes': peak}, ret
+
+
+def bench_file(midi_file, rollbook, out_dir, repeat):
+    """ benchmark one MIDI file
+
+    Returns
+    -------
+    result: dict
+    """
+    parser = Parser()
+    result = {'stages': {}}
+    stages = result['stages']
+
+    stages['parse'], midi = measure(
+        lambda: parser.parse(midi_file, []), repeat)
+    note_info = midi['note_info']
+    result['notes'] = len(note_info)
+
+    stages['layout'], holes = measure(
+        lambda: rollbook.layout(note_info), repeat)
+    result['out_of_range'] = holes.n_out_of_range
+
+    def serialize():
+        null = NullWriter()
+        rollbook.write_svg(null)
+        return null.size
+
+    stages['svg'], result['svg_bytes'] = measure(serialize, repeat)
+
+    out_file = os.path.join(out_dir, os.path.basename(midi_file) + '.svg')
+
+    def write():
+        with open(out_file, mode='w') as f:
+            rollbook.write_svg(f)
+
+    stages['write'], _ = measure(write, repeat)
+    os.remove(out_file)
+
+    return result
+
+
+def time_command(cmd, env, repeat) -> dict:
+    """ best elapsed time of a command
+
+    Returns
+    -------
+    result: dict
+        'sec': best time
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(cmd, env=env, check=True,
+                       stdout=subprocess.DEVNULL)
+        sec = time.perf_counter() - start
+        best = sec if best is None else min(best, sec)
+    return {'sec': best}
+
+
+def bench_startup(midi_file, conf_file, model, out_dir, repeat):
+    """ benchmark the startup of the CLI:
+    cold (a new interpreter) and warm (by the resident daemon)
+
+    Returns
+    -------
+    result: dict
+    """
+    cmd = [sys.executable, '-m', 'storgan', 'rollbook', '-f', conf_file,
+           '-m', model, '-o', out_dir, '-p', '0', midi_file]
+    sock_path = os.path.join(out_dir, 'daemon.sock')
+    env = dict(os.environ)
+    env[daemon.SOCKET_ENV] = sock_path
+    env.pop(daemon.NO_DAEMON_ENV, None)
+
+    result = {'file': os.path.basename(midi_file), 'stages': {}}
+    stages = result['stages']
+
+    cold_env = dict(env)
+    cold_env[daemon.NO_DAEMON_ENV] = '1'
+    stages['cold'] = time_command(cmd, cold_env, repeat)
+
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'storgan', 'daemon', '-f', conf_file,
+         '-s', sock_path], env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + DAEMON_TIMEOUT
+        while True:
+            sock = daemon.connect(sock_path)
+            if sock is not None:
+                sock.close()
+                break
+            if proc.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError('daemon is not started')
+            time.sleep(0.05)
+
+        stages['warm'] = time_command(cmd, env, repeat)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    os.remove(os.path.join(out_dir, os.path.basename(midi_file) + '.svg'))
+    return result
+
+
+def compare(report, baseline, threshold):
+    """ compare report with baseline
+
+    Returns
+    -------
+    regressions: list of str
+    """
+    regressions = []
+
+    print('%-10s %-8s %10s %10s %8s' % (
+        'corpus', 'stage', 'base[s]', 'now[s]', 'ratio'))
+    for name, result in report['results'].items():
+        base_result = baseline['results'].get(name)
+        if base_result is None:
+            continue
+
+        for stage, now in result['stages'].items():
+            base = base_result['stages'].get(stage)
+            if base is None or base['sec'] <= 0:
+                continue
+
+            ratio = now['sec'] / base['sec']
+            mark = ''
+            if ratio > 1 + threshold and \
+               now['sec'] - base['sec'] > NOISE_SEC:
+                mark = ' <- regression'
+                regressions.append('%s/%s' % (name, stage))
+
+            print('%-10s %-8s %10.4f %10.4f %8.2f%s' % (
+                name, stage, base['sec'], now['sec'], ratio, mark))
+
+    return regressions
+
+
+def main():
+    """ main """
+    arg_parser = argparse.ArgumentParser(
+        prog='python -m bench', description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--corpus', '-c', nargs='+',
+                            choices=sorted(midigen.CORPUS),
+                            default=list(midigen.DEF_CORPUS),
+                            help='corpus names')
+    arg_parser.add_argument('--conf_file', '-f', default=DEF_CONF_FILE,
+                            help='configuration file')
+    arg_parser.add_argument('--model', '-m', default=DEF_MODEL,
+                            help='Model Name')
+    arg_parser.add_argument('--repeat', '-r', type=int, default=DEF_REPEAT,
+                            help='number of runs per stage')
+    arg_parser.add_argument('--workdir', '-w',
+                            default=os.path.join(tempfile.gettempdir(),
+                                                 'storgan-bench'),
+                            help='directory for corpus and output files')
+    arg_parser.add_argument('--out', '-o', help='report file (JSON)')
+    arg_parser.add_argument('--baseline', '-b',
+                            help='baseline report file (JSON)')
+    arg_parser.add_argument('--threshold', '-t', type=float,
+                            default=DEF_THRESHOLD,
+                            help='regression threshold (0.2: +20%%)')
+    arg_parser.add_argument('--no_startup', action='store_true',
+                            help='skip the startup benchmark')
+    args = arg_parser.parse_args()
+
+    model = get_registry(args.conf_file).get(args.model)
+    rollbook = RollBook(model)
+
+    files = midigen.gen_corpus(os.path.join(args.workdir, 'corpus'),
+                               args.corpus)
+
+    report = {
+        'version': REPORT_VERSION,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'model': model.name,
+        'results': {},
+    }
+
+    print('%-10s %8s %-8s %10s %12s' % (
+        'corpus', 'notes', 'stage', 'sec', 'peak[KB]'), flush=True)
+    for name, midi_file in files.items():
+        result = bench_file(midi_file, rollbook, args.workdir, args.repeat)
+        report['results'][name] = result
+
+        for stage, res in result['stages'].items():
+            print('%-10s %8d %-8s %10.4f %12.1f' % (
+                name, result['notes'], stage, res['sec'],
+                res['peak_bytes'] / 1024), flush=True)
+
+    if not args.no_startup:
+        result = bench_startup(min(files.values(), key=os.path.getsize),
+                               args.conf_file, model.name, args.workdir,
+                               args.repeat)
+        report['results']['startup'] = result
+
+        for stage, res in result['stages'].items():
+            print('%-10s %8s %-8s %10.4f' % (
+                'startup', '', stage, res['sec']), flush=True)
+
+    if args.out:
+        with open(args.out, mode='w') as f:
+            json.dump(report, f, indent=2)
+        print('report: %s' % (args.out))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        print()
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print('regressions: %s' % (', '.join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#
+# (c) 2021 Yoichi Tanibayashi
+#
+"""
+micro-benchmark: logging overhead per note
+
+    $ python -m bench.bench_logger [-n N_NOTES]
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__ = '2021/01'
+
+import time
+import inspect
+import argparse
+from logging import DEBUG
+from storgan.my_logger import get_logger
+from storgan.model import Model
+from storgan.rollbook import HoleInfo, HoleTable
+
+
+CONF = {
+    'model': 'Bench', 'book height': 126, 'margin': 5, 'pitch': 3.5,
+    'hole height': 2.5, '1sec': 50, 'base note': 41,
+    'note offset': [0, 2, 4, 5, 6, 7, 9, 11, 12, 13, 14, 16, 17, 18,
+                    19, 20, 21, 23, 24, 25, 26, 27, 28, 29, 30,
+                    31, 32, 33, 35, 36, 37, 38, 39, 40],
+}
+
+
+class Note:
+    """ minimal stand-in for midilib.NoteInfo """
+    __slots__ = ('abs_time', 'note', 'end_time')
+
+    def __init__(self, abs_time, note, end_time):
+        self.abs_time = abs_time
+        self.note = note
+        self.end_time = end_time
+
+    def length(self):
+        """ length in sec """
+        return self.end_time - self.abs_time
+
+
+def per_call(func, n):
+    """ usec per call """
+    start = time.perf_counter()
+    func(n)
+    return (time.perf_counter() - start) / n * 1e6
+
+
+def main():
+    """ main """
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument('-n', type=int, default=20000,
+                            help='number of notes')
+    args = arg_parser.parse_args()
+
+    notes = [Note(i * 0.1, 36 + i % 48, i * 0.1 + 0.2)
+             for i in range(args.n)]
+    log = get_logger('bench', False)
+
+    def stack_walk(n):
+        for _ in range(n):
+            inspect.stack()[1].filename.split('/')[-1]
+
+    def logger(n):
+        for _ in range(n):
+            get_logger('bench', False)
+
+    def hole_info(n):
+        for ni in notes[:n]:
+            HoleInfo(ni, CONF)
+
+    def debug_unguarded(n):
+        for hi in holes:
+            log.debug('hi=%s', hi)
+
+    def debug_guarded(n):
+        if log.isEnabledFor(DEBUG):
+            for hi in holes:
+                log.debug('hi=%s', hi)
+
+    holes = HoleTable.from_notes(notes, Model(CONF))
+
+    n_stack = min(args.n, 200)
+    print('%-36s %10s' % ('(DEBUG off)', 'usec/note'))
+    print('%-36s %10.3f' % ('inspect.stack() (old get_logger)',
+                            per_call(stack_walk, n_stack)))
+    print('%-36s %10.3f' % ('get_logger()', per_call(logger, args.n)))
+    print('%-36s %10.3f' % ('HoleInfo()', per_call(hole_info, args.n)))
+    print('%-36s %10.3f' % ("log.debug('hi=%s') per hole",
+                            per_call(debug_unguarded, args.n)))
+    print('%-36s %10.3f' % ('isEnabledFor(DEBUG) guarded loop',
+                            per_call(debug_guarded, args.n)))
+
+
+if __name__ == '__main__':
+    main()
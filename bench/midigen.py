@@ -0,0 +1,160 @@
+#
+# (c) 2021 Yoichi Tanibayashi
+#
+"""
+deterministic synthetic MIDI file generator (offline, no dependencies)
+
+    $ python -m bench.midigen OUT_DIR [CORPUS_NAME ..]
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__ = '2021/01'
+
+import os
+import sys
+import random
+import struct
+
+
+TICKS_PER_BEAT = 480
+TEMPO = 500000  # usec per beat (120 bpm)
+TICKS_PER_SEC = TICKS_PER_BEAT * 1000000 // TEMPO
+
+# name: (length in sec, number of channels, notes per sec per channel)
+CORPUS = {
+    'short': (30, 1, 4),
+    'medium': (180, 4, 6),
+    'long': (900, 8, 8),
+    'dense': (600, 16, 20),
+    'hours': (3 * 3600, 8, 8),
+}
+DEF_CORPUS = ('short', 'medium', 'long')
+
+# `ModelName` in storgan.conf-sample: base note 41, note offset 0..40.
+# Some notes are out of range on purpose.
+NOTE_MIN = 36
+NOTE_MAX = 86
+
+
+def vlq(value) -> bytes:
+    """ variable-length quantity """
+    data = [value & 0x7f]
+    value >>= 7
+    while value:
+        data.append(0x80 | (value & 0x7f))
+        value >>= 7
+    return bytes(reversed(data))
+
+
+def chunk(chunk_type, data) -> bytes:
+    """ SMF chunk """
+    return chunk_type + struct.pack('>I', len(data)) + data
+
+
+def track(events) -> bytes:
+    """ track chunk
+
+    Parameters
+    ----------
+    events: list of (tick, bytes)
+        sorted by tick
+    """
+    data = bytearray()
+    prev = 0
+    for tick, event in events:
+        data += vlq(tick - prev) + event
+        prev = tick
+    data += vlq(0) + b'\xff\x2f\x00'  # end of track
+    return chunk(b'MTrk', bytes(data))
+
+
+def gen_notes(sec, notes_per_sec, channel, seed):
+    """ generate notes of one channel
+
+    Returns
+    -------
+    notes: list of (start_tick, end_tick, note, velocity)
+    """
+    rnd = random.Random(seed * 1000 + channel)
+    end = sec * TICKS_PER_SEC
+    mean_gap = TICKS_PER_SEC / notes_per_sec
+
+    notes = []
+    tick = 0
+    while True:
+        tick += max(1, int(rnd.expovariate(1 / mean_gap)))
+        if tick >= end:
+            break
+        length = max(1, int(rnd.uniform(0.05, 1.5) * TICKS_PER_SEC))
+        notes.append((tick, min(tick + length, end),
+                      rnd.randint(NOTE_MIN, NOTE_MAX),
+                      rnd.randint(40, 127)))
+    return notes
+
+
+def gen_midi(sec, channels, notes_per_sec, seed=0):
+    """ generate SMF (format 1) data
+
+    Parameters
+    ----------
+    sec: int
+        length in sec
+    channels: int
+        number of channels (one track per channel)
+    notes_per_sec: float
+        notes per sec per channel
+    seed: int
+
+    Returns
+    -------
+    (data, n_notes): (bytes, int)
+    """
+    tempo_track = track([(0, b'\xff\x51\x03' + TEMPO.to_bytes(3, 'big'))])
+    tracks = [tempo_track]
+    n_notes = 0
+
+    for ch in range(channels):
+        events = []
+        for start, end, note, vel in gen_notes(sec, notes_per_sec, ch,
+                                               seed):
+            # note off (0) sorts before note on (1) at the same tick
+            events.append((end, 0, bytes([0x80 | ch, note, 0])))
+            events.append((start, 1, bytes([0x90 | ch, note, vel])))
+            n_notes += 1
+        events.sort(key=lambda e: (e[0], e[1]))
+        tracks.append(track([(tick, ev) for tick, _, ev in events]))
+
+    header = chunk(b'MThd', struct.pack('>HHH', 1, len(tracks),
+                                        TICKS_PER_BEAT))
+    return header + b''.join(tracks), n_notes
+
+
+def gen_corpus(out_dir, names=DEF_CORPUS, seed=0):
+    """ generate corpus files (existing files are reused)
+
+    Returns
+    -------
+    files: dict
+        name -> file name
+    """
+    os.makedirs(out_dir, exist_ok=True)
+
+    files = {}
+    for name in names:
+        sec, channels, notes_per_sec = CORPUS[name]
+        path = os.path.join(out_dir, '%s-%s.mid' % (name, seed))
+        if not os.path.exists(path):
+            data, _ = gen_midi(sec, channels, notes_per_sec, seed)
+            with open(path, mode='wb') as f:
+                f.write(data)
+        files[name] = path
+    return files
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+
+    for corpus_name, file_name in gen_corpus(
+            sys.argv[1], sys.argv[2:] or DEF_CORPUS).items():
+        print('%-8s %s' % (corpus_name, file_name))
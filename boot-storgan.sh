@@ -17,6 +17,11 @@ LOGFILE=$LOGDIR/$CMD_NAME.log
 BOOT_FLAG=1
 DEBUG_FLAG=
 
+# server processes (0: number of CPUs, empty: development mode)
+PROCESSES=0
+# conversion workers per server process (empty: number of CPUs)
+WORKERS=
+
 #
 # functions
 #
@@ -31,10 +36,12 @@ usage() {
     echo
     echo "  $CMD_NAME boot script"
     echo
-    echo "  Usage: $MYNAME [-h] [-d]"
+    echo "  Usage: $MYNAME [-h] [-k] [-d] [-n N] [-j N]"
     echo
     echo "    -k   kill only"
     echo "    -d   debug flag"
+    echo "    -n   number of server processes (default: $PROCESSES)"
+    echo "    -j   number of conversion workers per server process"
     echo "    -h   show this usage"
     echo
 }
@@ -46,15 +53,17 @@ get_pid() {
 #
 # main
 #
-while getopts hkd OPT; do
+while getopts hkdn:j: OPT; do
     case $OPT in
         k) BOOT_FLAG=0;;
         d) DEBUG_FLAG="-d";;
+        n) PROCESSES=$OPTARG;;
+        j) WORKERS=$OPTARG;;
         h) usage; exit 0;;
         *) usage; exit 1;;
     esac
-    shift
 done
+shift `expr $OPTIND - 1`
 
 #
 # kill
@@ -74,4 +83,12 @@ fi
 #
 # boot
 #
-echo_do "$CMD $SUBCMD $DEBUG_FLAG -p $PORT >> $LOGFILE 2>&1 &"
+OPTS=
+if [ ! -z "$PROCESSES" ]; then
+    OPTS="$OPTS -n $PROCESSES"
+fi
+if [ ! -z "$WORKERS" ]; then
+    OPTS="$OPTS -j $WORKERS"
+fi
+
+echo_do "$CMD $SUBCMD $DEBUG_FLAG -p $PORT $OPTS >> $LOGFILE 2>&1 &"
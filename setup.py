@@ -35,6 +35,6 @@ setup(
         "Programming Language :: Python :: 3 :: Only",
     ],
     install_requires=read_requirements(),
-    packages=find_packages(exclude=('tests', 'docs')),
+    packages=find_packages(exclude=('tests', 'docs', 'bench', 'bench.*')),
     python_requires='>=3.7',
 )
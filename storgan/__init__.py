@@ -3,12 +3,33 @@
 #
 """
 storgan
+
+`RollBook` and `WebServer` are imported lazily on first access,
+so that `import storgan` (e.g. the CLI) does not import tornado.
 """
 __author__ = 'Yoichi Tanibayashi'
 __date__ = '2021/01'
 
-from .rollbook import RollBook
-from .webapp import WebServer
+import importlib
 
-__all__ = ['RollBook'
+__all__ = ['RollBook',
            'WebServer']
+
+_LAZY = {'RollBook': '.rollbook',
+         'WebServer': '.webapp'}
+
+
+def __getattr__(name):
+    """ import `RollBook` or `WebServer` on first access """
+    module = _LAZY.get(name)
+    if module is None:
+        raise AttributeError('module %r has no attribute %r' % (
+            __name__, name))
+
+    value = getattr(importlib.import_module(module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_LAZY))
@@ -3,25 +3,96 @@
 #
 """
 main for midi_tools
+
+`daemon.COMMANDS` are run by the resident daemon, if it is running
+(see `daemon`). They are forwarded before the imports below.
 """
+import sys
+from . import daemon as storgan_daemon
+
+if __name__ == '__main__':
+    _EXIT_STATUS = storgan_daemon.forward(sys.argv[1:])
+    if _EXIT_STATUS is not None:
+        sys.exit(_EXIT_STATUS)
+
+# pylint: disable=wrong-import-position
 import os
+import glob
+import time
+import tempfile
+import concurrent.futures
 import click
 from midilib import Parser, Player
-from . import RollBook, WebServer
+from .rollbook import RollBook, DEF_PRECISION
+from .model import get_registry, parse_overrides, MIDI_CHANNELS
+from .metrics import StageStats
+from . import profiler
+from . import notes
+from .worker import RenderPool, convert_file, NOTE_DIR
+from . import bundle
+from .jobs import JobScheduler
+from . import defaults
 from .my_logger import get_logger
 
 
 class RollBookApp:
     """ RollBookApp """
     DEF_OUT_DIR = '~/Desktop'
+    MIDI_SUFFIX = ('.mid', '.midi', notes.SUFFIX)  # and note files
 
     def __init__(self, midi_file, conf_file,
                  model_name,
                  channel=[],
                  out_file=None,
                  version='current',
+                 cache_dir=None,
+                 jobs=1,
+                 out_dir=DEF_OUT_DIR,
+                 page_len=None,
+                 precision=DEF_PRECISION,
+                 svgz=False,
+                 stats=False,
+                 overrides=None,
+                 all_models=False,
+                 by_channel=False,
                  debug=False):
-        """ Constructor """
+        """ Constructor
+
+        Parameters
+        ----------
+        midi_file: str or list of str
+            MIDI files, directories or glob patterns
+        out_file: str
+            output file name (single MIDI file only)
+        jobs: int
+            number of worker processes
+        out_dir: str
+            output directory
+            (files in a directory are written to the same relative
+            path under `out_dir`)
+        page_len: float
+            page length in mm (None: model default, 0: no paging)
+        precision: int
+            digits after the decimal point of coordinates
+        svgz: bool
+            write gzip-compressed SVG ('.svgz')
+        stats: bool
+            print elapsed time per stage
+        overrides: dict
+            configuration entries replaced (see `model.Model.replace()`)
+        all_models: bool
+            render rolls of all models in `conf_file` into a bundle
+            '{MIDI file}.zip' (see `bundle`)
+        by_channel: bool
+            render the combined roll and the roll of each channel
+            into a bundle '{MIDI file}.channels.zip' (see `bundle`)
+
+        Raises
+        ------
+        ValueError
+            output files collide (e.g. the same name in two directories
+            given by a glob pattern)
+        """
         self._dbg = debug
         self._log = get_logger(self.__class__.__name__, self._dbg)
         self._log.debug('midi_file=%s, conf_file=%s',
@@ -30,32 +101,257 @@ class RollBookApp:
         self._log.debug('channel=%s', channel)
         self._log.debug('out_file=%s', out_file)
         self._log.debug('version=%s', version)
+        self._log.debug('cache_dir=%s', cache_dir)
+        self._log.debug('jobs=%s, out_dir=%s', jobs, out_dir)
+        self._log.debug('page_len=%s', page_len)
+        self._log.debug('precision=%s, svgz=%s', precision, svgz)
+        self._log.debug('stats=%s, overrides=%s', stats, overrides)
+        self._log.debug('all_models=%s, by_channel=%s',
+                        all_models, by_channel)
+
+        if isinstance(midi_file, str):
+            midi_file = [midi_file]
+        expanded = self.expand(midi_file)
+        self._midi_files = [mf for mf, _ in expanded]
+        self._log.debug('midi_files=%s', self._midi_files)
 
-        self._midi_file = midi_file
         self._conf_file = conf_file
         self._model_name = model_name
-        self._channel = channel
+        self._channel = list(channel)
         self._version = version
-
-        if not out_file:
-            out_file = '%s.svg' % (self._midi_file)
-
-        out_file = os.path.basename(out_file)
-        out_file = '%s/%s' % (self.DEF_OUT_DIR, out_file)
-        self._out_file = os.path.expanduser(out_file)
-        self._log.debug('[fix] out_file=%s', self._out_file)
-
-        self._rollbook = RollBook(self._model_name, self._conf_file,
-                                  debug=self._dbg)
+        self._cache_dir = cache_dir
+        self._jobs = max(jobs, 1)
+        self._page_len = page_len
+        self._precision = precision
+        self._stats = stats
+        self._overrides = overrides or {}
+        self._all_models = all_models
+        self._by_channel = by_channel
+
+        self._out_files = []
+        for _, out_name in expanded:
+            if out_file and len(expanded) == 1:
+                out_name = os.path.basename(out_file)
+            else:
+                out_name = '%s.svg' % (out_name)
+            if self._by_channel:
+                out_name = os.path.splitext(out_name)[0] + \
+                    bundle.CHANNELS_SUFFIX
+            elif self._all_models:
+                out_name = os.path.splitext(out_name)[0] + bundle.SUFFIX
+            elif svgz and out_name.endswith('.svg'):
+                out_name += 'z'
+
+            self._out_files.append(
+                os.path.join(os.path.expanduser(out_dir), out_name))
+        self._log.debug('[fix] out_files=%s', self._out_files)
+
+        seen = {}
+        for mf, of in zip(self._midi_files, self._out_files):
+            if of in seen:
+                raise ValueError('%s, %s: the same output file: %s' % (
+                    seen[of], mf, of))
+            seen[of] = mf
+
+        # check model names and overrides
+        registry = get_registry(self._conf_file)
+        self._model_names = [self._model_name]
+        if self._all_models:
+            self._model_names = registry.names()
+        for model_name in self._model_names:
+            registry.get(model_name).replace(self._overrides)
+
+    def expand(self, paths):
+        """ expand directories and glob patterns
+
+        Parameters
+        ----------
+        paths: list of str
+
+        Returns
+        -------
+        midi_files: list of (str, str)
+            (MIDI file, output name): the output name is
+            the relative path in the directory,
+            or the base name of a file or a glob match
+        """
+        midi_files = []
+
+        for path in paths:
+            if os.path.isdir(path):
+                for dir_path, _, fnames in sorted(os.walk(path)):
+                    midi_files += [
+                        (os.path.join(dir_path, fname),
+                         os.path.relpath(os.path.join(dir_path, fname),
+                                         path))
+                        for fname in sorted(fnames)
+                        if fname.lower().endswith(self.MIDI_SUFFIX)]
+                continue
+
+            if os.path.exists(path):
+                midi_files.append((path, os.path.basename(path)))
+                continue
+
+            matched = sorted(glob.glob(os.path.expanduser(path),
+                                       recursive=True))
+            if not matched:
+                self._log.warning('%s: no such file', path)
+            midi_files += [(mf, os.path.basename(mf)) for mf in matched]
+
+        return midi_files
+
+    def convert(self, midi_file, out_file):
+        """ convert one file
+
+        Returns
+        -------
+        result: dict
+            see `worker.convert_file()`
+        """
+        return convert_file(midi_file, out_file,
+                            self._model_name, self._conf_file,
+                            self._channel, self._cache_dir,
+                            self._page_len, self._precision,
+                            self._overrides, self._dbg)
 
     def main(self):
         """ main """
         self._log.debug('')
 
-        svg = self._rollbook.parse(self._midi_file, self._channel)
+        for out_file in self._out_files:
+            os.makedirs(os.path.dirname(out_file) or '.', exist_ok=True)
+
+        if self._all_models or self._by_channel:
+            self.main_bundle()
+            return
+
+        n_files = len(self._midi_files)
+        if n_files == 1:
+            result = self.convert(self._midi_files[0], self._out_files[0])
+            if self._stats:
+                print('stats: %s' % (StageStats(result['stats']).format()),
+                      flush=True)
+            return
 
-        with open(self._out_file, mode='w') as f:
-            f.write(svg)
+        start = time.perf_counter()
+        n_ok = n_notes = 0
+        total_stats = StageStats()
+
+        if self._jobs == 1:
+            results = (
+                self._run(mf, self.convert, mf, of)
+                for mf, of in zip(self._midi_files, self._out_files))
+        else:
+            pool = RenderPool(self._jobs, n_files, debug=self._dbg)
+            futures = {
+                pool.submit(convert_file, mf, of,
+                            self._model_name, self._conf_file,
+                            self._channel, self._cache_dir,
+                            self._page_len, self._precision,
+                            self._overrides, self._dbg): mf
+                for mf, of in zip(self._midi_files, self._out_files)}
+            results = (
+                self._run(futures[f], f.result)
+                for f in concurrent.futures.as_completed(futures))
+
+        for i, (midi_file, result, err) in enumerate(results):
+            if err:
+                print('[%d/%d] %s: ERROR: %s' % (
+                    i + 1, n_files, midi_file, err), flush=True)
+                continue
+
+            n_ok += 1
+            if result['notes'] is None:
+                notes_str = 'cached'
+            else:
+                notes_str = '%d notes' % (result['notes'])
+                n_notes += result['notes']
+            if 'pages' in result:
+                notes_str += ', %d pages' % (result['pages'])
+
+            print('[%d/%d] %s: %s, %.2f sec' % (
+                i + 1, n_files, midi_file, notes_str, result['sec']),
+                  flush=True)
+            if self._stats:
+                total_stats.update(result['stats'])
+                print('  stats: %s' % (
+                    StageStats(result['stats']).format()), flush=True)
+
+        if self._jobs > 1:
+            pool.shutdown()
+
+        sec = max(time.perf_counter() - start, 1e-6)
+        print('%d files (%d errors), %d notes, %.2f sec:'
+              ' %.1f files/sec, %.1f notes/sec' % (
+                  n_files, n_files - n_ok, n_notes, sec,
+                  n_files / sec, n_notes / sec), flush=True)
+        if self._stats:
+            print('stats: %s' % (total_stats.format()), flush=True)
+
+    def main_bundle(self):
+        """ main of `all_models` or `by_channel`:
+        one bundle per MIDI file
+
+        MIDI files are converted one by one, and
+        the rolls of a MIDI file are rendered concurrently.
+        """
+        n_files = len(self._midi_files)
+        tmp_dir = None
+        if self._cache_dir:
+            note_dir = os.path.join(self._cache_dir, NOTE_DIR)
+        else:
+            tmp_dir = tempfile.TemporaryDirectory(prefix='storgan-')
+            note_dir = tmp_dir.name
+
+        n_rolls = len(self._model_names)
+        if self._by_channel:
+            n_rolls = MIDI_CHANNELS + 1  # and the combined roll
+
+        pool = None
+        if self._jobs > 1:
+            pool = RenderPool(self._jobs, n_rolls, debug=self._dbg)
+
+        for i, (midi_file, out_file) in enumerate(zip(self._midi_files,
+                                                      self._out_files)):
+            start = time.perf_counter()
+            if self._by_channel:
+                _, result, err = self._run(
+                    midi_file, bundle.render_channel_bundle, midi_file,
+                    out_file, self._model_name, self._conf_file, note_dir,
+                    self._overrides, pool, self._dbg)
+            else:
+                _, result, err = self._run(
+                    midi_file, bundle.render_bundle, midi_file, out_file,
+                    self._model_names, self._conf_file, self._channel,
+                    note_dir, self._overrides, pool, self._dbg)
+            if err:
+                print('[%d/%d] %s: ERROR: %s' % (
+                    i + 1, n_files, midi_file, err), flush=True)
+                continue
+
+            print('[%d/%d] %s: %d notes, %d rolls, %.2f sec: %s' % (
+                i + 1, n_files, midi_file, result['notes'],
+                len(result.get('models', result.get('channels'))),
+                time.perf_counter() - start, out_file), flush=True)
+            print(bundle.format_summary(result), flush=True)
+
+        if pool is not None:
+            pool.shutdown()
+        if tmp_dir is not None:
+            tmp_dir.cleanup()
+
+    def _run(self, midi_file, func, *args):
+        """ call `func(*args)` and catch errors
+
+        Returns
+        -------
+        (midi_file, result, err)
+        """
+        try:
+            return midi_file, func(*args), None
+        except Exception as ex:  # pylint: disable=broad-except
+            self._log.debug('%s: %s', type(ex).__name__, ex)
+            return midi_file, None, '%s: %s' % (type(ex).__name__, ex)
 
     def end(self) -> None:
         """ end ... do nothing """
@@ -70,6 +366,7 @@ class MidiApp:  # pylint: disable=too-many-instance-attributes
                  rate=Player.DEF_RATE,
                  sec_min=Player.SEC_MIN, sec_max=Player.SEC_MAX,
                  pos_sec=0,
+                 dump_file=None,
                  debug=False) -> None:
         """ Constructor """
         self._dbg = debug
@@ -81,6 +378,7 @@ class MidiApp:  # pylint: disable=too-many-instance-attributes
         self._log.debug('rate=%s', rate)
         self._log.debug('sec_min/max=%s/%s', sec_min, sec_max)
         self._log.debug('pos_sec=%s', pos_sec)
+        self._log.debug('dump_file=%s', dump_file)
 
         self._midi_file = midi_file
         self._channel = channel
@@ -90,6 +388,7 @@ class MidiApp:  # pylint: disable=too-many-instance-attributes
         self._sec_min = sec_min
         self._sec_max = sec_max
         self._pos_sec = pos_sec
+        self._dump_file = dump_file
 
         self._parser = Parser(debug=self._dbg)
         self._player = Player(rate=self._rate, debug=self._dbg)
@@ -101,12 +400,19 @@ class MidiApp:  # pylint: disable=too-many-instance-attributes
         parsed_data = self._parser.parse(self._midi_file, self._channel)
 
         self._log.debug('parsed_data=')
-        if self._dbg or self._parse_only:
+        if self._dbg or (self._parse_only and not self._dump_file):
             for i, data in enumerate(parsed_data['note_info']):
                 print('(%4d) %s' % (i, data), flush=True)
 
         print('channel_set=', parsed_data['channel_set'], flush=True)
 
+        if self._dump_file:
+            note_stream = notes.NoteStream.from_note_info(
+                parsed_data['note_info'])
+            notes.dump(note_stream, self._dump_file)
+            print('dump: %s (%d notes)' % (self._dump_file,
+                                           len(note_stream)), flush=True)
+
         if self._visual_flag:
             v_data = self._parser.mk_visual(parsed_data['note_info'])
             print()
@@ -127,6 +433,27 @@ class MidiApp:  # pylint: disable=too-many-instance-attributes
 
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 
+PROFILE_OPTION = click.option(
+    '--profile', 'profile', type=click.Path(), default=None,
+    help='write cProfile dump to PROFILE, and print top %s hot spots' % (
+        profiler.DEF_TOP))
+
+
+def overrides_callback(_ctx, _param, value) -> dict:
+    """ click callback: parse '--set KEY=VALUE' """
+    try:
+        return parse_overrides(value)
+    except ValueError as ex:
+        raise click.BadParameter(str(ex))
+
+
+def run_main(app, profile=None):
+    """ call `app.main()` (under cProfile, if `profile` is given) """
+    if profile:
+        profiler.run(app.main, profile)
+    else:
+        app.main()
+
 
 @click.group(invoke_without_command=True,
              context_settings=CONTEXT_SETTINGS, help='''
@@ -146,38 +473,104 @@ def cli(ctx):
 @cli.command(help="""
 Web server""")
 @click.option('--port', '-p', 'port', type=int,
-              default=WebServer.DEF_PORT,
+              default=defaults.DEF_PORT,
               help='port number')
 @click.option('--webroot', '-r', 'webroot', type=click.Path(exists=True),
-              default=WebServer.DEF_WEBROOT,
+              default=defaults.DEF_WEBROOT,
               help='Web root directory')
 @click.option('--workdir', '-w', 'workdir', type=click.Path(),
-              default=WebServer.DEF_WORKDIR,
+              default=defaults.DEF_WORKDIR,
               help='work directory')
 @click.option('--size_limit', '-l', 'size_limit', type=int,
               default=100*1024*1024,
               help='upload size limit, default=%s' % (
-                  WebServer.DEF_SIZE_LIMIT))
+                  defaults.DEF_SIZE_LIMIT))
+@click.option('--conf_file', '-f', 'conf_file',
+              type=click.Path(exists=True),
+              default='%s' % (RollBook.DEF_CONF_FILE),
+              help='configuration file')
+@click.option('--workers', '-j', 'workers', type=int,
+              default=RenderPool.DEF_WORKERS,
+              help='number of conversion workers '
+              '(split among server processes), default=%s' % (
+                  RenderPool.DEF_WORKERS))
+@click.option('--max_pending', '--max-pending', 'max_pending', type=int,
+              default=RenderPool.DEF_MAX_PENDING,
+              help='max number of pending conversions, default=%s' % (
+                  RenderPool.DEF_MAX_PENDING))
+@click.option('--max_per_client', 'max_per_client', type=int,
+              default=JobScheduler.DEF_MAX_PER_CLIENT,
+              help='max number of running jobs per client, default=%s' % (
+                  JobScheduler.DEF_MAX_PER_CLIENT))
+@click.option('--processes', '-n', 'processes', type=int, default=None,
+              help='production mode: number of server processes '
+              '(0: number of CPUs), '
+              'default: development mode (one process, autoreload)')
+@click.option('--profile_sample', 'profile_sample', type=int, default=0,
+              help='profile one in N conversions (0: never), default=0')
+@click.option('--profile_token', 'profile_token', type=str, default=None,
+              envvar='STORGAN_PROFILE_TOKEN',
+              help='profile conversions requested with this token '
+              '(header: X-Profile-Token)')
 @click.option('--version', 'version', type=str, default='current',
               help='version string')
 @click.option('--debug', '-d', 'debug', is_flag=True, default=False,
               help='debug flag')
-def webapp(port, webroot, workdir, size_limit, version, debug):
+def webapp(port,  # pylint: disable=too-many-arguments
+           webroot, workdir, size_limit, conf_file, workers, max_pending,
+           max_per_client, processes, profile_sample, profile_token,
+           version, debug):
     """ cmd1  """
+    from .webapp import WebServer  # tornado is imported only here
+
     log = get_logger(__name__, debug)
 
     app = WebServer(port, webroot, workdir, size_limit, version,
-                    debug=debug)
+                    conf_file, workers, max_pending, max_per_client,
+                    processes, profile_sample, profile_token, debug=debug)
     try:
         app.main()
     finally:
         log.info('end')
 
 
+@cli.command(context_settings=CONTEXT_SETTINGS, help='''
+Resident daemon
+
+Commands (%s) are run by the daemon while it is running,
+without the startup cost ($%s=1: run locally).
+''' % (', '.join(storgan_daemon.COMMANDS), storgan_daemon.NO_DAEMON_ENV))
+@click.option('--conf_file', '-f', 'conf_file',
+              type=click.Path(exists=True),
+              default='%s' % (RollBook.DEF_CONF_FILE),
+              help='configuration file (models are loaded in advance)')
+@click.option('--socket', '-s', 'sock_path', type=click.Path(),
+              default=None, envvar=storgan_daemon.SOCKET_ENV,
+              help='UNIX socket, default=%s' % (
+                  storgan_daemon.socket_path()))
+@click.option('--debug', '-d', 'dbg', is_flag=True, default=False,
+              help='debug flag')
+def daemon(conf_file, sock_path, dbg) -> None:
+    """
+    daemon main
+    """
+    log = get_logger(__name__, dbg)
+
+    app = storgan_daemon.Daemon(cli, conf_file, sock_path, debug=dbg)
+    try:
+        app.main()
+    except RuntimeError as ex:
+        raise click.ClickException(str(ex))
+    finally:
+        log.debug('finally')
+
+
 @cli.command(context_settings=CONTEXT_SETTINGS, help='''
 Roll Book
+
+MIDI_FILE: MIDI files, directories or glob patterns
 ''')
-@click.argument('midi_file', type=click.Path(exists=True))
+@click.argument('midi_file', type=str, nargs=-1, required=True)
 @click.option('--conf_file', '-f', 'conf_file',
               type=click.Path(exists=True),
               default='%s' % (RollBook.DEF_CONF_FILE),
@@ -187,21 +580,75 @@ Roll Book
               help='Model Name')
 @click.option('--channel', '-c', 'channel', type=int, multiple=True,
               help='MIDI channel')
+@click.option('--out_dir', '-o', 'out_dir', type=click.Path(),
+              default=RollBookApp.DEF_OUT_DIR,
+              help='output directory, default=%s' % (
+                  RollBookApp.DEF_OUT_DIR))
+@click.option('--cache_dir', '-C', 'cache_dir', type=click.Path(),
+              default=None,
+              help='render cache directory (default: no cache)')
+@click.option('--jobs', '-j', 'jobs', type=int, default=1,
+              help='number of worker processes, default=1')
+@click.option('--page_len', '-p', 'page_len', type=float, default=None,
+              help='page length in mm (0: no paging), '
+              'default: "page length" in conf_file')
+@click.option('--precision', '-P', 'precision', type=int,
+              default=DEF_PRECISION,
+              help='digits after the decimal point, default=%s' % (
+                  DEF_PRECISION))
+@click.option('--svgz', '-z', 'svgz', is_flag=True, default=False,
+              help='gzip-compressed SVG (.svgz)')
+@click.option('--stats', '-s', 'stats', is_flag=True, default=False,
+              help='print elapsed time per stage')
+@click.option('--all_models', '-A', 'all_models', is_flag=True,
+              default=False,
+              help='render rolls of all models into a bundle '
+              '(MIDI_FILE.zip with summary.json), parsing MIDI file once')
+@click.option('--by_channel', '-B', 'by_channel', is_flag=True,
+              default=False,
+              help='render the combined roll and the roll of each channel '
+              'into a bundle (MIDI_FILE.channels.zip with summary.json), '
+              'parsing MIDI file once')
+@click.option('--set', '-S', 'overrides', type=str, multiple=True,
+              metavar='KEY=VALUE', callback=overrides_callback,
+              help='override a model configuration entry '
+              '(e.g. -S 1sec=55 -S pitch=2.1)')
+@PROFILE_OPTION
 @click.option('--version', 'version', type=str, default='current',
               help='version string')
 @click.option('--debug', '-d', 'dbg', is_flag=True, default=False,
               help='debug flag')
-def rollbook(midi_file, conf_file, model_name, channel, version,
-             dbg) -> None:
+def rollbook(midi_file,  # pylint: disable=too-many-arguments
+             conf_file, model_name, channel, out_dir, cache_dir, jobs,
+             page_len, precision, svgz, stats, all_models, by_channel,
+             overrides, profile, version, dbg) -> None:
     """
     rollbook main
     """
     log = get_logger(__name__, dbg)
 
-    app = RollBookApp(midi_file, conf_file, model_name, channel,
-                      version, debug=dbg)
+    if all_models and by_channel:
+        raise click.UsageError('--all_models and --by_channel are exclusive')
+    if by_channel and channel:
+        log.warning('--by_channel: --channel %s is ignored', channel)
+        channel = ()
+
+    if profile and jobs > 1:
+        # worker processes are not profiled
+        log.warning('--profile: jobs=%s -> 1', jobs)
+        jobs = 1
+
     try:
-        app.main()
+        app = RollBookApp(list(midi_file), conf_file, model_name, channel,
+                          version=version, cache_dir=cache_dir, jobs=jobs,
+                          out_dir=out_dir, page_len=page_len,
+                          precision=precision, svgz=svgz, stats=stats,
+                          overrides=overrides, all_models=all_models,
+                          by_channel=by_channel, debug=dbg)
+    except ValueError as ex:
+        raise click.UsageError(str(ex))
+    try:
+        run_main(app, profile)
     finally:
         log.debug('finally')
         app.end()
@@ -216,19 +663,25 @@ MIDI parser
 @click.option('--visual', '-v', 'visual_flag', is_flag=True,
               default=False,
               help='Visual flag')
+@click.option('--dump', '-D', 'dump_file', type=click.Path(),
+              default=None,
+              help='write parsed notes to DUMP_FILE (note file), '
+              'which can be given to rollbook instead of MIDI file')
+@PROFILE_OPTION
 @click.option('--debug', '-d', 'dbg', is_flag=True, default=False,
               help='debug flag')
-def parse(midi_file, channel, visual_flag, dbg) -> None:
+def parse(midi_file, channel, visual_flag, dump_file, profile,
+          dbg) -> None:
     """
     parser main
     """
     log = get_logger(__name__, dbg)
 
     app = MidiApp(midi_file, channel, parse_only=True,
-                  visual_flag=visual_flag,
+                  visual_flag=visual_flag, dump_file=dump_file,
                   debug=dbg)
     try:
-        app.main()
+        run_main(app, profile)
     finally:
         log.debug('finally')
         app.end()
@@ -251,10 +704,11 @@ MIDI player
 @click.option('--sec_max', '--max', 'sec_max', type=float,
               default=Player.SEC_MAX,
               help='max sound length, default=%s' % (Player.SEC_MAX))
+@PROFILE_OPTION
 @click.option('--debug', '-d', 'dbg', is_flag=True, default=False,
               help='debug flag')
 def play(midi_file,  # pylint: disable=too-many-arguments
-         pos_sec, channel, rate, sec_min, sec_max, dbg) -> None:
+         pos_sec, channel, rate, sec_min, sec_max, profile, dbg) -> None:
     """
     player main
     """
@@ -265,7 +719,7 @@ def play(midi_file,  # pylint: disable=too-many-arguments
                   sec_min=sec_min, sec_max=sec_max, pos_sec=pos_sec,
                   debug=dbg)
     try:
-        app.main()
+        run_main(app, profile)
     finally:
         log.debug('finally')
         app.end()
@@ -0,0 +1,395 @@
+#
+# (c) 2021 Yoichi Tanibayashi
+#
+"""
+Bundle: several rolls of one MIDI file in a zip file
+
+The MIDI file is parsed once into the note cache (see `notes`),
+and the rolls are rendered from the cached note streams
+(concurrently, if a worker pool is given).
+
+Multi-model bundle (`render_bundle()`): a roll for each model
+
+    {MIDI file name}.zip
+        {model}.svg ..
+        summary.json:
+            {'midi': MIDI file name, 'channel': [..], 'notes': N,
+             'models': [{roll}, ..]}
+
+Per-channel bundle (`render_channel_bundle()`): the combined roll
+and a roll for each MIDI channel. Notes are partitioned by channel
+in one pass, and the partitions are cached.
+
+    {MIDI file name}.channels.zip
+        all.svg, ch00.svg, ch01.svg ..
+        summary.json:
+            {'midi': MIDI file name, 'model': .., 'notes': N,
+             'channels': [{roll, 'polyphony': ..}, ..]}
+
+Roll:
+    {'model': .., 'channel': [..] ([]: all), 'file': '{name}.svg',
+     'notes': N, 'fit': notes in the range of the model,
+     'out_of_range': N - fit, 'playable': fit / N,
+     'holes': .., 'short_gap': .., 'width': roll length in mm}
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__ = '2021/01'
+
+import os
+import json
+import time
+import zipfile
+import tempfile
+import concurrent.futures
+from .notes import get_note_cache, is_note_file, load as load_notes
+from .fileutil import file_hash
+from .worker import render_svg
+from .fileutil import atomic_open
+
+
+SUFFIX = '.zip'
+CHANNELS_SUFFIX = '.channels.zip'
+ALL_NAME = 'all.svg'
+SUMMARY_NAME = 'summary.json'
+BUF_SIZE = 64 * 1024
+
+
+def cache_notes(midi_file, channel=(), note_dir=None, debug=False) -> int:
+    """ parse MIDI file into the note cache, shared by the following
+    renders of all models
+
+    This function is executed in a worker process (or thread).
+
+    Parameters
+    ----------
+    midi_file: str
+        MIDI file name, or note file name
+    channel: list of int
+        selected MIDI channel ([]: all)
+    note_dir: str
+        directory of the note cache
+
+    Returns
+    -------
+    n_notes: int
+    """
+    if is_note_file(midi_file):
+        return len(load_notes(midi_file).select(channel))
+
+    return len(get_note_cache(note_dir, debug=debug).get(midi_file,
+                                                         channel))
+
+
+def cache_channels(midi_file, note_dir=None, debug=False) -> list:
+    """ parse MIDI file, partition the notes by channel, and put
+    the partitions into the note cache (see `cache_notes()`)
+
+    This function is executed in a worker process (or thread).
+
+    Parameters
+    ----------
+    midi_file: str
+        MIDI file name, or note file name
+    note_dir: str
+        directory of the note cache
+
+    Returns
+    -------
+    channels: list of dict
+        {'channel': [], 'notes': N, 'polyphony': max polyphony}
+        of all notes, followed by those of each channel
+    """
+    if is_note_file(midi_file):
+        notes = load_notes(midi_file)
+        partitions = notes.partition()
+    else:
+        note_cache = get_note_cache(note_dir, debug=debug)
+        midi_digest = file_hash(midi_file)
+        notes = note_cache.get(midi_file, [], midi_digest)
+        partitions = notes.partition()
+        for ch, part in partitions.items():
+            note_cache.put(midi_digest, [ch], part)
+
+    channels = [{'channel': [], 'notes': len(notes),
+                 'polyphony': notes.polyphony()}]
+    for ch, part in partitions.items():
+        channels.append({'channel': [ch], 'notes': len(part),
+                         'polyphony': part.polyphony()})
+    return channels
+
+
+def svg_name(model) -> str:
+    """ file name of the roll of `model` in the bundle """
+    return '%s.svg' % (model)
+
+
+def channel_svg_name(channel) -> str:
+    """ file name of the roll of `channel` in the bundle
+
+    Parameters
+    ----------
+    channel: list of int
+        [ch] or [] (all)
+    """
+    if not channel:
+        return ALL_NAME
+    return 'ch%02d.svg' % (channel[0])
+
+
+def roll(name, model, channel, result) -> dict:
+    """ summary of a roll (see module doc)
+
+    Parameters
+    ----------
+    name: str
+        file name in the bundle
+    model: str
+    channel: list of int
+    result: dict
+        result of `worker.render_svg()`
+        (unknown values are None, e.g. meta data of old cache entries)
+    """
+    notes = result.get('notes')
+    out_of_range = result.get('out_of_range')
+    fit = playable = None
+    if notes is not None and out_of_range is not None:
+        fit = notes - out_of_range
+        playable = round(fit / notes, 4) if notes else 0
+
+    return {'model': model, 'channel': list(channel), 'file': name,
+            'notes': notes, 'fit': fit, 'out_of_range': out_of_range,
+            'playable': playable,
+            'holes': result.get('holes'),
+            'short_gap': result.get('short_gap'),
+            'width': result.get('width')}
+
+
+def summary(midi_file, channel, n_notes, models, results) -> dict:
+    """ summary of a multi-model bundle (see module doc)
+
+    Parameters
+    ----------
+    midi_file: str
+    channel: list of int
+    n_notes: int
+    models: list of str
+        Model Names
+    results: list of dict
+        results of `worker.render_svg()`
+    """
+    return {'midi': os.path.basename(midi_file), 'channel': list(channel),
+            'notes': n_notes,
+            'models': [roll(svg_name(model), model, channel, result)
+                       for model, result in zip(models, results)]}
+
+
+def channel_summary(midi_file, model, channels, results) -> dict:
+    """ summary of a per-channel bundle (see module doc)
+
+    Parameters
+    ----------
+    midi_file: str
+    model: str
+    channels: list of dict
+        see `cache_channels()`
+    results: list of dict
+        results of `worker.render_svg()`
+    """
+    entries = []
+    for ch, result in zip(channels, results):
+        ent = roll(channel_svg_name(ch['channel']), model, ch['channel'],
+                   result)
+        ent['polyphony'] = ch['polyphony']
+        entries.append(ent)
+
+    return {'midi': os.path.basename(midi_file), 'model': model,
+            'notes': channels[0]['notes'], 'channels': entries}
+
+
+def write_bundle(f, svg_files, summary_data):
+    """ write zip file
+
+    Parameters
+    ----------
+    f: file object
+        opened in binary mode
+    svg_files: list of (str, file object)
+        (name in the zip file, SVG data in text or binary mode),
+        closed after writing
+    summary_data: dict
+        see `summary()`
+    """
+    with zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, svg_f in svg_files:
+            info = zipfile.ZipInfo(name, time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with svg_f, zf.open(info, 'w') as out_f:
+                while True:
+                    data = svg_f.read(BUF_SIZE)
+                    if not data:
+                        break
+                    if isinstance(data, str):
+                        data = data.encode('utf-8')
+                    out_f.write(data)
+
+        zf.writestr(SUMMARY_NAME, json.dumps(summary_data, indent=2))
+
+
+def _num(fmt, value, scale=1) -> str:
+    """ formatted number, or '-' if unknown
+    (e.g. not in the metadata of an old cache entry) """
+    if value is None:
+        return '-'
+    return fmt % (value * scale)
+
+
+def format_summary(summary_data) -> str:
+    """ summary table (CLI) """
+    lines = []
+    for ent in summary_data.get('models', []):
+        lines.append('  %-16s %6s/%s notes fit, %s holes, %s mm' % (
+            ent['model'], _num('%d', ent.get('fit')),
+            _num('%d', ent.get('notes')), _num('%d', ent.get('holes')),
+            _num('%.1f', ent.get('width'))))
+    for ent in summary_data.get('channels', []):
+        lines.append('  %-8s %6s/%s notes fit (%5s%%), '
+                     'polyphony %s, %s holes' % (
+                         os.path.splitext(ent['file'])[0],
+                         _num('%d', ent.get('fit')),
+                         _num('%d', ent.get('notes')),
+                         _num('%.1f', ent.get('playable'), 100),
+                         _num('%d', ent.get('polyphony')),
+                         _num('%d', ent.get('holes'))))
+    return '\n'.join(lines)
+
+
+def _submit(pool, func, *args, **kwargs) -> concurrent.futures.Future:
+    """ `pool.submit()`, or call `func` now if `pool` is None """
+    if pool is not None:
+        return pool.submit(func, *args, **kwargs)
+
+    future = concurrent.futures.Future()
+    try:
+        future.set_result(func(*args, **kwargs))
+    except Exception as ex:  # pylint: disable=broad-except
+        future.set_exception(ex)
+    return future
+
+
+def _render_rolls(midi_file, bundle_file, rolls, conf_file, note_dir,
+                  overrides, pool, summary_func, debug) -> dict:
+    """ render rolls from cached notes, and write a bundle
+
+    Parameters
+    ----------
+    rolls: list of (str, str, list of int)
+        (file name in the bundle, Model Name, channel)
+    summary_func: callable
+        `summary_func(results)` returns summary
+    """
+    with tempfile.TemporaryDirectory(prefix='storgan-') as tmp_dir:
+        futures = [
+            _submit(pool, render_svg, midi_file,
+                    os.path.join(tmp_dir, name), model, conf_file,
+                    channel, note_dir=note_dir, overrides=overrides,
+                    debug=debug)
+            for name, model, channel in rolls]
+        results = [future.result() for future in futures]
+
+        summary_data = summary_func(results)
+        with atomic_open(bundle_file, 'wb') as f:
+            write_bundle(f, [(name, open(os.path.join(tmp_dir, name), 'rb'))
+                             for name, _, _ in rolls], summary_data)
+
+    return summary_data
+
+
+def render_bundle(midi_file, bundle_file, models, conf_file, channel=(),
+                  note_dir=None, overrides=None, pool=None,
+                  debug=False) -> dict:
+    """ render rolls of all `models` into a bundle (see module doc)
+
+    Parameters
+    ----------
+    midi_file: str
+        MIDI file name, or note file name
+    bundle_file: str
+        output zip file name
+    models: list of str
+        Model Names
+    conf_file: str
+        configuration file
+    channel: list of int
+        selected MIDI channel ([]: all)
+    note_dir: str
+        directory of the note cache (None: temporary)
+    overrides: dict
+        configuration entries replaced for all models
+        (see `model.Model.replace()`)
+    pool: worker.RenderPool
+        models are rendered concurrently in the pool
+        (None: one by one in this process)
+
+    Returns
+    -------
+    summary: dict
+    """
+    with tempfile.TemporaryDirectory(prefix='storgan-') as tmp_dir:
+        if note_dir is None:
+            note_dir = tmp_dir
+
+        n_notes = _submit(pool, cache_notes, midi_file, channel,
+                          note_dir=note_dir, debug=debug).result()
+
+        return _render_rolls(
+            midi_file, bundle_file,
+            [(svg_name(model), model, channel) for model in models],
+            conf_file, note_dir, overrides, pool,
+            lambda results: summary(midi_file, channel, n_notes, models,
+                                    results),
+            debug)
+
+
+def render_channel_bundle(midi_file, bundle_file, model, conf_file,
+                          note_dir=None, overrides=None, pool=None,
+                          debug=False) -> dict:
+    """ render the combined roll and the roll of each channel
+    into a bundle (see module doc)
+
+    Parameters
+    ----------
+    midi_file: str
+        MIDI file name, or note file name
+    bundle_file: str
+        output zip file name
+    model: str
+        Model Name
+    conf_file: str
+        configuration file
+    note_dir: str
+        directory of the note cache (None: temporary)
+    overrides: dict
+        configuration entries replaced (see `model.Model.replace()`)
+    pool: worker.RenderPool
+        channels are rendered concurrently in the pool
+        (None: one by one in this process)
+
+    Returns
+    -------
+    summary: dict
+    """
+    with tempfile.TemporaryDirectory(prefix='storgan-') as tmp_dir:
+        if note_dir is None:
+            note_dir = tmp_dir
+
+        channels = _submit(pool, cache_channels, midi_file,
+                           note_dir=note_dir, debug=debug).result()
+
+        return _render_rolls(
+            midi_file, bundle_file,
+            [(channel_svg_name(ch['channel']), model, ch['channel'])
+             for ch in channels],
+            conf_file, note_dir, overrides, pool,
+            lambda results: channel_summary(midi_file, model, channels,
+                                            results),
+            debug)
@@ -0,0 +1,378 @@
+#
+# (c) 2021 Yoichi Tanibayashi
+#
+"""
+Content-addressed render cache for MIDI -> SVG results
+
+The cache key is made from
+the MIDI contents, the model name, the selected channels and
+the model configuration.
+So the same tune is converted only once,
+and a different tune with the same file name never hits a stale result.
+
+Two tiers:
+  * memory: LRU, limited by total bytes (small entries only,
+    and only while the entry exists on disk)
+  * disk: files in `cache_dir`, limited by total bytes
+    (least recently used files are removed first,
+    down to `LOW_WATER` of the limit)
+
+The gzip-compressed SVG of an entry ('{key}.svgz', for downloads)
+is made on demand, and is counted in the disk tier.
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__ = '2021/01'
+
+import io
+import os
+import json
+import time
+import hashlib
+import threading
+import contextlib
+from collections import OrderedDict
+from .fileutil import atomic_open, atomic_write, atomic_gzip
+from .my_logger import get_logger
+
+
+def midi_hash(data: bytes) -> str:
+    """ hash of MIDI data
+
+    Parameters
+    ----------
+    data: bytes
+        contents of MIDI file
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+class RenderCache:
+    """ two-tier (memory and disk) render cache
+
+    Attributes
+    ----------
+    hits: int
+    misses: int
+    """
+    DEF_MEM_LIMIT = 32 * 1024 * 1024  # 32MB
+    DEF_DISK_LIMIT = 1024 * 1024 * 1024  # 1GB
+
+    MEM_ITEM_LIMIT = 1024 * 1024  # 1MB
+
+    LOW_WATER = 0.9  # eviction goes down to this ratio of disk_limit
+    RESCAN_SEC = 60  # the disk tier is rescanned at most this often
+
+    SUFFIX = '.svg'
+    GZ_SUFFIX = '.svgz'
+    META_SUFFIX = '.json'
+
+    KEY_VERSION = 2  # bump when the rendered output changes
+
+    def __init__(self, cache_dir,
+                 mem_limit=DEF_MEM_LIMIT, disk_limit=DEF_DISK_LIMIT,
+                 debug=False):
+        """ Constructor
+
+        Parameters
+        ----------
+        cache_dir: str
+            cache directory
+        mem_limit: int
+            max total bytes in memory
+        disk_limit: int
+            max total bytes on disk
+        """
+        self._dbg = debug
+        self._log = get_logger(self.__class__.__name__, self._dbg)
+        self._log.debug('cache_dir=%s, mem_limit=%s, disk_limit=%s',
+                        cache_dir, mem_limit, disk_limit)
+
+        self._cache_dir = os.path.expanduser(cache_dir)
+        self._mem_limit = mem_limit
+        self._disk_limit = disk_limit
+
+        os.makedirs(self._cache_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._mem = OrderedDict()
+        self._mem_size = 0
+        self._disk = OrderedDict()  # file name -> size (LRU first)
+        self._disk_size = 0
+        self._scanned = 0
+        self._scan_disk()
+        self._log.debug('disk_size=%s', self._disk_size)
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(midi_digest, model, channel, conf_fp, variant='') -> str:
+        """ make cache key
+
+        Parameters
+        ----------
+        midi_digest: str
+            hash of MIDI data (see `midi_hash()`)
+        model: str
+            Model Name
+        channel: list of int
+            selected MIDI channel ([]: all)
+        conf_fp: str
+            fingerprint of model configuration (model.Model.fingerprint)
+        variant: str
+            rendering options (e.g. page)
+        """
+        key_src = '%s|%s|%s|%s|%s|%s' % (
+            RenderCache.KEY_VERSION, midi_digest, model,
+            ','.join([str(ch) for ch in sorted(set(channel))]),
+            conf_fp, variant)
+
+        return hashlib.sha256(key_src.encode('utf-8')).hexdigest()
+
+    @property
+    def cache_dir(self) -> str:
+        """ cache directory """
+        return self._cache_dir
+
+    def path(self, key) -> str:
+        """ path name of the disk tier entry """
+        return os.path.join(self._cache_dir, key + self.SUFFIX)
+
+    def gz_path(self, key) -> str:
+        """ path name of the gzip-compressed disk tier entry """
+        return os.path.join(self._cache_dir, key + self.GZ_SUFFIX)
+
+    def meta_path(self, key) -> str:
+        """ path name of the meta data of the disk tier entry """
+        return os.path.join(self._cache_dir, key + self.META_SUFFIX)
+
+    def _scan_disk(self):
+        """ rebuild the index of the disk tier from the directory
+        (lock must be held)
+
+        Other server processes add and remove entries
+        in the same directory.
+        """
+        entries = []
+        for e in os.scandir(self._cache_dir):
+            if not e.is_file() or \
+               not e.name.endswith((self.SUFFIX, self.GZ_SUFFIX)):
+                continue
+            try:
+                st = e.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, e.name, st.st_size))
+        entries.sort()
+
+        self._disk = OrderedDict([(name, size)
+                                  for _, name, size in entries])
+        self._disk_size = sum(self._disk.values())
+        self._scanned = time.monotonic()
+
+    def _disk_put(self, name, size):
+        """ add a file to the index of the disk tier, and evict
+        (lock must be held) """
+        self._disk_size += size - self._disk.pop(name, 0)
+        self._disk[name] = size
+        self._disk_evict()
+
+    def _mem_put(self, key, svg):
+        """ put to memory tier (lock must be held) """
+        size = len(svg)
+        if size > min(self._mem_limit, self.MEM_ITEM_LIMIT):
+            return
+
+        old = self._mem.pop(key, None)
+        if old is not None:
+            self._mem_size -= len(old)
+
+        self._mem[key] = svg
+        self._mem_size += size
+
+        while self._mem_size > self._mem_limit:
+            _, old = self._mem.popitem(last=False)
+            self._mem_size -= len(old)
+
+    def _disk_evict(self):
+        """ remove least recently used files from disk tier
+        (lock must be held) """
+        if self._disk_size <= self._disk_limit:
+            return
+
+        # entries of other server processes
+        if time.monotonic() - self._scanned > self.RESCAN_SEC:
+            self._scan_disk()
+
+        low_water = self._disk_limit * self.LOW_WATER
+        while self._disk and self._disk_size > low_water:
+            name, size = self._disk.popitem(last=False)
+            self._disk_size -= size
+            try:
+                # other server processes may remove it at the same time
+                os.remove(os.path.join(self._cache_dir, name))
+                self._log.debug('evict %s', name)
+            except FileNotFoundError:
+                continue
+            if not name.endswith(self.SUFFIX):
+                continue
+
+            # the gzip-compressed entry is removed by its own turn
+            key = name[:-len(self.SUFFIX)]
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.meta_path(key))
+
+            svg = self._mem.pop(key, None)
+            if svg is not None:
+                self._mem_size -= len(svg)
+
+    def _disk_touch(self, key):
+        """ mark the disk tier entry as recently used
+        (lock must be held) """
+        name = key + self.SUFFIX
+        if name in self._disk:
+            self._disk.move_to_end(name)
+
+    def open(self, key):
+        """ open cached SVG data for reading
+
+        Small entries are kept in the memory tier,
+        large entries are read from the disk tier in chunks.
+
+        Returns
+        -------
+        f: file object or None
+            None: not cached
+        """
+        with self._lock:
+            svg = self._mem.get(key)
+            if svg is not None:
+                self._mem.move_to_end(key)
+                self._disk_touch(key)
+                self.hits += 1
+                return io.StringIO(svg)
+
+        path = self.path(key)
+        try:
+            f = open(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        os.utime(f.fileno())
+        with self._lock:
+            self._disk_touch(key)
+            self.hits += 1
+
+        if os.fstat(f.fileno()).st_size > self.MEM_ITEM_LIMIT:
+            return f
+
+        with f:
+            svg = f.read()
+
+        with self._lock:
+            self._mem_put(key, svg)
+
+        return io.StringIO(svg)
+
+    def get(self, key):
+        """ get SVG data
+
+        Returns
+        -------
+        svg: str or None
+            None: not cached
+        """
+        f = self.open(key)
+        if f is None:
+            return None
+
+        with f:
+            return f.read()
+
+    def gzip(self, key):
+        """ make the gzip-compressed disk tier entry, if not exists
+
+        Returns
+        -------
+        path: str or None
+            path name (see `gz_path()`)
+            None: not cached
+        """
+        path = self.gz_path(key)
+        if os.path.exists(path):
+            return path
+
+        try:
+            atomic_gzip(self.path(key), path)
+        except FileNotFoundError:
+            return None
+
+        size = os.path.getsize(path)
+        with self._lock:
+            self._disk_put(os.path.basename(path), size)
+        return path
+
+    def get_meta(self, key):
+        """ get meta data
+
+        Returns
+        -------
+        meta: dict or None
+        """
+        try:
+            with open(self.meta_path(key)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def put_meta(self, key, meta):
+        """ put meta data (e.g. size of the roll)
+
+        Parameters
+        ----------
+        key: str
+        meta: dict
+        """
+        atomic_write(self.meta_path(key), json.dumps(meta))
+
+    def add(self, key):
+        """ register the disk tier entry written by others
+        (e.g. worker processes)
+
+        Parameters
+        ----------
+        key: str
+        """
+        size = os.path.getsize(self.path(key))
+
+        with self._lock:
+            self._disk_put(key + self.SUFFIX, size)
+
+    @contextlib.contextmanager
+    def writer(self, key):
+        """ open the disk tier entry for (streaming) writing
+
+        Parameters
+        ----------
+        key: str
+        """
+        with atomic_open(self.path(key)) as f:
+            yield f
+
+        self.add(key)
+
+    def put(self, key, svg):
+        """ put SVG data
+
+        Parameters
+        ----------
+        key: str
+        svg: str
+        """
+        with self.writer(key) as f:
+            f.write(svg)
+
+        with self._lock:
+            self._mem_put(key, svg)
@@ -0,0 +1,401 @@
+#
+# (c) 2021 Yoichi Tanibayashi
+#
+"""
+Resident daemon: CLI commands without the startup cost
+
+The daemon keeps the interpreter, the imported modules (midilib ..)
+and the models warm, and listens on a UNIX socket.
+The CLI forwards `COMMANDS` to the daemon, if it is running,
+instead of importing everything and loading the configuration.
+
+    $ Storgan daemon -f storgan.conf &
+    $ Storgan rollbook a.mid     # run by the daemon
+    $ STORGAN_NO_DAEMON=1 Storgan rollbook a.mid   # run locally
+
+Each request is run in a process forked from the daemon,
+with stdin, stdout and stderr of the client (passed over the socket)
+and in the working directory of the client.
+
+Protocol:
+    client -> daemon: JSON {'argv': [..], 'cwd': ..}
+                      (file descriptors 0, 1, 2 as SCM_RIGHTS),
+                      and shutdown of writing
+    daemon -> client: JSON {'exit': exit status}
+
+This module is imported by the CLI before anything else,
+so that the client part imports only the standard library.
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__ = '2021/01'
+
+import os
+import sys
+import json
+import array
+import stat
+import struct
+import signal
+import socket
+import socketserver
+import traceback
+
+COMMANDS = ('rollbook', 'parse')
+PROG_NAME = 'Storgan'
+
+SOCKET_ENV = 'STORGAN_SOCKET'
+NO_DAEMON_ENV = 'STORGAN_NO_DAEMON'
+
+BUF_SIZE = 64 * 1024
+N_FDS = 3  # stdin, stdout, stderr
+
+
+def socket_path() -> str:
+    """ path name of the UNIX socket
+    ($STORGAN_SOCKET, '$XDG_RUNTIME_DIR/storgan.sock',
+    or '$TMPDIR/storgan-{uid}/daemon.sock') """
+    path = os.environ.get(SOCKET_ENV)
+    if path:
+        return os.path.expanduser(path)
+
+    run_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if run_dir:
+        return os.path.join(run_dir, 'storgan.sock')
+
+    return os.path.join(os.environ.get('TMPDIR', '/tmp'),
+                        'storgan-%d' % (os.getuid()), 'daemon.sock')
+
+
+def _is_own_socket(sock_path) -> bool:
+    """ the file is a socket of the user
+    (not a file put by someone else on a predictable path) """
+    try:
+        st = os.lstat(sock_path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(st.st_mode) and st.st_uid == os.getuid()
+
+
+def _peer_uid(sock):
+    """ uid of the process on the other end
+
+    Returns
+    -------
+    uid: int
+        None: unknown (SO_PEERCRED is not supported)
+    """
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+
+    cred = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                           struct.calcsize('3i'))
+    _pid, uid, _gid = struct.unpack('3i', cred)
+    return uid
+
+
+def _check_dir(dir_name):
+    """ make the directory of the socket (for the user only)
+
+    Raises
+    ------
+    RuntimeError
+        the directory is not owned by the user,
+        or others can replace the socket in it
+    """
+    if not os.path.exists(dir_name):
+        os.makedirs(dir_name, mode=0o700)
+
+    st = os.stat(dir_name)
+    if st.st_uid not in (os.getuid(), 0):
+        raise RuntimeError('not owned by the user: %s' % (dir_name))
+    if st.st_mode & 0o022 and not st.st_mode & stat.S_ISVTX:
+        raise RuntimeError('writable by others: %s' % (dir_name))
+
+
+def connect(sock_path=None):
+    """ connect to the daemon
+
+    The socket and the daemon are checked to be of the user,
+    before passing the file descriptors to it.
+
+    Returns
+    -------
+    sock: socket.socket
+        None: the daemon is not running (or not of the user)
+    """
+    sock_path = sock_path or socket_path()
+    if not os.path.exists(sock_path):
+        return None
+    if not _is_own_socket(sock_path):
+        print('%s: not a socket of the user, ignored: %s' % (
+            PROG_NAME, sock_path), file=sys.stderr)
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(sock_path)
+        uid = _peer_uid(sock)
+    except OSError:
+        sock.close()
+        return None
+
+    if uid not in (None, os.getuid()):
+        sock.close()
+        print('%s: the daemon is not of the user (uid=%d), ignored: %s' % (
+            PROG_NAME, uid, sock_path), file=sys.stderr)
+        return None
+    return sock
+
+
+def _recv_all(sock) -> bytes:
+    """ receive until EOF """
+    chunks = []
+    while True:
+        data = sock.recv(BUF_SIZE)
+        if not data:
+            return b''.join(chunks)
+        chunks.append(data)
+
+
+def forward(argv, sock_path=None):
+    """ run CLI command by the daemon
+
+    Parameters
+    ----------
+    argv: list of str
+        command line arguments (without the program name)
+    sock_path: str
+        (None: `socket_path()`)
+
+    Returns
+    -------
+    exit_status: int
+        None: not forwarded (not in `COMMANDS`, disabled by
+        $STORGAN_NO_DAEMON, or the daemon is not running)
+    """
+    if not argv or argv[0] not in COMMANDS or \
+       os.environ.get(NO_DAEMON_ENV):
+        return None
+
+    sock = connect(sock_path)
+    if sock is None:
+        return None
+
+    with sock:
+        req = json.dumps({'argv': list(argv),
+                          'cwd': os.getcwd()}).encode('utf-8')
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        fds = array.array('i', range(N_FDS))
+        sock.sendmsg([req[:1]],
+                     [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+        sock.sendall(req[1:])
+        sock.shutdown(socket.SHUT_WR)
+
+        res = _recv_all(sock)
+
+    try:
+        return int(json.loads(res.decode('utf-8'))['exit'])
+    except (ValueError, KeyError, TypeError):
+        print('%s: no response from the daemon' % (PROG_NAME),
+              file=sys.stderr)
+        return 1
+
+
+def _recv_request(sock):
+    """ receive a request (see module doc)
+
+    Returns
+    -------
+    req: dict
+        None: no request (e.g. `connect()` only)
+    fds: list of int
+    """
+    fds = array.array('i')
+    data, ancdata, _, _ = sock.recvmsg(
+        BUF_SIZE, socket.CMSG_SPACE(N_FDS * fds.itemsize))
+    for level, ctype, cdata in ancdata:
+        if level == socket.SOL_SOCKET and ctype == socket.SCM_RIGHTS:
+            cdata = cdata[:len(cdata) - (len(cdata) % fds.itemsize)]
+            fds.frombytes(cdata)
+
+    data += _recv_all(sock)
+    req = json.loads(data.decode('utf-8')) if data else None
+    return req, list(fds)
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    """ request handler (in a forked process) """
+    def handle(self):
+        self.server.daemon.handle(self.request)
+
+
+class _Server(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    """ UNIX socket server, forking a process per request
+
+    Attributes
+    ----------
+    daemon: Daemon
+    """
+    def __init__(self, sock_path, daemon):
+        self.daemon = daemon
+        super().__init__(sock_path, _Handler)
+
+    def process_request(self, request, client_address):
+        # buffered output is not duplicated in the child
+        sys.stdout.flush()
+        sys.stderr.flush()
+        super().process_request(request, client_address)
+
+
+class Daemon:
+    """ resident daemon (see module doc) """
+    def __init__(self, cli, conf_file, sock_path=None, debug=False):
+        """ Constructor
+
+        Parameters
+        ----------
+        cli: click.Group
+            the CLI (run for each request)
+        conf_file: str
+            configuration file (models are loaded in advance)
+        sock_path: str
+            (None: `socket_path()`)
+        """
+        from .my_logger import get_logger  # not imported by the client
+
+        self._dbg = debug
+        self._log = get_logger(self.__class__.__name__, self._dbg)
+        self._log.debug('conf_file=%s, sock_path=%s', conf_file, sock_path)
+
+        self._cli = cli
+        self._conf_file = conf_file
+        self._sock_path = sock_path or socket_path()
+        self._pid = os.getpid()
+        self._server = None
+
+    def preload(self):
+        """ import the parser and load the models """
+        from midilib import Parser
+        from .model import get_registry
+
+        Parser(debug=self._dbg)
+        registry = get_registry(self._conf_file, debug=self._dbg)
+        self._log.info('models=%s', registry.names())
+
+    def main(self):
+        """ main: serve until SIGTERM or SIGINT
+
+        Raises
+        ------
+        RuntimeError
+            the daemon is already running,
+            or the socket path is not safe (see `_check_dir()`)
+        """
+        _check_dir(os.path.dirname(os.path.abspath(self._sock_path)))
+
+        sock = connect(self._sock_path)
+        if sock is not None:
+            sock.close()
+            raise RuntimeError('already running: %s' % (self._sock_path))
+        if os.path.lexists(self._sock_path):
+            if not _is_own_socket(self._sock_path):
+                raise RuntimeError('not a socket of the user: %s' % (
+                    self._sock_path))
+            os.remove(self._sock_path)  # stale
+
+        self.preload()
+        signal.signal(signal.SIGTERM, self._stop)
+
+        old_umask = os.umask(0o177)  # the socket is for the user only
+        try:
+            self._server = _Server(self._sock_path, self)
+        finally:
+            os.umask(old_umask)
+
+        self._log.info('listen: %s', self._sock_path)
+        try:
+            self._server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.end()
+
+    @staticmethod
+    def _stop(_signum, _frame):
+        """ signal handler: stop serving """
+        raise SystemExit(0)
+
+    def handle(self, conn):
+        """ run a request (in a forked process)
+
+        Parameters
+        ----------
+        conn: socket.socket
+        """
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+        uid = _peer_uid(conn)
+        if uid not in (None, os.getuid()):
+            self._log.warning('not of the user: uid=%d', uid)
+            return
+
+        req, fds = _recv_request(conn)
+        self._log.debug('req=%s, fds=%s', req, fds)
+        if req is None:
+            return
+
+        for std_fd, fd in enumerate(fds[:N_FDS]):
+            os.dup2(fd, std_fd)
+        for fd in fds:
+            os.close(fd)
+
+        try:
+            os.chdir(req['cwd'])
+            status = self.run(req['argv'])
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+
+        conn.sendall(json.dumps({'exit': status}).encode('utf-8'))
+
+    def run(self, argv) -> int:
+        """ run CLI command
+
+        Returns
+        -------
+        exit_status: int
+        """
+        import click  # not imported by the client
+
+        try:
+            ret = self._cli.main(args=list(argv), prog_name=PROG_NAME,
+                                 standalone_mode=False)
+            return ret if isinstance(ret, int) else 0
+        except click.ClickException as ex:
+            ex.show()
+            return ex.exit_code
+        except click.Abort:
+            print('Aborted!', file=sys.stderr)
+            return 1
+        except SystemExit as ex:
+            if ex.code is None or isinstance(ex.code, int):
+                return ex.code or 0
+            print(ex.code, file=sys.stderr)
+            return 1
+        except Exception:  # pylint: disable=broad-except
+            traceback.print_exc()
+            return 1
+
+    def end(self):
+        """ close the socket (in the daemon process only) """
+        if os.getpid() != self._pid or self._server is None:
+            return
+
+        self._log.info('end')
+        self._server.server_close()
+        self._server = None
+        if _is_own_socket(self._sock_path):
+            os.remove(self._sock_path)
@@ -0,0 +1,16 @@
+#
+# (c) 2021 Yoichi Tanibayashi
+#
+"""
+default settings of the web server
+
+They are used by the command line options of `webapp`,
+so that the CLI does not import tornado (see `webapp.WebServer`).
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__ = '2021/01'
+
+DEF_PORT = 10081
+DEF_WEBROOT = './webroot'
+DEF_WORKDIR = '/tmp/storgan'
+DEF_SIZE_LIMIT = 100*1024*1024  # 100MB
@@ -0,0 +1,155 @@
+#
+# (c) 2021 Yoichi Tanibayashi
+#
+"""
+file utilities
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__ = '2021/01'
+
+import io
+import os
+import gzip
+import shutil
+import hashlib
+import tempfile
+import contextlib
+
+
+HASH_BUF_SIZE = 64 * 1024
+
+SVGZ_SUFFIX = '.svgz'
+
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def make_temp(dir_name, prefix='.tmp-'):
+    """ make temporary file with the default permission (umask)
+
+    Parameters
+    ----------
+    dir_name: str
+    prefix: str
+
+    Returns
+    -------
+    (fd, path): (int, str)
+    """
+    fd, path = tempfile.mkstemp(dir=dir_name, prefix=prefix)
+    os.chmod(path, 0o666 & ~_UMASK)
+    return fd, path
+
+
+@contextlib.contextmanager
+def atomic_open(path, mode='w'):
+    """ open file for atomic writing
+
+    Data is written to a temporary file in the same directory,
+    and renamed to `path` on successful exit.
+    Readers never see a partially written file.
+
+    Parameters
+    ----------
+    path: str
+    mode: str
+        'w' or 'wb'
+    """
+    fd, tmp_path = make_temp(os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, mode=mode) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+@contextlib.contextmanager
+def atomic_open_svg(path):
+    """ open SVG file for atomic writing (text mode)
+
+    If `path` ends with '.svgz', data is gzip-compressed.
+
+    Parameters
+    ----------
+    path: str
+    """
+    if not path.endswith(SVGZ_SUFFIX):
+        with atomic_open(path) as f:
+            yield f
+        return
+
+    with atomic_open(path, mode='wb') as raw_f:
+        with gzip.GzipFile(fileobj=raw_f, mode='wb', mtime=0) as gz_f:
+            with io.TextIOWrapper(gz_f, encoding='utf-8') as f:
+                yield f
+
+
+def atomic_gzip(src, dst):
+    """ gzip-compress `src` to `dst` atomically
+
+    Parameters
+    ----------
+    src: str
+    dst: str
+    """
+    with open(src, mode='rb') as in_f, atomic_open(dst, mode='wb') as f:
+        with gzip.GzipFile(fileobj=f, mode='wb', mtime=0) as gz_f:
+            shutil.copyfileobj(in_f, gz_f, HASH_BUF_SIZE)
+
+
+def atomic_write(path, data, mode='w'):
+    """ write file atomically (see `atomic_open()`)
+
+    Parameters
+    ----------
+    path: str
+    data: str or bytes
+    mode: str
+        'w' or 'wb'
+    """
+    with atomic_open(path, mode) as f:
+        f.write(data)
+
+
+def atomic_link(src, dst):
+    """ make `dst` a hard link to (or a copy of) `src` atomically
+
+    Parameters
+    ----------
+    src: str
+    dst: str
+    """
+    dir_name = os.path.dirname(dst) or '.'
+    tmp_path = os.path.join(dir_name, '.tmp-%s-%s' % (
+        os.getpid(), os.path.basename(dst)))
+    try:
+        try:
+            os.link(src, tmp_path)
+        except OSError:
+            shutil.copyfile(src, tmp_path)
+        os.replace(tmp_path, dst)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def file_hash(path) -> str:
+    """ SHA-256 hex digest of the file contents
+
+    Parameters
+    ----------
+    path: str
+    """
+    h = hashlib.sha256()
+    with open(path, mode='rb') as f:
+        while True:
+            data = f.read(HASH_BUF_SIZE)
+            if not data:
+                break
+            h.update(data)
+
+    return h.hexdigest()
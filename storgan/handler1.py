@@ -9,16 +9,66 @@ __author__ = 'Yoichi Tanibayashi'
 __date__ = '2021/01'
 
 import os
+import json
+import hmac
+import time
+import asyncio
+import tempfile
+import itertools
+from urllib.parse import urlencode, quote
+import tornado.ioloop
 import tornado.web
 from .rollbook import RollBook
+from .cache import RenderCache
+from .fileutil import atomic_link, SVGZ_SUFFIX
+from .multipart import StreamingFormData, StreamingBody, MultipartError
+from .multipart import MultipartTooLarge
+from .multipart import parse_header_params
+from .worker import QueueFull, render_page, render_svg, render_tile
+from .model import parse_overrides
+from .jobs import JobScheduler
+from . import bundle
+from . import transpose as transpose_mod
+from . import metrics
 from .my_logger import get_logger
 
 
-class Download(tornado.web.RequestHandler):
+BUF_SIZE = 64 * 1024
+
+
+async def write_file_obj(handler, f):
+    """ write contents of file object to client chunk by chunk
+
+    Parameters
+    ----------
+    handler: tornado.web.RequestHandler
+    f: file object
+        closed after writing
+    """
+    with f:
+        while True:
+            data = f.read(BUF_SIZE)
+            if not data:
+                break
+            handler.write(data)
+            await handler.flush()
+
+
+class Download(tornado.web.StaticFileHandler):
     """
     Download SVG file
+
+    Rolls are served from the render cache by cache key
+    ('{key}.svg' and '{key}.svgz', see `cache.RenderCache`) with
+    ETag / Last-Modified (304), Range and Content-Length.
+    The file name of the attachment is given by
+    the query argument 'name' (e.g. 'a.mid.svg').
+
+    If the client accepts gzip, '{key}.svgz' is served for '{key}.svg'
+    with 'Content-Encoding: gzip'.
+    '{key}.svgz' is made on demand, and stored in the cache.
     """
-    def __init__(self, app, req):
+    def __init__(self, app, req, **kwargs):
         """ Constructor """
         self._dbg = app.settings.get('debug')
         self._mylog = get_logger(self.__class__.__name__, self._dbg)
@@ -26,63 +76,237 @@ class Download(tornado.web.RequestHandler):
         self._mylog.debug('app=%s', app)
         self._mylog.debug('req=%s', req)
 
-        self._webroot = app.settings.get('webroot')
-        self._mylog.debug('webroot=%s', self._webroot)
+        self._render_cache = app.settings.get('render_cache')
+        self._gzip = False
 
-        self._workdir = app.settings.get('workdir')
-        self._mylog.debug('workdir=%s', self._workdir)
+        super().__init__(app, req, **kwargs)
 
-        self._size_limit = app.settings.get('size_limit')
-        self._mylog.debug('size_limit=%s', self._size_limit)
+    def validate_absolute_path(self, root, absolute_path):
+        """ validate path, and select the stored variant """
+        key, suffix = os.path.splitext(os.path.basename(absolute_path))
+        if suffix == SVGZ_SUFFIX:
+            self._render_cache.gzip(key)
 
-        # [!! 重要 !!] 末尾の「/」
-        self._url_path = app.settings.get('url_prefix_handler1') + '/'
+        path = super().validate_absolute_path(root, absolute_path)
+        self._mylog.debug('path=%s', path)
+        if path is None:
+            return None
 
-        self._version = app.settings.get('version')
+        if suffix == RenderCache.SUFFIX and \
+           'gzip' in self.request.headers.get('Accept-Encoding', ''):
+            gz_path = self._render_cache.gzip(key)
+            if gz_path is not None:
+                self._gzip = True
+                return super().validate_absolute_path(root, gz_path)
 
-        self._model_name = RollBook.DEF_MODEL_NAME
-        self._conf_file = RollBook.DEF_CONF_FILE
+        return path
 
-        self._rollbook = RollBook(self._model_name, self._conf_file,
-                                  debug=self._dbg)
+    def compute_etag(self):
+        """ strong ETag from the file status
 
-        super().__init__(app, req)
+        Files are replaced atomically (a new inode),
+        so the file contents are never read for ETag.
+        """
+        st = os.stat(self.absolute_path)
+        return '"%x-%x-%x"' % (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def get_content_type(self):
+        return 'application/octet-stream'
+
+    def set_extra_headers(self, path):
+        name = os.path.basename(self.get_query_argument('name', ''))
+        if not name:
+            name = os.path.basename(path)
+        elif path.endswith(SVGZ_SUFFIX) and name.endswith('.svg'):
+            name += 'z'
+        self.set_header('Content-Disposition',
+                        "attachment; filename*=UTF-8''" + quote(name))
+        if path.endswith('.svg'):
+            self.set_header('Vary', 'Accept-Encoding')
+        if self._gzip:
+            self.set_header('Content-Encoding', 'gzip')
 
-    def get(self):
+
+@tornado.web.stream_request_body
+class UploadHandler(tornado.web.RequestHandler):
+    """
+    base class of handlers receiving a MIDI file by POST
+
+    The request body is streamed:
+    the file is written to a temporary file in `upload_dir`
+    and hashed as it arrives.
+
+    multipart/form-data: the file is in the field `FILE_FIELD`,
+    and the other fields are in `self.upload.fields`.
+    Other Content-Type: the whole body is the file.
+    """
+    FILE_FIELD = 'file1'
+    CLIENT_ID_HEADER = 'X-Client-Id'
+
+    upload = None  # StreamingFormData or StreamingBody
+    _upload_error = None  # tornado.web.HTTPError (raised by `store_midi()`)
+    _upload_start = None  # time.perf_counter()
+
+    def prepare(self):
+        """ check headers before the request body is read """
+        if self.request.method != 'POST':
+            return
+
+        self._upload_start = time.perf_counter()
+        size_limit = self.settings.get('size_limit')
+        upload_dir = self.settings.get('upload_dir')
+        dbg = self.settings.get('debug')
+
+        content_len = int(self.request.headers.get('Content-Length', 0))
+        if content_len > size_limit:
+            raise tornado.web.HTTPError(
+                413, reason='too large: > %s bytes' % (size_limit))
+
+        content_type = parse_header_params(
+            'Content-Type', self.request.headers.get('Content-Type', ''))
+        if content_type.get_content_type() != 'multipart/form-data':
+            self.upload = StreamingBody(
+                self.FILE_FIELD, self.get_query_argument('filename', ''),
+                upload_dir, size_limit, debug=dbg)
+            return
+
+        boundary = content_type.get_param('boundary')
+        if not boundary:
+            raise tornado.web.HTTPError(400, reason='no boundary')
+        self.upload = StreamingFormData(boundary.encode('utf-8'),
+                                        upload_dir, size_limit, debug=dbg)
+
+    def data_received(self, chunk):
+        """ a chunk of request body
+
+        An error is replied after the whole body is read
+        (raising here closes the connection without a reply),
+        and the rest of the body is discarded.
         """
-        GET method and rendering
+        if self.upload is None or self._upload_error is not None:
+            return
+        try:
+            self.upload.feed(chunk)
+        except MultipartTooLarge as ex:
+            self._upload_error = tornado.web.HTTPError(413, reason=str(ex))
+        except MultipartError as ex:
+            self._upload_error = tornado.web.HTTPError(400, reason=str(ex))
+        else:
+            return
+        self.upload.cleanup()
+
+    def on_finish(self):
+        """ remove temporary files """
+        if self.upload is not None:
+            self.upload.cleanup()
+
+    def on_connection_close(self):
+        """ remove temporary files (e.g. body too large) """
+        super().on_connection_close()
+        self.on_finish()
+
+    def client_id(self) -> str:
+        """ client id: `CLIENT_ID_HEADER` or remote address """
+        return self.request.headers.get(self.CLIENT_ID_HEADER,
+                                        self.request.remote_ip)
+
+    def upload_field(self, name, default=None) -> str:
+        """ form field, or query argument """
+        return self.upload.fields.get(
+            name, self.get_query_argument(name, default))
+
+    def upload_fields(self, name) -> list:
+        """ form field (comma separated values),
+        or query arguments (repeated) """
+        value = self.upload.fields.get(name)
+        if value is None:
+            return self.get_query_arguments(name)
+        return [v for v in value.split(',') if v.strip()]
+
+    def transpose_overrides(self, model) -> tuple:
+        """ the field 'transpose' (default: auto-transpose)
+
+        Returns
+        -------
+        model: model.Model
+            overridden
+        overrides: dict
+            {'transpose': ..}, or {} (same as the model)
+
+        Raises
+        ------
+        tornado.web.HTTPError
+            400: invalid transpose
         """
-        self._mylog.debug('request=%s', self.request)
+        overrides = {}
+        transpose = self.upload_field('transpose', transpose_mod.AUTO)
+        if transpose != str(model.transpose):
+            try:
+                overrides['transpose'] = int(transpose) \
+                    if transpose != transpose_mod.AUTO else transpose
+                model = model.replace(overrides)
+            except (TypeError, ValueError):
+                raise tornado.web.HTTPError(400, reason='invalid transpose')
+        return model, overrides
+
+    def store_midi(self):
+        """ store the uploaded MIDI file to {webroot}/midi by hash
+
+        Returns
+        -------
+        upload_file: multipart.UploadFile
+        midi_path: str
+
+        Raises
+        ------
+        tornado.web.HTTPError
+            400: invalid request body, 413: too large
+        """
+        if self._upload_error is not None:
+            raise self._upload_error
+        try:
+            self.upload.close()
+        except MultipartError as ex:
+            raise tornado.web.HTTPError(400, reason=str(ex))
 
-        fname = self.request.uri.split('/')[-1]
-        self._mylog.debug('fname=%s', fname)
+        upload_file = self.upload.files.get(self.FILE_FIELD)
+        if upload_file is None or upload_file.size == 0:
+            raise tornado.web.HTTPError(400, reason='no file')
 
-        path_name = '%s/svg/%s' % (self._webroot, fname)
-        self._mylog.debug('path_name=%s', path_name)
+        metrics.STAGE_SECONDS.observe(
+            time.perf_counter() - self._upload_start, stage='upload')
+        metrics.UPLOAD_BYTES.inc(upload_file.size)
 
-        self.set_header('Content-Type', 'application/octet-stream')
-        self.set_header('Content-Disposition',
-                        'attachment; filename=' + fname)
+        # MIDI files are stored by hash: never stale
+        midi_path = '%s/midi/%s.mid' % (self.settings.get('webroot'),
+                                        upload_file.digest)
+        if not os.path.exists(midi_path):
+            atomic_link(upload_file.path, midi_path)
 
-        buf_size = 4096
-        with open(path_name, 'r') as f:
-            while True:
-                data = f.read(buf_size)
-                if not data:
-                    break
-                self.write(data)
+        return upload_file, midi_path
 
-        self.finish()
 
-
-class Handler1(tornado.web.RequestHandler):
+class Handler1(UploadHandler):
     """
     Web handler1
+
+    Conversions are run by JobScheduler with the highest priority.
+
+    A conversion is profiled (see `want_profile()`), if the request has
+    the header `PROFILE_TOKEN_HEADER` with `profile_token` (admin),
+    or once in `profile_sample` requests.
+    Profiles are written to `profile_dir`.
     """
     TITLE = 'Street Organ Roll Book Maker'
 
     HTML_FILE = 'storgan.html'
 
+    RETRY_AFTER = 10  # sec
+
+    PROFILE_TOKEN_HEADER = 'X-Profile-Token'
+
+    _n_posts = itertools.count(1)  # for sampling
+
     def __init__(self, app, req):
         """ Constructor """
         self._dbg = app.settings.get('debug')
@@ -105,11 +329,11 @@ class Handler1(tornado.web.RequestHandler):
 
         self._version = app.settings.get('version')
 
-        self._model_name = RollBook.DEF_MODEL_NAME
-        self._conf_file = RollBook.DEF_CONF_FILE
+        self._render_cache = app.settings.get('render_cache')
+        self._job_scheduler = app.settings.get('job_scheduler')
 
-        self._rollbook = RollBook(self._model_name, self._conf_file,
-                                  debug=self._dbg)
+        self._model_registry = app.settings.get('model_registry')
+        self._model_name = RollBook.DEF_MODEL_NAME
 
         super().__init__(app, req)
 
@@ -142,52 +366,623 @@ class Handler1(tornado.web.RequestHandler):
 
         return self.get_size_unit(f_size)
 
-    def get(self, svg_data='', svg_filename='',
-            msg='Please select a MIDI file'):
+    def get(self, viewer=None, svg_filename='',
+            msg='Please select a MIDI file', pages=[], svg_name=''):
         """
         GET method and rendering
         """
-        # self._mylog.debug('svg_data=%s', svg_data)
         self._mylog.debug('request=%s', self.request)
 
         if self.request.uri != self._url_path:
             self.redirect(self._url_path, permanent=True)
             return
 
+        self.render(self.HTML_FILE,
+                    **self.template_args(viewer, svg_filename, msg, pages,
+                                         svg_name))
+
+    def template_args(self, viewer, svg_filename, msg, pages=[],
+                      svg_name=''):
+        """
+        Parameters
+        ----------
+        viewer: dict
+            the roll viewer (None: upload form)
+            'tile_url': URL of tiles without the time range
+            (see `Tile`), 'width', 'height': roll size in mm,
+            'sec_len': mm per sec, 'max_tile_sec': max time range of
+            a tile (see `Tile`)
+        svg_filename: str
+            file to download (see `Download`)
+        msg: str
+        pages: list of str
+            URLs of pages
+        svg_name: str
+            file name of the download
+
+        Returns
+        -------
+        args: dict
+            template arguments
+        """
         size_limit, size_unit = self.get_size_unit(self._size_limit)
 
-        self.render(self.HTML_FILE,
-                    title=self.TITLE,
+        return dict(title=self.TITLE,
                     author=__author__,
                     version=self._version,
                     copyright_year='2021',
                     size_limit=size_limit,
                     size_unit=size_unit,
-                    svg_data=svg_data,
+                    models=self._model_registry.names(),
+                    model_name=self._model_name,
+                    viewer=viewer,
                     svg_filename=svg_filename,
+                    svg_name=svg_name,
+                    pages=pages,
                     msg=msg)
 
+    def want_profile(self) -> bool:
+        """ profile this conversion or not """
+        token = self.settings.get('profile_token')
+        if token and hmac.compare_digest(
+                self.request.headers.get(self.PROFILE_TOKEN_HEADER,
+                                         '').encode('utf-8'),
+                token.encode('utf-8')):
+            return True
+
+        sample = self.settings.get('profile_sample')
+        return bool(sample) and next(self._n_posts) % sample == 0
+
     async def post(self):
         """
         POST method
         """
-        file1 = self.request.files['file1'][0]
-        file1_fname = file1['filename']
-        file1_path = '%s/midi/%s' % (self._webroot, file1_fname)
-        svg1_fname = '%s.svg' % (file1_fname)
-        svg1_path = '%s/svg/%s' % (self._webroot, svg1_fname)
+        file1, file1_path = self.store_midi()
+        svg1_name = '%s.svg' % (os.path.basename(file1.filename))
+
+        f_size, unit = self.get_size_unit(file1.size)
+        msg = '%s (%.1f %s)' % (file1.filename, f_size, unit)
+
+        self._model_name = self.upload_field('model', self._model_name)
+        try:
+            model = self._model_registry.get(self._model_name)
+        except KeyError:
+            raise tornado.web.HTTPError(
+                400, reason='unknown model: %s' % (self._model_name))
+
+        try:
+            page_len = float(self.upload_field('page_len', '') or
+                             model.page_len)
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason='invalid page_len')
+
+        model, overrides = self.transpose_overrides(model)
+
+        midi_digest = file1.digest
+        channel = []
+        cache_key = RenderCache.key(midi_digest, model.name, channel,
+                                    model.fingerprint)
+        self._mylog.debug('cache_key=%s', cache_key)
+
+        try:
+            job = self._job_scheduler.submit(
+                self.client_id(), JobScheduler.PRIO_INTERACTIVE,
+                file1_path, model, channel, cache_key, self.want_profile(),
+                overrides)
+        except QueueFull as ex:
+            self._mylog.warning('%s: %s', type(ex).__name__, ex)
+            self.set_status(503)
+            self.set_header('Retry-After', str(self.RETRY_AFTER))
+            self.get(msg='Server busy: please retry later')
+            return
+
+        await job.wait()
+        if job.error:
+            raise tornado.web.HTTPError(422, '%s', job.error,
+                                        reason='conversion failed')
+        meta = job.meta
+        if (meta.get('transpose') or {}).get('shift'):
+            msg += ': transpose %+d, %d notes recovered' % (
+                meta['transpose']['shift'], meta['transpose']['recovered'])
+        if not os.path.exists(self._render_cache.path(cache_key)):
+            # evicted: very unlikely
+            raise tornado.web.HTTPError(503, 'evicted: %s', cache_key)
+        # downloaded from the cache by key (see `Download`)
+        svg1_fname = cache_key + RenderCache.SUFFIX
+
+        query = [('model', model.name)] + [
+            ('set', '%s=%s' % (k, json.dumps(v)))
+            for k, v in overrides.items()]
+
+        pages = []
+        if page_len > 0:
+            n_pages = max(-(-meta['width'] // page_len), 1)
+            pages = [
+                '%spage/%s.svg?%s' % (
+                    self._url_path, midi_digest,
+                    urlencode(query + [('page', i),
+                                       ('page_len', page_len)]))
+                for i in range(int(n_pages))]
+
+        # the roll is not inlined: the viewer loads tiles on scroll
+        viewer = {'tile_url': '%sapi/tile/%s.svg?%s' % (
+                      self._url_path, midi_digest, urlencode(query)),
+                  'width': meta['width'], 'height': model.book_height,
+                  'sec_len': model.sec_len,
+                  'max_tile_sec': Tile.MAX_TILE_SEC}
+
+        self.render(self.HTML_FILE,
+                    **self.template_args(viewer, svg1_fname, msg, pages,
+                                         svg1_name))
+
+
+class RenderHandler(tornado.web.RequestHandler):
+    """
+    base class of handlers rendering an uploaded MIDI file on demand
+
+    The MIDI file is given by its hash ({webroot}/midi/{hash}.mid).
+    Query arguments:
+        model: Model Name
+        set: 'KEY=VALUE', configuration entry replaced (repeatable)
+    Rendered SVG is stored in the render cache.
+    """
+    def __init__(self, app, req):
+        """ Constructor """
+        self._dbg = app.settings.get('debug')
+        self._mylog = get_logger(self.__class__.__name__, self._dbg)
+        self._mylog.debug('debug=%s', self._dbg)
+
+        self._webroot = app.settings.get('webroot')
+        self._note_dir = app.settings.get('note_dir')
+        self._render_pool = app.settings.get('render_pool')
+        self._render_cache = app.settings.get('render_cache')
+        self._model_registry = app.settings.get('model_registry')
+
+        super().__init__(app, req)
+
+    def midi_path(self, midi_digest) -> str:
+        """ path name of the uploaded MIDI file
+
+        Raises
+        ------
+        tornado.web.HTTPError
+            404: not found
+        """
+        midi_path = '%s/midi/%s.mid' % (self._webroot, midi_digest)
+        if not os.path.exists(midi_path):
+            raise tornado.web.HTTPError(404)
+        return midi_path
+
+    def model_args(self):
+        """ model and overrides by query arguments
+
+        Returns
+        -------
+        model: model.Model
+            overridden model
+        overrides: dict
+
+        Raises
+        ------
+        tornado.web.HTTPError
+            400: unknown model or invalid overrides
+        """
+        model_name = self.get_argument('model', RollBook.DEF_MODEL_NAME)
+        try:
+            overrides = parse_overrides(self.get_arguments('set'))
+            model = self._model_registry.get(model_name).replace(overrides)
+        except (KeyError, ValueError, TypeError) as ex:
+            raise tornado.web.HTTPError(
+                400, reason='%s: %s' % (type(ex).__name__, ex))
+        return model, overrides
+
+    async def render_cached(self, kind, cache_key, func, *args, **kwargs):
+        """ open cached SVG, or render it by `func` in RenderPool
+
+        Parameters
+        ----------
+        kind: str
+            'roll', 'page' or 'tile'
+            (see `metrics.observe_conversion()`)
+        cache_key: str
+        func: callable
+            worker function, called as
+            `func(*args, **kwargs, note_dir=.., debug=..)`
+
+        Returns
+        -------
+        svg_f: file object
+        meta: dict
+            result of `func` (None: cache hit)
+
+        Raises
+        ------
+        tornado.web.HTTPError
+            503: RenderPool is full, 404: IndexError (no such page)
+        """
+        self._mylog.debug('cache_key=%s', cache_key)
+
+        svg_f = self._render_cache.open(cache_key)
+        if svg_f is not None:
+            metrics.CACHE_HITS.inc()
+            return svg_f, None
+
+        metrics.CACHE_MISSES.inc()
+        try:
+            meta = await self._render_pool.run(
+                func, *args, **kwargs, note_dir=self._note_dir,
+                debug=self._dbg)
+        except QueueFull:
+            self.set_header('Retry-After', str(Handler1.RETRY_AFTER))
+            raise tornado.web.HTTPError(503)
+        except IndexError:
+            raise tornado.web.HTTPError(404)
+        except Exception:
+            metrics.observe_conversion(kind, error=True)
+            raise
+
+        metrics.observe_conversion(kind, meta.pop('stats', None))
+        self._render_cache.add(cache_key)
+        return self._render_cache.open(cache_key), meta
+
+    def channel_args(self) -> list:
+        """ MIDI channels by query arguments
+
+        Raises
+        ------
+        tornado.web.HTTPError
+            400: invalid channel
+        """
+        try:
+            return [int(ch) for ch in self.get_arguments('channel')]
+        except ValueError as ex:
+            raise tornado.web.HTTPError(
+                400, reason='%s: %s' % (type(ex).__name__, ex))
+
+    async def render_roll(self, midi_digest, midi_path, model, channel,
+                          overrides=None):
+        """ open cached SVG of the whole roll, or render it
+
+        Parameters
+        ----------
+        midi_digest: str
+        midi_path: str
+        model: model.Model
+            overridden model
+        channel: list of int
+        overrides: dict
+
+        Returns
+        -------
+        svg_f: file object
+        meta: dict
+            see `worker.render_svg()` ({}: unknown)
+        """
+        cache_key = RenderCache.key(midi_digest, model.name, channel,
+                                    model.fingerprint)
+
+        svg_f, meta = await self.render_cached(
+            'roll', cache_key, render_svg, midi_path,
+            self._render_cache.path(cache_key), model.name,
+            self._model_registry.conf_file, channel, overrides=overrides)
+
+        if meta is None:
+            meta = self._render_cache.get_meta(cache_key) or {}
+        else:
+            self._render_cache.put_meta(cache_key, meta)
+        return svg_f, meta
+
+
+class Page(RenderHandler):
+    """
+    SVG of a page of the roll (rendered on demand)
+
+    URL: {prefix}/page/{MIDI hash}.svg?model=..&page=..&page_len=..
+    """
+    async def get(self, midi_digest):
+        """
+        GET method
+
+        Parameters
+        ----------
+        midi_digest: str
+            hash of MIDI data
+        """
+        self._mylog.debug('request=%s', self.request)
+
+        midi_path = self.midi_path(midi_digest)
+        model, overrides = self.model_args()
+        try:
+            page = int(self.get_argument('page', '0'))
+            page_len = float(self.get_argument('page_len', '') or
+                             model.page_len)
+        except ValueError as ex:
+            raise tornado.web.HTTPError(
+                400, reason='%s: %s' % (type(ex).__name__, ex))
+        if page < 0 or page_len <= 0:
+            raise tornado.web.HTTPError(400, reason='invalid page')
+
+        channel = []
+        cache_key = RenderCache.key(
+            midi_digest, model.name, channel, model.fingerprint,
+            'page=%d,page_len=%r' % (page, page_len))
+
+        svg_f, _ = await self.render_cached(
+            'page', cache_key, render_page, midi_path,
+            self._render_cache.path(cache_key), model.name,
+            self._model_registry.conf_file, channel, page, page_len,
+            overrides=overrides)
+
+        self.set_header('Content-Type', 'image/svg+xml')
+        await write_file_obj(self, svg_f)
+        self.finish()
+
+
+class Render(RenderHandler):
+    """
+    SVG of the whole roll, for interactive tuning of the model geometry
+
+    URL: {prefix}/api/render/{MIDI hash}.svg?model=..&channel=..
+         &set=1sec=55&set=pitch=2.1 ..
+
+    The parsed notes are cached (see `notes.NoteCache`),
+    so that only the layout and SVG are computed for new overrides.
+    """
+    async def get(self, midi_digest):
+        """
+        GET method
+
+        Parameters
+        ----------
+        midi_digest: str
+            hash of MIDI data
+        """
+        self._mylog.debug('request=%s', self.request)
+
+        midi_path = self.midi_path(midi_digest)
+        model, overrides = self.model_args()
+        channel = self.channel_args()
+
+        svg_f, meta = await self.render_roll(midi_digest, midi_path, model,
+                                             channel, overrides)
+        for key in ('notes', 'holes', 'width'):
+            if key in meta:
+                self.set_header('X-Storgan-%s' % (key.capitalize()),
+                                str(meta[key]))
+
+        self.set_header('Content-Type', 'image/svg+xml')
+        await write_file_obj(self, svg_f)
+        self.finish()
+
+
+class Tile(RenderHandler):
+    """
+    SVG of a time range of the roll, a tile of the viewer
+    (rendered on demand)
+
+    URL: {prefix}/api/tile/{MIDI hash}.svg?model=..&t0=..&t1=..&lod=..
+        t0, t1: time range in sec
+        lod: level of detail, min gap of holes in mm
+             (0: every hole, see `rollbook.HoleTable.simplify()`)
+
+    Only the holes in the range are looked up (see `HoleIndex`),
+    so that the size of a tile does not depend on the length of
+    the tune.
+    """
+    MAX_TILE_SEC = 600
+
+    async def get(self, midi_digest):
+        """
+        GET method
+
+        Parameters
+        ----------
+        midi_digest: str
+            hash of MIDI data
+        """
+        self._mylog.debug('request=%s', self.request)
+
+        midi_path = self.midi_path(midi_digest)
+        model, overrides = self.model_args()
+        channel = self.channel_args()
+        try:
+            t0 = float(self.get_argument('t0', '0'))
+            t1 = float(self.get_argument('t1'))
+            lod = float(self.get_argument('lod', '0'))
+        except ValueError as ex:
+            raise tornado.web.HTTPError(
+                400, reason='%s: %s' % (type(ex).__name__, ex))
+        if not 0 <= t0 < t1 <= t0 + self.MAX_TILE_SEC or lod < 0:
+            raise tornado.web.HTTPError(400, reason='invalid range')
+
+        cache_key = RenderCache.key(
+            midi_digest, model.name, channel, model.fingerprint,
+            't0=%r,t1=%r,lod=%r' % (t0, t1, lod))
+
+        svg_f, _ = await self.render_cached(
+            'tile', cache_key, render_tile, midi_path,
+            self._render_cache.path(cache_key), model.name,
+            self._model_registry.conf_file, channel, t0, t1, lod,
+            overrides=overrides)
+
+        self.set_header('Content-Type', 'image/svg+xml')
+        await write_file_obj(self, svg_f)
+        self.finish()
+
+
+class BundleHandler(RenderHandler):
+    """
+    base class of handlers sending several rolls in a zip file
+    (see `bundle`)
+
+    The MIDI file is parsed once, and the rolls are rendered
+    concurrently in RenderPool. They are cached as well as
+    the rolls rendered one by one.
+
+    Query arguments:
+        summary: '1': send only the summary (JSON)
+    """
+    async def parse_once(self, func, *args):
+        """ call `func` (`bundle.cache_notes()` or
+        `bundle.cache_channels()`) in RenderPool
+
+        Raises
+        ------
+        tornado.web.HTTPError
+            503: RenderPool is full
+        """
+        try:
+            return await self._render_pool.run(
+                func, *args, note_dir=self._note_dir, debug=self._dbg)
+        except QueueFull:
+            self.set_header('Retry-After', str(Handler1.RETRY_AFTER))
+            raise tornado.web.HTTPError(503)
+
+    async def send_bundle(self, midi_digest, midi_path, rolls,
+                          summary_func, suffix, overrides=None):
+        """ render rolls, and send them in a zip file
+
+        Parameters
+        ----------
+        midi_digest: str
+        midi_path: str
+        rolls: list of (str, model.Model, list of int)
+            (file name in the bundle, model, channel)
+        summary_func: callable
+            `summary_func(results)` returns summary
+        suffix: str
+            suffix of the file name
+        overrides: dict
+            configuration entries replaced (see `model_args()`)
+        """
+        results = await asyncio.gather(
+            *[self.render_roll(midi_digest, midi_path, model, channel,
+                               overrides)
+              for _, model, channel in rolls], return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                for other in results:
+                    if not isinstance(other, BaseException):
+                        other[0].close()
+                raise result
+
+        summary = summary_func([meta for _, meta in results])
+        if self.get_argument('summary', '') == '1':
+            for svg_f, _ in results:
+                svg_f.close()
+            self.write(summary)
+            return
+
+        # zip in a thread: compression releases GIL
+        zip_f = tempfile.TemporaryFile(dir=self.settings.get('workdir'))
+        await tornado.ioloop.IOLoop.current().run_in_executor(
+            None, bundle.write_bundle, zip_f,
+            [(name, svg_f) for (name, _, _), (svg_f, _)
+             in zip(rolls, results)], summary)
+        zip_f.seek(0)
+
+        self.set_header('Content-Type', 'application/zip')
+        self.set_header('Content-Disposition',
+                        'attachment; filename="%s%s"' % (midi_digest,
+                                                         suffix))
+        await write_file_obj(self, zip_f)
+        self.finish()
+
+
+class Bundle(BundleHandler):
+    """
+    rolls of all models in a zip file
+
+    URL: {prefix}/api/bundle/{MIDI hash}.zip?model=..&model=..&channel=..
+        model: Model Names (default: all models)
+    """
+    async def get(self, midi_digest):
+        """
+        GET method
 
-        if not os.path.exists(file1_path):
-            with open(file1_path, mode='wb') as f:
-                f.write(file1['body'])
+        Parameters
+        ----------
+        midi_digest: str
+            hash of MIDI data
+        """
+        self._mylog.debug('request=%s', self.request)
 
-        f_size, unit = self.get_filesize(file1_path)
-        msg = '%s (%.1f %s)' % (file1['filename'], f_size, unit)
+        midi_path = self.midi_path(midi_digest)
+        model_names = self.get_arguments('model') or \
+            self._model_registry.names()
+        try:
+            models = [self._model_registry.get(name)
+                      for name in dict.fromkeys(model_names)]
+        except KeyError as ex:
+            raise tornado.web.HTTPError(
+                400, reason='%s: %s' % (type(ex).__name__, ex))
+        channel = self.channel_args()
+
+        n_notes = await self.parse_once(bundle.cache_notes, midi_path,
+                                        channel)
+
+        names = [model.name for model in models]
+        await self.send_bundle(
+            midi_digest, midi_path,
+            [(bundle.svg_name(model.name), model, channel)
+             for model in models],
+            lambda results: bundle.summary(
+                '%s.mid' % (midi_digest), channel, n_notes, names,
+                results),
+            bundle.SUFFIX)
+
+
+class Channels(BundleHandler):
+    """
+    the combined roll and the roll of each MIDI channel in a zip file,
+    with statistics per channel (e.g. playable ratio, polyphony)
 
-        svg_data = self._rollbook.parse(file1_path)
-        self._mylog.debug('svg_data=%a', svg_data)
+    URL: {prefix}/api/channels/{MIDI hash}.zip?model=..&set=..
+    """
+    async def get(self, midi_digest):
+        """
+        GET method
 
-        with open(svg1_path, mode='w') as f:
-            f.write(svg_data)
+        Parameters
+        ----------
+        midi_digest: str
+            hash of MIDI data
+        """
+        self._mylog.debug('request=%s', self.request)
 
-        self.get(svg_data=svg_data, svg_filename=svg1_fname, msg=msg)
+        midi_path = self.midi_path(midi_digest)
+        model, overrides = self.model_args()
+
+        channels = await self.parse_once(bundle.cache_channels, midi_path)
+
+        await self.send_bundle(
+            midi_digest, midi_path,
+            [(bundle.channel_svg_name(ch['channel']), model, ch['channel'])
+             for ch in channels],
+            lambda results: bundle.channel_summary(
+                '%s.mid' % (midi_digest), model.name, channels, results),
+            bundle.CHANNELS_SUFFIX, overrides)
+
+
+class Metrics(tornado.web.RequestHandler):
+    """
+    metrics in Prometheus text format
+
+    With several server processes (`metrics_dir` is set),
+    the samples of all processes are summed up.
+    """
+    STALE_SEC = 60  # sec: snapshots of dead processes
+
+    def get(self):
+        """
+        GET method
+        """
+        metrics_dir = self.settings.get('metrics_dir')
+        snapshots = None
+        if metrics_dir:
+            metrics.REGISTRY.dump(metrics.dump_path(metrics_dir))
+            snapshots = metrics.REGISTRY.collect(metrics_dir,
+                                                 self.STALE_SEC)
+
+        self.set_header('Content-Type', metrics.Registry.CONTENT_TYPE)
+        self.write(metrics.REGISTRY.render(snapshots))
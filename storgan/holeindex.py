@@ -0,0 +1,98 @@
+#
+# (c) 2021 Yoichi Tanibayashi
+#
+"""
+sorted interval index over holes
+
+Holes are sorted by x (start), and grouped into blocks of `BLOCK`.
+A binary tree over the blocks keeps the maximum of x + w (end),
+so that only the blocks with holes ending in the range are scanned,
+even if a long hole (e.g. a drone) starts before them.
+The holes starting after the range are cut by a binary search.
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__ = '2021/01'
+
+from bisect import bisect_left
+from array import array
+
+
+class HoleIndex:
+    """ interval index over HoleTable
+
+    Attributes
+    ----------
+    order: array of int
+        row indexes of HoleTable, sorted by x
+    start, end: array of float
+        x and x + w, sorted by x
+    """
+    BLOCK = 32  # holes
+    def __init__(self, holes):
+        """ Constructor
+
+        Parameters
+        ----------
+        holes: rollbook.HoleTable
+        """
+        x, w = holes.x, holes.w
+
+        self.order = array('l', sorted(range(len(x)), key=x.__getitem__))
+        self.start = array('d', [x[i] for i in self.order])
+        self.end = array('d', [x[i] + w[i] for i in self.order])
+
+        # max end of blocks: leaves from `self._size`, root at 1
+        n_blocks = -(-len(self.order) // self.BLOCK)
+        self._size = 1
+        while self._size < n_blocks:
+            self._size *= 2
+        self._max_end = array('d', [float('-inf')]) * (2 * self._size)
+        for b in range(n_blocks):
+            self._max_end[self._size + b] = max(
+                self.end[b * self.BLOCK:(b + 1) * self.BLOCK])
+        for i in range(self._size - 1, 0, -1):
+            self._max_end[i] = max(self._max_end[2 * i],
+                                   self._max_end[2 * i + 1])
+
+    def __len__(self):
+        return len(self.order)
+
+    def query(self, x0, x1):
+        """ holes overlapping [x0, x1)
+
+        Parameters
+        ----------
+        x0, x1: float
+            range in mm
+
+        Returns
+        -------
+        rows: list of int
+            row indexes of HoleTable, sorted by x
+            (x < x1, and x + w > x0 or x >= x0 for zero width holes)
+        """
+        hi = bisect_left(self.start, x1)
+        if hi == 0:
+            return []
+        last_block = (hi - 1) // self.BLOCK
+
+        start, end, order = self.start, self.end, self.order
+        max_end, size = self._max_end, self._size
+        rows = []
+        # depth first, left first: (node, first block, number of blocks)
+        stack = [(1, 0, size)]
+        while stack:
+            node, first, n_blocks = stack.pop()
+            # holes ending before x0 start before it, too
+            if first > last_block or max_end[node] < x0:
+                continue
+            if node < size:
+                n_blocks //= 2
+                stack.append((2 * node + 1, first + n_blocks, n_blocks))
+                stack.append((2 * node, first, n_blocks))
+                continue
+
+            k_end = min((first + 1) * self.BLOCK, hi)
+            rows.extend([order[k] for k in range(first * self.BLOCK, k_end)
+                         if end[k] > x0 or start[k] >= x0])
+        return rows
@@ -0,0 +1,168 @@
+#
+# (c) 2021 Yoichi Tanibayashi
+#
+"""
+JSON API of conversion jobs
+
+    POST {prefix}/api/jobs?model=..&channel=..&priority=..&transpose=..
+        MIDI file: raw body, or multipart/form-data (field 'file1')
+        (model, channel, priority and transpose: query arguments or
+        form fields, channel: repeated, or comma separated in a form
+        field, transpose: 'auto' (default, as the upload page)
+        or semitones)
+        -> 202 {job status}
+    GET  {prefix}/api/jobs/{id}
+        -> 200 {job status}
+    GET  {prefix}/api/jobs/{id}/result
+        -> 200 SVG (done), 202 {job status} (not yet), 422 (error)
+
+The client is identified by the 'X-Client-Id' header
+(default: remote address).
+Jobs submitted to another server process are found by their
+status files (see `jobs.JobScheduler`).
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__ = '2021/01'
+
+import tornado.web
+from .rollbook import RollBook
+from .cache import RenderCache
+from .jobs import Job, JobScheduler
+from .worker import QueueFull
+from .handler1 import UploadHandler, Handler1, write_file_obj
+from .my_logger import get_logger
+
+
+def job_status(handler, job_id) -> dict:
+    """ job status with URLs and queue position
+
+    Parameters
+    ----------
+    handler: tornado.web.RequestHandler
+    job_id: str
+
+    Raises
+    ------
+    tornado.web.HTTPError
+        404: unknown job
+    """
+    try:
+        status = handler.settings.get('job_scheduler').status(job_id)
+    except KeyError:
+        raise tornado.web.HTTPError(404) from None
+
+    url_prefix = '%s/api/jobs/%s' % (
+        handler.settings.get('url_prefix_handler1'), job_id)
+    status['status_url'] = url_prefix
+    status['result_url'] = url_prefix + '/result'
+    return status
+
+
+class JobSubmit(UploadHandler):
+    """
+    submit a conversion job
+    """
+    def __init__(self, app, req):
+        """ Constructor """
+        self._dbg = app.settings.get('debug')
+        self._mylog = get_logger(self.__class__.__name__, self._dbg)
+        self._mylog.debug('debug=%s', self._dbg)
+
+        self._job_scheduler = app.settings.get('job_scheduler')
+        self._model_registry = app.settings.get('model_registry')
+
+        super().__init__(app, req)
+
+    def post(self):
+        """
+        POST method
+        """
+        upload_file, midi_path = self.store_midi()
+        self._mylog.debug('upload_file=%s', upload_file)
+
+        model_name = self.upload_field('model', RollBook.DEF_MODEL_NAME)
+        try:
+            model = self._model_registry.get(model_name)
+        except KeyError:
+            raise tornado.web.HTTPError(
+                400, reason='unknown model: %s' % (model_name))
+
+        model, overrides = self.transpose_overrides(model)
+
+        try:
+            channel = [int(ch) for ch in self.upload_fields('channel')]
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason='invalid channel')
+
+        try:
+            # batch jobs never outrank interactive conversions
+            priority = max(int(self.upload_field(
+                'priority', str(JobScheduler.PRIO_BATCH))),
+                           JobScheduler.PRIO_INTERACTIVE + 1)
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason='invalid priority')
+
+        cache_key = RenderCache.key(upload_file.digest, model.name,
+                                    channel, model.fingerprint)
+        try:
+            job = self._job_scheduler.submit(
+                self.client_id(), priority, midi_path, model, channel,
+                cache_key, overrides=overrides)
+        except QueueFull:
+            self.set_header('Retry-After', str(Handler1.RETRY_AFTER))
+            raise tornado.web.HTTPError(503)
+
+        self.set_status(202)
+        self.write(job_status(self, job.id))
+
+
+class JobStatus(tornado.web.RequestHandler):
+    """
+    status of a job
+    """
+    def get(self, job_id):
+        """
+        GET method
+
+        Parameters
+        ----------
+        job_id: str
+        """
+        self.write(job_status(self, job_id))
+
+
+class JobResult(tornado.web.RequestHandler):
+    """
+    result (SVG) of a job
+    """
+    RETRY_AFTER = 1  # sec
+
+    async def get(self, job_id):
+        """
+        GET method
+
+        Parameters
+        ----------
+        job_id: str
+        """
+        status = job_status(self, job_id)
+
+        if status['state'] not in (Job.DONE, Job.ERROR):
+            self.set_status(202)
+            self.set_header('Retry-After', str(self.RETRY_AFTER))
+            self.write(status)
+            return
+
+        if status['error']:
+            self.set_status(422)
+            self.write(status)
+            return
+
+        svg_f = self.settings.get('render_cache').open(status['cache_key'])
+        if svg_f is None:
+            # evicted from the render cache
+            raise tornado.web.HTTPError(410)
+
+        self.set_header('Content-Type', 'image/svg+xml')
+        await write_file_obj(self, svg_f)
+        self.finish()
@@ -0,0 +1,442 @@
+#
+# (c) 2021 Yoichi Tanibayashi
+#
+"""
+Conversion job scheduler
+
+Jobs are queued in a priority heap (smaller number: higher priority),
+and at most `RenderPool.workers` jobs run at the same time.
+Each client can run at most `max_per_client` jobs at the same time,
+so that a batch client cannot occupy all workers.
+Each client can queue at most `max_queued_per_client` jobs,
+and the last `INTERACTIVE_RESERVE` of the queue is only for
+interactive jobs, so that batch clients flooding the queue
+never make interactive conversions fail with QueueFull.
+
+With `job_dir`, the status of each job is also written to
+`job_dir/{id}.json`, so that any server process sharing the directory
+can answer status queries of the job.
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__ = '2021/01'
+
+import os
+import json
+import time
+import heapq
+import uuid
+import asyncio
+import itertools
+from .worker import QueueFull, render_svg
+from .fileutil import atomic_write
+from . import metrics
+from .my_logger import get_logger
+
+
+class Job:
+    """ conversion job
+
+    Attributes
+    ----------
+    id: str
+        job id
+    client: str
+        client id
+    priority: int
+        smaller number: higher priority
+    midi_path: str
+        MIDI file
+    model: model.Model
+    channel: list of int
+    cache_key: str
+        render cache key of the result
+    profile: bool
+        run under cProfile (see `worker.render_svg()`)
+    overrides: dict
+        configuration entries replaced (see `model.Model.replace()`)
+    state: str
+        'queued', 'running', 'done' or 'error'
+    submitted, started, finished: float
+        time (time.time())
+    meta: dict
+        result of `worker.render_svg()`
+    error: str
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    ERROR = 'error'
+
+    def __init__(self, client, priority, midi_path, model, channel,
+                 cache_key, profile=False, overrides=None):
+        """ Constructor """
+        self.id = uuid.uuid4().hex
+        self.client = client
+        self.priority = priority
+        self.midi_path = midi_path
+        self.model = model
+        self.channel = list(channel)
+        self.cache_key = cache_key
+        self.profile = profile
+        self.overrides = overrides or {}
+
+        self.state = self.QUEUED
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.meta = None
+        self.error = None
+
+        self._event = asyncio.Event()
+
+    @property
+    def is_finished(self) -> bool:
+        """ done or error """
+        return self.state in (self.DONE, self.ERROR)
+
+    def finish(self, meta=None, error=None):
+        """ set result """
+        self.meta = meta
+        self.error = error
+        self.state = self.ERROR if error else self.DONE
+        self.finished = time.time()
+        self._event.set()
+
+    async def wait(self):
+        """ wait for the job to finish """
+        await self._event.wait()
+
+    def status(self) -> dict:
+        """ status (JSON serializable) """
+        now = time.time()
+        started = self.started or now
+        return {
+            'id': self.id,
+            'state': self.state,
+            'model': self.model.name,
+            'priority': self.priority,
+            'submitted': self.submitted,
+            'started': self.started,
+            'finished': self.finished,
+            'queue_sec': started - self.submitted,
+            'run_sec': ((self.finished or now) - self.started
+                        if self.started else None),
+            'meta': self.meta,
+            'error': self.error,
+            'cache_key': self.cache_key,
+        }
+
+    def __repr__(self):
+        return '<%s %s %s %s>' % (self.__class__.__name__, self.id,
+                                  self.client, self.state)
+
+
+class JobScheduler:
+    """ bounded priority scheduler over RenderPool
+
+    Attributes
+    ----------
+    max_per_client: int
+        max number of running jobs per client
+    max_queued: int
+        max number of queued jobs
+    max_queued_per_client: int
+        max number of queued jobs per client
+    """
+    DEF_MAX_PER_CLIENT = 2
+    DEF_MAX_QUEUED = 1000
+    DEF_MAX_QUEUED_PER_CLIENT = 100
+    INTERACTIVE_RESERVE = 0.1  # ratio of max_queued
+    JOB_TTL = 3600  # sec: finished jobs are kept for this time
+    RETRY_SEC = 0.5  # sec: retry after RenderPool is full
+    PURGE_SEC = 60  # sec: interval of purging status files
+
+    PRIO_INTERACTIVE = 0
+    PRIO_BATCH = 10
+
+    def __init__(self, pool, cache, conf_file,
+                 max_per_client=DEF_MAX_PER_CLIENT,
+                 max_queued=DEF_MAX_QUEUED, job_dir=None,
+                 note_dir=None, profile_dir=None,
+                 max_queued_per_client=DEF_MAX_QUEUED_PER_CLIENT,
+                 debug=False):
+        """ Constructor
+
+        Parameters
+        ----------
+        pool: worker.RenderPool
+        cache: cache.RenderCache
+        conf_file: str
+            configuration file
+        max_per_client: int
+            max number of running jobs per client
+        max_queued: int
+            max number of queued jobs
+        job_dir: str
+            directory for status files (None: no status files)
+        note_dir: str
+            directory of the note cache (see `notes.NoteCache`)
+        profile_dir: str
+            directory for profiles of jobs with `profile`
+        max_queued_per_client: int
+            max number of queued jobs per client
+        """
+        self._dbg = debug
+        self._log = get_logger(self.__class__.__name__, self._dbg)
+        self._log.debug('max_per_client=%s, max_queued=%s, job_dir=%s',
+                        max_per_client, max_queued, job_dir)
+
+        self._pool = pool
+        self._cache = cache
+        self._conf_file = conf_file
+        self.max_per_client = max(max_per_client, 1)
+        self.max_queued = max(max_queued, 1)
+        self.max_queued_per_client = max(max_queued_per_client, 1)
+        self._job_dir = job_dir
+        self._note_dir = note_dir
+        self._profile_dir = profile_dir
+        if self._job_dir is not None:
+            os.makedirs(self._job_dir, exist_ok=True)
+
+        self._heap = []  # (priority, seq, job)
+        self._seq = itertools.count()
+        self._jobs = {}  # id -> job
+        self._running = {}  # client -> number of running jobs
+        self._queued = {}  # client -> number of queued jobs
+        self._n_running = 0
+        self._retry = None
+        self._purged = time.time()
+
+    @property
+    def n_queued(self) -> int:
+        """ number of queued jobs """
+        return len(self._heap)
+
+    @property
+    def n_running(self) -> int:
+        """ number of running jobs """
+        return self._n_running
+
+    def get(self, job_id) -> Job:
+        """ get job
+
+        Raises
+        ------
+        KeyError
+        """
+        return self._jobs[job_id]
+
+    def status(self, job_id) -> dict:
+        """ status of a job of this process or, if any, another process
+
+        Returns
+        -------
+        status: dict
+            `Job.status()` with 'position' (None: unknown)
+
+        Raises
+        ------
+        KeyError
+        """
+        job = self._jobs.get(job_id)
+        if job is not None:
+            status = job.status()
+            status['position'] = self.position(job)
+            return status
+
+        if self._job_dir is None:
+            raise KeyError(job_id)
+
+        try:
+            with open(self._job_path(job_id)) as f:
+                status = json.load(f)
+        except (FileNotFoundError, ValueError):
+            raise KeyError(job_id) from None
+
+        status['position'] = None
+        return status
+
+    def _job_path(self, job_id) -> str:
+        """ path name of the status file """
+        return os.path.join(self._job_dir, job_id + '.json')
+
+    def _save(self, job):
+        """ write the status file """
+        if self._job_dir is None:
+            return
+
+        atomic_write(self._job_path(job.id), json.dumps(job.status()))
+
+    def submit(self, client, priority, midi_path, model, channel,
+               cache_key, profile=False, overrides=None) -> Job:
+        """ submit a job
+
+        If the result is in the render cache, the job is done at once.
+
+        Parameters
+        ----------
+        client: str
+            client id
+        priority: int
+            smaller number: higher priority
+        midi_path: str
+        model: model.Model
+            overridden by `overrides`
+        channel: list of int
+        cache_key: str
+        profile: bool
+            run under cProfile (not for cached results)
+        overrides: dict
+            configuration entries replaced (see `model.Model.replace()`)
+
+        Raises
+        ------
+        QueueFull
+            the queue is full (for the priority), or
+            the client has `max_queued_per_client` queued jobs
+        """
+        self._purge()
+        max_queued = self.max_queued
+        if priority > self.PRIO_INTERACTIVE:
+            max_queued -= int(self.max_queued * self.INTERACTIVE_RESERVE)
+        if len(self._heap) >= max_queued:
+            raise QueueFull('queued=%s' % (len(self._heap)))
+        if self._queued.get(client, 0) >= self.max_queued_per_client:
+            raise QueueFull('client=%s, queued=%s' % (
+                client, self._queued[client]))
+
+        job = Job(client, priority, midi_path, model, channel, cache_key,
+                  profile, overrides)
+        self._jobs[job.id] = job
+        self._log.debug('job=%s', job)
+
+        meta = self._cache.get_meta(cache_key)
+        if meta is not None and \
+           os.path.exists(self._cache.path(cache_key)):
+            metrics.CACHE_HITS.inc()
+            job.started = job.submitted
+            job.finish(meta)
+            self._save(job)
+            return job
+
+        metrics.CACHE_MISSES.inc()
+
+        self._push(job)
+        self._save(job)
+        self._dispatch()
+        return job
+
+    def _push(self, job):
+        """ queue a job """
+        heapq.heappush(self._heap, (job.priority, next(self._seq), job))
+        self._queued[job.client] = self._queued.get(job.client, 0) + 1
+
+    def position(self, job) -> int:
+        """ number of queued jobs before `job` (None: not queued) """
+        if job.state != Job.QUEUED:
+            return None
+
+        for pos, (_, _, queued) in enumerate(sorted(self._heap)):
+            if queued is job:
+                return pos
+        return None
+
+    def _purge(self):
+        """ forget old finished jobs """
+        now = time.time()
+        expire = now - self.JOB_TTL
+        for job_id in [job_id for job_id, job in self._jobs.items()
+                       if job.is_finished and job.finished < expire]:
+            del self._jobs[job_id]
+
+        if self._job_dir is None or now - self._purged < self.PURGE_SEC:
+            return
+
+        self._purged = now
+        for ent in os.scandir(self._job_dir):
+            try:
+                if ent.name.endswith('.json') and \
+                   ent.stat().st_mtime < expire:
+                    os.remove(ent.path)
+            except FileNotFoundError:
+                # removed by another process
+                pass
+
+    def _dispatch(self):
+        """ start queued jobs, as many as possible """
+        skipped = []
+        while self._heap and self._n_running < self._pool.workers:
+            entry = heapq.heappop(self._heap)
+            job = entry[2]
+            if self._running.get(job.client, 0) >= self.max_per_client:
+                skipped.append(entry)
+                continue
+
+            self._queued[job.client] -= 1
+            if not self._queued[job.client]:
+                del self._queued[job.client]
+            self._n_running += 1
+            self._running[job.client] = \
+                self._running.get(job.client, 0) + 1
+            job.state = Job.RUNNING
+            job.started = time.time()
+            self._save(job)
+            asyncio.ensure_future(self._run(job))
+
+        for entry in skipped:
+            heapq.heappush(self._heap, entry)
+
+    async def _run(self, job):
+        """ run a job """
+        retry = False
+        try:
+            meta = await self._pool.run(
+                render_svg, job.midi_path, self._cache.path(job.cache_key),
+                job.model.name, self._conf_file, job.channel,
+                note_dir=self._note_dir, overrides=job.overrides,
+                profile_dir=self._profile_dir if job.profile else None,
+                debug=self._dbg)
+        except QueueFull:
+            # RenderPool is shared with other handlers: retry later
+            retry = True
+            job.state = Job.QUEUED
+            job.started = None
+            self._push(job)
+        except Exception as ex:  # pylint: disable=broad-except
+            self._log.warning('%s: %s: %s', job, type(ex).__name__, ex)
+            job.finish(error='%s: %s' % (type(ex).__name__, ex))
+            metrics.observe_conversion('roll', error=True)
+        else:
+            metrics.observe_conversion('roll', meta.pop('stats', None))
+            profile = meta.pop('profile', None)
+            self._cache.add(job.cache_key)
+            self._cache.put_meta(job.cache_key, meta)
+            if profile:
+                # not cached: only for this job
+                self._log.info('%s: profile=%s', job, profile)
+                meta['profile'] = profile
+            job.finish(meta)
+            self._log.debug('job=%s, meta=%s', job, meta)
+        finally:
+            self._n_running -= 1
+            self._running[job.client] -= 1
+            if not self._running[job.client]:
+                del self._running[job.client]
+            self._save(job)
+
+        if retry:
+            self._schedule_retry()
+        else:
+            self._dispatch()
+
+    def _schedule_retry(self):
+        """ call `_dispatch()` later """
+        if self._retry is not None:
+            return
+
+        def retry():
+            self._retry = None
+            self._dispatch()
+
+        self._retry = asyncio.get_event_loop().call_later(
+            self.RETRY_SEC, retry)
@@ -0,0 +1,390 @@
+#
+# (c) 2021 Yoichi Tanibayashi
+#
+"""
+Metrics: per-stage timings of a conversion and
+counters / gauges / histograms in Prometheus text format
+
+`StageStats` is filled by `RollBook` (parse, layout, svg, write),
+and reported by the CLI (`--stats`) or observed into `STAGE_SECONDS`
+by the web server.
+
+With several server processes, each process dumps its samples to
+a directory (`Registry.dump()`), and the samples of all processes
+are summed up (`Registry.collect()`).
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__ = '2021/01'
+
+import os
+import json
+import time
+import contextlib
+from .fileutil import atomic_write
+
+
+class StageStats:
+    """ elapsed time per stage and counts of a conversion
+
+    Attributes
+    ----------
+    sec: dict
+        stage -> elapsed time in sec
+    counts: dict
+        name -> count (e.g. 'notes', 'svg_bytes')
+    """
+    STAGES = ('upload', 'parse', 'layout', 'svg', 'write')
+
+    def __init__(self, stats=None):
+        """ Constructor
+
+        Parameters
+        ----------
+        stats: dict
+            initial values (see `as_dict()`)
+        """
+        self.sec = {}
+        self.counts = {}
+        if stats:
+            self.update(stats)
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """ measure elapsed time of a stage """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def add(self, stage, sec):
+        """ add elapsed time of a stage """
+        self.sec[stage] = self.sec.get(stage, 0) + sec
+
+    def count(self, name, n=1):
+        """ add count """
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def update(self, stats):
+        """ add stats of another conversion
+
+        Parameters
+        ----------
+        stats: dict
+            see `as_dict()`
+        """
+        for stage, sec in stats.get('sec', {}).items():
+            self.add(stage, sec)
+        for name, n in stats.get('counts', {}).items():
+            self.count(name, n)
+
+    def as_dict(self) -> dict:
+        """ stats (JSON serializable, picklable) """
+        return {'sec': dict(self.sec), 'counts': dict(self.counts)}
+
+    def format(self) -> str:
+        """ one line summary """
+        stages = sorted(self.sec, key=lambda s: (
+            self.STAGES.index(s) if s in self.STAGES else len(self.STAGES),
+            s))
+        items = ['%s %.4f sec' % (s, self.sec[s]) for s in stages]
+        items += ['%s %d' % (name, n) for name, n in self.counts.items()]
+        return ', '.join(items)
+
+
+def _escape(value) -> str:
+    """ escape label value """
+    return str(value).replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n')
+
+
+def _sample_name(name, label_names, label_values, extra='') -> str:
+    """ sample name with labels: name{k="v",..} """
+    labels = ['%s="%s"' % (k, _escape(v))
+              for k, v in zip(label_names, label_values)]
+    if extra:
+        labels.append(extra)
+    if not labels:
+        return name
+    return '%s{%s}' % (name, ','.join(labels))
+
+
+def _format_value(value) -> str:
+    """ format sample value """
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+
+class Metric:
+    """ base class of metrics
+
+    Attributes
+    ----------
+    name: str
+    help: str
+    labels: tuple of str
+        label names
+    """
+    TYPE = 'untyped'
+
+    def __init__(self, name, help_text, labels=(), func=None):
+        """ Constructor
+
+        Parameters
+        ----------
+        name: str
+        help_text: str
+        labels: tuple of str
+            label names
+        func: callable
+            returns the value at collection (no labels only)
+        """
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._func = func
+        self._values = {}  # label values -> value
+
+    def _key(self, labels) -> tuple:
+        """ label values in the order of `self.labels` """
+        return tuple(labels[k] for k in self.labels)
+
+    def samples(self):
+        """ (sample name, value) """
+        if self._func is not None:
+            return [(self.name, self._func())]
+
+        return [(_sample_name(self.name, self.labels, key), value)
+                for key, value in self._values.items()]
+
+
+class Counter(Metric):
+    """ counter """
+    TYPE = 'counter'
+
+    def inc(self, n=1, **labels):
+        """ increment """
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + n
+
+
+class Gauge(Metric):
+    """ gauge """
+    TYPE = 'gauge'
+
+    def set(self, value, **labels):
+        """ set value """
+        self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    """ histogram
+
+    Attributes
+    ----------
+    buckets: tuple of float
+        upper bounds
+    """
+    TYPE = 'histogram'
+    DEF_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)
+
+    def __init__(self, name, help_text, labels=(), buckets=DEF_BUCKETS):
+        """ Constructor
+
+        Parameters
+        ----------
+        name: str
+        help_text: str
+        labels: tuple of str
+        buckets: tuple of float
+            upper bounds (+Inf is added)
+        """
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        """ observe a value """
+        key = self._key(labels)
+        hist = self._values.get(key)
+        if hist is None:
+            # [counts per bucket .., sum]
+            hist = self._values[key] = [0] * len(self.buckets) + [0.0]
+
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                hist[i] += 1
+                break
+        hist[-1] += value
+
+    def samples(self):
+        """ (sample name, value): cumulative buckets, sum and count """
+        samples = []
+        for key, hist in self._values.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets, hist):
+                cumulative += n
+                samples.append((_sample_name(
+                    self.name + '_bucket', self.labels, key,
+                    'le="%s"' % (_format_value(float(bound)))),
+                                cumulative))
+            samples.append((_sample_name(
+                self.name + '_sum', self.labels, key), hist[-1]))
+            samples.append((_sample_name(
+                self.name + '_count', self.labels, key), cumulative))
+        return samples
+
+
+class Registry:
+    """ set of metrics """
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+    DUMP_SUFFIX = '.json'
+
+    def __init__(self):
+        """ Constructor """
+        self._metrics = {}  # name -> Metric
+
+    def register(self, metric):
+        """ register (or replace) a metric
+
+        Returns
+        -------
+        metric: Metric
+        """
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text, labels=(), func=None) -> Counter:
+        """ register a counter """
+        return self.register(Counter(name, help_text, labels, func))
+
+    def gauge(self, name, help_text, labels=(), func=None) -> Gauge:
+        """ register a gauge """
+        return self.register(Gauge(name, help_text, labels, func))
+
+    def histogram(self, name, help_text, labels=(),
+                  buckets=Histogram.DEF_BUCKETS) -> Histogram:
+        """ register a histogram """
+        return self.register(Histogram(name, help_text, labels, buckets))
+
+    def snapshot(self) -> dict:
+        """ samples of all metrics
+
+        Returns
+        -------
+        snapshot: dict
+            metric name -> list of [sample name, value]
+        """
+        return {name: [list(s) for s in metric.samples()]
+                for name, metric in self._metrics.items()}
+
+    def dump(self, path):
+        """ write snapshot to file (atomically) """
+        atomic_write(path, json.dumps(self.snapshot()))
+
+    def collect(self, dir_name, stale_sec) -> list:
+        """ read snapshots dumped by all processes
+
+        Snapshots older than `stale_sec` (dead processes) are removed.
+
+        Returns
+        -------
+        snapshots: list of dict
+        """
+        expire = time.time() - stale_sec
+        snapshots = []
+        for ent in os.scandir(dir_name):
+            if not ent.name.endswith(self.DUMP_SUFFIX):
+                continue
+            try:
+                if ent.stat().st_mtime < expire:
+                    os.remove(ent.path)
+                    continue
+                with open(ent.path) as f:
+                    snapshots.append(json.load(f))
+            except (FileNotFoundError, ValueError):
+                # removed or being replaced by another process
+                pass
+        return snapshots
+
+    def render(self, snapshots=None) -> str:
+        """ Prometheus text format
+
+        Parameters
+        ----------
+        snapshots: list of dict
+            samples of processes to be summed up
+            (None: this process only)
+        """
+        if snapshots is None:
+            snapshots = [self.snapshot()]
+
+        lines = []
+        for name, metric in self._metrics.items():
+            values = {}
+            for snapshot in snapshots:
+                for sample, value in snapshot.get(name, []):
+                    values[sample] = values.get(sample, 0) + value
+
+            lines.append('# HELP %s %s' % (name, metric.help))
+            lines.append('# TYPE %s %s' % (name, metric.TYPE))
+            lines += ['%s %s' % (sample, _format_value(value))
+                      for sample, value in values.items()]
+
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    'storgan_stage_seconds', 'elapsed time of conversion stages',
+    ('stage',))
+CONVERSIONS = REGISTRY.counter(
+    'storgan_conversions_total', 'number of conversions',
+    ('kind', 'result'))
+CACHE_HITS = REGISTRY.counter(
+    'storgan_cache_hits_total', 'number of render cache hits')
+CACHE_MISSES = REGISTRY.counter(
+    'storgan_cache_misses_total', 'number of render cache misses')
+NOTES = REGISTRY.counter(
+    'storgan_notes_total', 'number of converted notes')
+OUTPUT_BYTES = REGISTRY.counter(
+    'storgan_output_bytes_total', 'bytes of rendered SVG')
+UPLOAD_BYTES = REGISTRY.counter(
+    'storgan_upload_bytes_total', 'bytes of uploaded MIDI files')
+REQUESTS = REGISTRY.counter(
+    'storgan_requests_total', 'number of HTTP requests',
+    ('handler', 'method', 'code'))
+REQUEST_SECONDS = REGISTRY.histogram(
+    'storgan_request_seconds', 'elapsed time of HTTP requests',
+    ('handler',))
+
+
+def dump_path(dir_name) -> str:
+    """ dump file of this process (see `Registry.dump()`) """
+    return os.path.join(dir_name, '%d%s' % (os.getpid(),
+                                             Registry.DUMP_SUFFIX))
+
+
+def observe_conversion(kind, stats=None, error=False):
+    """ observe the result of a conversion
+
+    Parameters
+    ----------
+    kind: str
+        'roll', 'page' or 'tile'
+    stats: dict
+        `StageStats.as_dict()`
+    error: bool
+    """
+    CONVERSIONS.inc(kind=kind, result='error' if error else 'ok')
+    if not stats:
+        return
+
+    for stage, sec in stats.get('sec', {}).items():
+        STAGE_SECONDS.observe(sec, stage=stage)
+    counts = stats.get('counts', {})
+    NOTES.inc(counts.get('notes', 0))
+    OUTPUT_BYTES.inc(counts.get('svg_bytes', 0))
@@ -0,0 +1,377 @@
+#
+# (c) 2021 Yoichi Tanibayashi
+#
+"""
+Organ models and process-wide model registry
+
+The configuration file (a JSON array of model entries) is loaded once,
+and reloaded only when its mtime changes.
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__ = '2021/01'
+
+import os
+import time
+import json
+import hashlib
+import threading
+from array import array
+from types import MappingProxyType
+from .my_logger import get_logger
+
+
+MIDI_NOTES = 128
+MIDI_CHANNELS = 16
+
+
+def _thaw(obj):
+    """ convert immutable object to JSON object """
+    if isinstance(obj, MappingProxyType):
+        return {k: _thaw(v) for k, v in obj.items()}
+    if isinstance(obj, tuple):
+        return [_thaw(v) for v in obj]
+    return obj
+
+
+# entries of more than one JSON type, checked by `Model` itself
+# (e.g. "transpose": "auto" or int)
+MIXED_TYPE_KEYS = ('transpose',)
+
+
+def _json_type(value) -> type:
+    """ JSON type of a value (int and float are the same) """
+    if isinstance(value, bool):
+        return bool
+    if isinstance(value, (int, float)):
+        return float
+    return type(value)
+
+
+def parse_overrides(items) -> dict:
+    """ parse configuration overrides
+
+    Parameters
+    ----------
+    items: list of str
+        'key=value', value is JSON (e.g. '1sec=55', 'note offset=[0,2]')
+        or string
+
+    Returns
+    -------
+    overrides: dict
+
+    Raises
+    ------
+    ValueError
+    """
+    overrides = {}
+    for item in items:
+        key, sep, value = item.partition('=')
+        key = key.strip()
+        if not sep or not key:
+            raise ValueError('invalid override: %r' % (item))
+        try:
+            overrides[key] = json.loads(value)
+        except ValueError:
+            overrides[key] = value.strip()
+    return overrides
+
+
+def _freeze(obj):
+    """ convert JSON object to immutable object """
+    if isinstance(obj, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in obj.items()})
+    if isinstance(obj, list):
+        return tuple([_freeze(v) for v in obj])
+    return obj
+
+
+class Model:
+    """ compiled (immutable) organ model
+
+    Attributes
+    ----------
+    name: str
+        Model Name
+    conf: mapping
+        read-only model configuration
+    fingerprint: str
+        hash of the model configuration
+    book_height, margin, pitch, hole_height: float
+        size in mm
+    sec_len: float
+        length of 1 sec in mm ('1sec')
+    base_note: int
+        MIDI note number of scale 0
+    note_offset: tuple of int
+        note offset of each scale
+    scale_table: array of int
+        MIDI note number -> scale number (-1: out of range)
+    page_len: float
+        page length in mm ('page length', 0: no paging)
+    bridge_width, bridge_interval, bridge_threshold: float
+        bridges of `bridge_width` are inserted about every
+        `bridge_interval` into slots longer than `bridge_threshold`
+        (size in mm, 0: no bridge)
+    min_gap: float
+        gaps between holes of a scale shorter than this are too short
+        to re-articulate ('min gap', default: `bridge_width`)
+    transpose: int or str
+        semitones, or 'auto' ('transpose', default: 0)
+        (see `transpose`)
+    fold_channels: tuple of int
+        MIDI channels folded by octaves into the range
+        ('fold channels', default: [])
+    """
+    __slots__ = ('name', 'conf', 'fingerprint',
+                 'book_height', 'margin', 'pitch', 'hole_height',
+                 'sec_len', 'base_note', 'note_offset', 'scale_table',
+                 'page_len',
+                 'bridge_width', 'bridge_interval', 'bridge_threshold',
+                 'min_gap', 'transpose', 'fold_channels')
+
+    def __init__(self, conf):
+        """ Constructor
+
+        Parameters
+        ----------
+        conf: dict
+            an entry of the configuration file
+        """
+        conf_str = json.dumps(conf, sort_keys=True, separators=(',', ':'))
+
+        setattr_ = super().__setattr__
+        setattr_('name', conf['model'])
+        setattr_('conf', _freeze(conf))
+        setattr_('fingerprint',
+                 hashlib.sha256(conf_str.encode('utf-8')).hexdigest())
+        setattr_('book_height', conf['book height'])
+        setattr_('margin', conf['margin'])
+        setattr_('pitch', conf['pitch'])
+        setattr_('hole_height', conf['hole height'])
+        setattr_('sec_len', conf['1sec'])
+        setattr_('base_note', conf['base note'])
+        setattr_('note_offset', tuple(conf['note offset']))
+
+        scale_table = array('h', [-1]) * MIDI_NOTES
+        for scale, offset in reversed(list(enumerate(self.note_offset))):
+            note = self.base_note + offset
+            if 0 <= note < MIDI_NOTES:
+                scale_table[note] = scale
+        setattr_('scale_table', scale_table)
+
+        setattr_('page_len', conf.get('page length', 0))
+
+        setattr_('bridge_width', conf.get('bridge width', 0))
+        setattr_('bridge_interval', conf.get('bridge interval', 0))
+        setattr_('bridge_threshold', conf.get('bridge threshold', 0))
+        setattr_('min_gap', conf.get('min gap', self.bridge_width))
+
+        transpose = conf.get('transpose', 0)
+        if transpose != 'auto' and (not isinstance(transpose, int) or
+                                    isinstance(transpose, bool)):
+            raise ValueError('transpose: "auto" or int is expected: %r' % (
+                transpose))
+        setattr_('transpose', transpose)
+        setattr_('fold_channels', tuple(conf.get('fold channels', [])))
+
+    def replace(self, overrides):
+        """ model with some configuration entries replaced
+        (e.g. geometry tuning)
+
+        Parameters
+        ----------
+        overrides: dict
+            configuration entries
+
+        Returns
+        -------
+        model: Model
+            self, if `overrides` is empty
+
+        Raises
+        ------
+        KeyError, ValueError, TypeError
+            invalid configuration
+        """
+        if not overrides:
+            return self
+
+        conf = _thaw(self.conf)
+        for key, value in overrides.items():
+            if key in conf and key not in MIXED_TYPE_KEYS and \
+               _json_type(value) != _json_type(conf[key]):
+                raise TypeError('%r: %s is expected' % (
+                    key, type(conf[key]).__name__))
+        conf.update(overrides)
+        if conf['model'] != self.name:
+            raise ValueError('model name cannot be changed')
+        return Model(conf)
+
+    def note2scale(self, note) -> int:
+        """ MIDI note number -> scale number
+
+        Parameters
+        ----------
+        note: int
+            MIDI note number
+
+        Returns
+        -------
+        scale: int
+            -1: out of range
+        """
+        if 0 <= note < MIDI_NOTES:
+            return self.scale_table[note]
+        return -1
+
+    def scales(self, notes):
+        """ MIDI note numbers -> scale numbers
+
+        Parameters
+        ----------
+        notes: array or list of int
+            MIDI note numbers (0..127)
+
+        Returns
+        -------
+        scales: array of int
+            -1: out of range
+        """
+        return array('h', map(self.scale_table.__getitem__, notes))
+
+    def note_stats(self, notes):
+        """ how many notes are playable
+
+        Parameters
+        ----------
+        notes: array or list of int
+            MIDI note numbers (0..127)
+
+        Returns
+        -------
+        stats: dict
+            'notes', 'playable', 'out_of_range'
+        """
+        n_out = self.scales(notes).count(-1)
+
+        return {'notes': len(notes),
+                'playable': len(notes) - n_out,
+                'out_of_range': n_out}
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is immutable' % (self.__class__.__name__))
+
+    def __delattr__(self, name):
+        raise AttributeError('%s is immutable' % (self.__class__.__name__))
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.name)
+
+
+class ModelRegistry:
+    """ model registry
+
+    The configuration file is reloaded when its mtime changes.
+    mtime is checked at most once in `CHECK_INTERVAL` sec.
+    """
+    CHECK_INTERVAL = 1.0  # sec
+
+    def __init__(self, conf_file, debug=False):
+        """ Constructor
+
+        Parameters
+        ----------
+        conf_file: str
+            configuration file
+        """
+        self._dbg = debug
+        self._log = get_logger(self.__class__.__name__, self._dbg)
+        self._log.debug('conf_file=%s', conf_file)
+
+        self._conf_file = conf_file
+
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._checked = 0
+        self._models = {}
+
+    @property
+    def conf_file(self):
+        """ configuration file """
+        return self._conf_file
+
+    def _load(self):
+        """ (re)load configuration file, if it is modified """
+        now = time.monotonic()
+        if self._mtime is not None and \
+           now - self._checked < self.CHECK_INTERVAL:
+            return
+
+        with self._lock:
+            self._checked = now
+
+            mtime = os.stat(self._conf_file).st_mtime_ns
+            if mtime == self._mtime:
+                return
+
+            with open(self._conf_file) as f:
+                all_conf = json.load(f)
+
+            models = {}
+            for conf in all_conf:
+                model = Model(conf)
+                models[model.name] = model
+
+            self._models = models
+            self._mtime = mtime
+            self._log.debug('loaded: %s', list(self._models))
+
+    def get(self, name) -> Model:
+        """ get model
+
+        Parameters
+        ----------
+        name: str
+            Model Name
+
+        Raises
+        ------
+        KeyError
+            unknown model name
+        """
+        self._load()
+        return self._models[name]
+
+    def names(self):
+        """ list of Model Names """
+        self._load()
+        return list(self._models)
+
+    def models(self):
+        """ list of all models """
+        self._load()
+        return list(self._models.values())
+
+
+_REGISTRY = {}
+_REGISTRY_LOCK = threading.Lock()
+
+
+def get_registry(conf_file, debug=False) -> ModelRegistry:
+    """ get process-wide model registry for `conf_file`
+
+    Parameters
+    ----------
+    conf_file: str
+        configuration file
+    """
+    path = os.path.abspath(os.path.expanduser(conf_file))
+
+    with _REGISTRY_LOCK:
+        registry = _REGISTRY.get(path)
+        if registry is None:
+            registry = ModelRegistry(path, debug=debug)
+            _REGISTRY[path] = registry
+
+    return registry
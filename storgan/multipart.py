@@ -0,0 +1,385 @@
+#
+# (c) 2021 Yoichi Tanibayashi
+#
+"""
+streaming multipart/form-data parser (and raw body receiver)
+
+The request body is fed chunk by chunk (`feed()`).
+File parts are written to temporary files and hashed on the fly,
+so that memory usage does not depend on the upload size.
+Other fields are kept in memory (up to `FIELD_LIMIT` bytes).
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__ = '2021/01'
+
+import os
+import hashlib
+from email.message import Message
+from .fileutil import make_temp
+from .my_logger import get_logger
+
+
+class MultipartError(ValueError):
+    """ malformed or too large multipart data """
+
+
+class MultipartTooLarge(MultipartError):
+    """ too large file, field or headers """
+
+
+def parse_header_params(name, value):
+    """ parse header value with parameters
+
+    Parameters
+    ----------
+    name: str
+        header name (e.g. 'Content-Type')
+    value: str
+        header value
+
+    Returns
+    -------
+    msg: email.message.Message
+        use `get_content_type()`, `get_content_disposition()`,
+        `get_param()`, `get_filename()`
+    """
+    msg = Message()
+    msg[name] = value
+    return msg
+
+
+class UploadFile:
+    """ uploaded file
+
+    Attributes
+    ----------
+    name: str
+        field name
+    filename: str
+        file name given by the client
+    path: str
+        temporary file
+    size: int
+        size in bytes
+    digest: str
+        SHA-256 hex digest of the contents (same as `cache.midi_hash()`)
+    """
+    __slots__ = ('name', 'filename', 'path', 'size', 'digest')
+
+    def __init__(self, name, filename, path):
+        self.name = name
+        self.filename = filename
+        self.path = path
+        self.size = 0
+        self.digest = None
+
+    def __repr__(self):
+        return '<%s %s %s %s>' % (self.__class__.__name__,
+                                  self.filename, self.size, self.digest)
+
+
+class StreamingBody:
+    """ receiver of raw request body (the whole body is a file)
+
+    Same interface as `StreamingFormData`.
+
+    Attributes
+    ----------
+    fields: dict
+        (always empty)
+    files: dict
+        field name -> UploadFile
+    """
+    def __init__(self, name, filename, tmp_dir, size_limit=None,
+                 debug=False):
+        """ Constructor
+
+        Parameters
+        ----------
+        name: str
+            field name of the file
+        filename: str
+            file name
+        tmp_dir: str
+            directory for temporary files
+        size_limit: int
+            max size of the file (None: no limit)
+        """
+        self._dbg = debug
+        self._log = get_logger(self.__class__.__name__, self._dbg)
+        self._log.debug('name=%s, filename=%s, tmp_dir=%s, size_limit=%s',
+                        name, filename, tmp_dir, size_limit)
+
+        self._size_limit = size_limit
+
+        fd, path = make_temp(tmp_dir, prefix='.upload-')
+        self._file = os.fdopen(fd, mode='wb')
+        self._hash = hashlib.sha256()
+        self._upload = UploadFile(name, filename, path)
+
+        self.fields = {}
+        self.files = {name: self._upload}
+
+    def feed(self, data):
+        """ feed a chunk of request body
+
+        Raises
+        ------
+        MultipartTooLarge
+            too large
+        """
+        self._upload.size += len(data)
+        if self._size_limit is not None and \
+           self._upload.size > self._size_limit:
+            raise MultipartTooLarge('too large file: > %s bytes' % (
+                self._size_limit))
+        self._file.write(data)
+        self._hash.update(data)
+
+    def close(self):
+        """ end of request body """
+        if not self._file.closed:
+            self._file.close()
+            self._upload.digest = self._hash.hexdigest()
+
+    def cleanup(self):
+        """ remove temporary file """
+        self.close()
+        if os.path.exists(self._upload.path):
+            os.remove(self._upload.path)
+
+
+class StreamingFormData:
+    """ streaming multipart/form-data parser
+
+    Attributes
+    ----------
+    fields: dict
+        field name -> value (str)
+    files: dict
+        field name -> UploadFile
+    """
+    FIELD_LIMIT = 64 * 1024  # bytes per field
+    HEADER_LIMIT = 16 * 1024  # bytes of headers per part
+    MAX_PARTS = 16
+
+    _PREAMBLE, _DELIM, _HEADERS, _BODY, _END = range(5)
+
+    def __init__(self, boundary: bytes, tmp_dir, size_limit=None,
+                 debug=False):
+        """ Constructor
+
+        Parameters
+        ----------
+        boundary: bytes
+            boundary in Content-Type header
+        tmp_dir: str
+            directory for temporary files
+        size_limit: int
+            max size of each file (None: no limit)
+        """
+        self._dbg = debug
+        self._log = get_logger(self.__class__.__name__, self._dbg)
+        self._log.debug('boundary=%s, tmp_dir=%s, size_limit=%s',
+                        boundary, tmp_dir, size_limit)
+
+        self._delim = b'--' + boundary
+        self._body_delim = b'\r\n' + self._delim
+        self._tmp_dir = tmp_dir
+        self._size_limit = size_limit
+
+        self.fields = {}
+        self.files = {}
+
+        self._buf = bytearray()
+        self._state = self._PREAMBLE
+        self._n_parts = 0
+
+        self._part = None  # UploadFile or (name, bytearray)
+        self._file = None
+        self._hash = None
+
+    @property
+    def done(self) -> bool:
+        """ the last boundary has been read """
+        return self._state == self._END
+
+    def feed(self, data):
+        """ feed a chunk of request body
+
+        Parameters
+        ----------
+        data: bytes
+
+        Raises
+        ------
+        MultipartError
+            malformed
+        MultipartTooLarge
+            too large file, field or headers
+        """
+        if self._state == self._END:
+            return
+
+        self._buf += data
+        while self._step():
+            pass
+
+    def close(self):
+        """ end of request body
+
+        Raises
+        ------
+        MultipartError
+            the last boundary is missing
+        """
+        if self._state != self._END:
+            self._end_part()
+            raise MultipartError('unexpected end of multipart data')
+
+    def cleanup(self):
+        """ remove temporary files """
+        self._end_part()
+        for upload in self.files.values():
+            if os.path.exists(upload.path):
+                os.remove(upload.path)
+
+    def _step(self) -> bool:
+        """ parse buffered data as far as possible
+
+        Returns
+        -------
+        progress: bool
+            False: more data is needed
+        """
+        buf = self._buf
+
+        if self._state == self._PREAMBLE:
+            pos = buf.find(self._delim)
+            if pos < 0:
+                del buf[:max(len(buf) - len(self._delim), 0)]
+                return False
+            del buf[:pos + len(self._delim)]
+            self._state = self._DELIM
+            return True
+
+        if self._state == self._DELIM:
+            return self._after_delim()
+
+        if self._state == self._HEADERS:
+            pos = buf.find(b'\r\n\r\n')
+            if pos < 0:
+                if len(buf) > self.HEADER_LIMIT:
+                    raise MultipartTooLarge('too large part headers')
+                return False
+            self._begin_part(bytes(buf[:pos]))
+            del buf[:pos + 4]
+            self._state = self._BODY
+            return True
+
+        if self._state == self._BODY:
+            pos = buf.find(self._body_delim)
+            if pos < 0:
+                # keep a possible partial delimiter
+                n_data = len(buf) - len(self._body_delim) + 1
+                if n_data > 0:
+                    self._part_data(buf[:n_data])
+                    del buf[:n_data]
+                return False
+            self._part_data(buf[:pos])
+            self._end_part()
+            del buf[:pos + len(self._body_delim)]
+            self._state = self._DELIM
+            return True
+
+        return False
+
+    def _after_delim(self) -> bool:
+        """ '--' (end) or CRLF (next part) after a delimiter """
+        buf = self._buf
+        if len(buf) < 2:
+            return False
+
+        tail = bytes(buf[:2])
+        del buf[:2]
+        if tail == b'--':
+            self._state = self._END
+            buf.clear()
+            return False
+        if tail != b'\r\n':
+            raise MultipartError('invalid boundary')
+
+        self._state = self._HEADERS
+        return True
+
+    def _begin_part(self, header_data: bytes):
+        """ start a part """
+        self._n_parts += 1
+        if self._n_parts > self.MAX_PARTS:
+            raise MultipartError('too many parts')
+
+        disposition = None
+        for line in header_data.decode('utf-8', 'replace').split('\r\n'):
+            key, _, value = line.partition(':')
+            if key.strip().lower() == 'content-disposition':
+                disposition = parse_header_params(key.strip(),
+                                                  value.strip())
+        if disposition is None or \
+           disposition.get_content_disposition() != 'form-data':
+            raise MultipartError('invalid Content-Disposition')
+
+        name = disposition.get_param('name',
+                                     header='content-disposition')
+        if not name:
+            raise MultipartError('no field name')
+        filename = disposition.get_filename()
+        self._log.debug('name=%s, filename=%s', name, filename)
+
+        if filename is None:
+            self._part = (name, bytearray())
+            return
+
+        fd, path = make_temp(self._tmp_dir, prefix='.upload-')
+        self._file = os.fdopen(fd, mode='wb')
+        self._hash = hashlib.sha256()
+        self._part = UploadFile(name, filename, path)
+        old = self.files.get(name)
+        if old is not None:
+            os.remove(old.path)
+        self.files[name] = self._part
+
+    def _part_data(self, data):
+        """ data of the current part """
+        if not data:
+            return
+
+        if isinstance(self._part, UploadFile):
+            self._part.size += len(data)
+            if self._size_limit is not None and \
+               self._part.size > self._size_limit:
+                raise MultipartTooLarge('too large file: > %s bytes' % (
+                    self._size_limit))
+            self._file.write(data)
+            self._hash.update(data)
+            return
+
+        value = self._part[1]
+        value += data
+        if len(value) > self.FIELD_LIMIT:
+            raise MultipartTooLarge('too large field: %s' % (self._part[0]))
+
+    def _end_part(self):
+        """ end the current part """
+        if self._part is None:
+            return
+
+        if isinstance(self._part, UploadFile):
+            self._file.close()
+            self._part.digest = self._hash.hexdigest()
+            self._file = self._hash = None
+            self._log.debug('file=%s', self._part)
+        else:
+            name, value = self._part
+            self.fields[name] = value.decode('utf-8', 'replace')
+
+        self._part = None
@@ -3,11 +3,19 @@
 #
 """
 my_logger.py
+
+Loggers are cached by (caller file name, name).
+The caller file name is taken from the caller's frame directly,
+without walking (and reading the source of) the whole stack.
+
+In hot loops, check `logger.isEnabledFor(DEBUG)` once,
+and skip debug work entirely when DEBUG is off.
 """
 __author__ = 'Yoichi Tanibayashi'
 __date__ = '2021'
 
-import inspect
+import sys
+import threading
 from logging import getLogger, StreamHandler, Formatter
 from logging import DEBUG, INFO
 # from logging import NOTSET, DEBUG, INFO, WARNING, ERROR, CRITICAL
@@ -21,30 +29,44 @@ CONSOLE_HANDLER = StreamHandler()
 CONSOLE_HANDLER.setFormatter(HANDLER_FMT)
 CONSOLE_HANDLER.setLevel(DEBUG)
 
+_LOGGERS = {}
+_LOGGERS_LOCK = threading.Lock()
+
+
+def _caller_filename(depth=2) -> str:
+    """ file name of the caller (without directory) """
+    return sys._getframe(depth).f_code.co_filename.split('/')[-1]
+
 
 def get_logger(name, dbg=False):
     """
     get logger
     """
-    filename = inspect.stack()[1].filename.split('/')[-1]
-    name = filename + '.' + name
-    logger = getLogger(name)
-    logger.propagate = False
-    logger.addHandler(CONSOLE_HANDLER)
-    logger.setLevel(INFO)
-
     # [Important !! ]
     # isinstance()では、boolもintと判定されるので、
     # 先に bool かどうかを判定する
 
     if isinstance(dbg, bool):
-        if dbg:
-            logger.setLevel(DEBUG)
+        level = DEBUG if dbg else INFO
+    elif isinstance(dbg, int):
+        level = dbg
+    else:
+        raise ValueError('invalid `dbg` value: %s' % (dbg))
+
+    key = (_caller_filename(), name)
 
-        return logger
+    logger = _LOGGERS.get(key)
+    if logger is None:
+        with _LOGGERS_LOCK:
+            logger = getLogger(key[0] + '.' + name)
+            logger.propagate = False
+            if CONSOLE_HANDLER not in logger.handlers:
+                logger.addHandler(CONSOLE_HANDLER)
+            _LOGGERS[key] = logger
 
-    if isinstance(dbg, int):
-        logger.setLevel(dbg)
-        return logger
+    # setLevel() clears the level cache of all loggers,
+    # so call it only when the level is changed
+    if logger.level != level:
+        logger.setLevel(level)
 
-    raise ValueError('invalid `dbg` value: %s' % (dbg))
+    return logger
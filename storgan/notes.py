@@ -0,0 +1,488 @@
+#
+# (c) 2021 Yoichi Tanibayashi
+#
+"""
+Parsed note stream and its cache
+
+The note stream (note, channel, start and length of each note)
+does not depend on the model, so that it is cached separately from
+the layout and the SVG. When only the model geometry changes,
+a roll is re-rendered without parsing the MIDI file again.
+
+Note file format (version 1, little endian):
+
+    header (16 bytes):
+        magic 'STGN', version (uint16), header size (uint16),
+        number of notes N (uint32), reserved (uint32)
+    columns (fixed width, one after another):
+        start_sec: float64 x N
+        sec: float64 x N
+        note: uint8 x N
+        channel: uint8 x N
+
+A note file is memory-mapped, and the columns are used as they are
+(no objects per note are created).
+
+    $ Storgan parse --dump a.notes a.mid
+    $ Storgan rollbook a.notes
+
+NoteCache has two tiers:
+    memory: LRU, up to `mem_limit` notes
+    disk: `cache_dir/{key}.notes` (optional), LRU, up to `disk_limit`
+          bytes (down to `LOW_WATER` of the limit, like `cache`)
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__ = '2021/01'
+
+import os
+import sys
+import mmap
+import time
+import struct
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+from .fileutil import atomic_open, file_hash
+from .my_logger import get_logger
+
+
+SUFFIX = '.notes'
+
+
+class NoteStream:
+    """ parsed notes, column by column
+
+    Attributes
+    ----------
+    note, channel: array or memoryview of int
+        MIDI note number and channel
+    start_sec, sec: array or memoryview of float
+        start time and length in sec
+    """
+    __slots__ = ('note', 'channel', 'start_sec', 'sec')
+
+    MAGIC = b'STGN'
+    VERSION = 1
+    HEADER = struct.Struct('<4sHHII')
+    # (name, typecode) in file order
+    COLUMNS = (('start_sec', 'd'), ('sec', 'd'),
+               ('note', 'B'), ('channel', 'B'))
+
+    def __init__(self, note=(), channel=(), start_sec=(), sec=()):
+        """ Constructor """
+        self.note = array('B', note)
+        self.channel = array('B', channel)
+        self.start_sec = array('d', start_sec)
+        self.sec = array('d', sec)
+
+    @classmethod
+    def from_note_info(cls, note_info):
+        """ make note stream from parsed notes
+
+        Parameters
+        ----------
+        note_info: list of midilib.NoteInfo
+        """
+        return cls([ni.note for ni in note_info],
+                   [ni.channel for ni in note_info],
+                   [ni.abs_time for ni in note_info],
+                   [ni.length() for ni in note_info])
+
+    @classmethod
+    def from_buffer(cls, buf):
+        """ make note stream from note file data (see module doc)
+
+        The columns are views of `buf` (not copied).
+
+        Parameters
+        ----------
+        buf: bytes-like object
+            e.g. mmap
+
+        Raises
+        ------
+        ValueError
+            not a note file, unsupported version or truncated
+        """
+        buf = memoryview(buf)
+        if len(buf) < cls.HEADER.size:
+            raise ValueError('not a note file')
+        magic, version, offset, n_notes, _ = cls.HEADER.unpack_from(buf)
+        if magic != cls.MAGIC:
+            raise ValueError('not a note file')
+        if version != cls.VERSION:
+            raise ValueError('unsupported note file version: %s' % (
+                version))
+
+        notes = cls.__new__(cls)
+        for name, typecode in cls.COLUMNS:
+            size = n_notes * array(typecode).itemsize
+            if offset + size > len(buf):
+                raise ValueError('truncated note file')
+
+            col = buf[offset:offset + size]
+            if sys.byteorder == 'little':
+                col = col.cast(typecode)
+            else:
+                col = array(typecode, col)
+                col.byteswap()
+            setattr(notes, name, col)
+            offset += size
+        return notes
+
+    def write(self, f):
+        """ write note file data (see module doc)
+
+        Parameters
+        ----------
+        f: file object
+            opened in binary mode
+        """
+        f.write(self.HEADER.pack(self.MAGIC, self.VERSION,
+                                 self.HEADER.size, len(self), 0))
+        for name, typecode in self.COLUMNS:
+            col = getattr(self, name)
+            if sys.byteorder != 'little':
+                col = array(typecode, col)
+                col.byteswap()
+            f.write(col)
+
+    def select(self, channel):
+        """ notes of selected MIDI channels
+
+        Parameters
+        ----------
+        channel: list of int
+            selected MIDI channel ([]: all)
+
+        Returns
+        -------
+        notes: NoteStream
+            self, if `channel` is empty
+        """
+        if not channel:
+            return self
+
+        idx = [i for i, ch in enumerate(self.channel) if ch in channel]
+        return NoteStream([self.note[i] for i in idx],
+                          [self.channel[i] for i in idx],
+                          [self.start_sec[i] for i in idx],
+                          [self.sec[i] for i in idx])
+
+    def partition(self) -> dict:
+        """ split notes by MIDI channel (in one pass)
+
+        Returns
+        -------
+        notes: dict
+            channel -> NoteStream (sorted by channel)
+        """
+        cols = {}
+        for i, ch in enumerate(self.channel):
+            col = cols.get(ch)
+            if col is None:
+                col = cols[ch] = ([], [], [], [])
+            col[0].append(self.note[i])
+            col[1].append(ch)
+            col[2].append(self.start_sec[i])
+            col[3].append(self.sec[i])
+
+        return {ch: NoteStream(*cols[ch]) for ch in sorted(cols)}
+
+    def polyphony(self) -> int:
+        """ max number of notes sounding at the same time """
+        # end (-1) before start (+1) at the same time
+        events = sorted([(t, 1) for t in self.start_sec] +
+                        [(t + sec, -1) for t, sec in zip(self.start_sec,
+                                                          self.sec)])
+        peak = n = 0
+        for _, delta in events:
+            n += delta
+            peak = max(peak, n)
+        return peak
+
+    def __len__(self):
+        return len(self.note)
+
+
+def is_note_file(path) -> bool:
+    """ True if `path` is a note file (see module doc) """
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(NoteStream.MAGIC)) == NoteStream.MAGIC
+    except OSError:
+        return False
+
+
+def load(path) -> NoteStream:
+    """ load note file (memory-mapped)
+
+    Raises
+    ------
+    ValueError
+        invalid note file
+    """
+    with open(path, 'rb') as f:
+        # the mapping is kept by the columns, and outlives the file
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return NoteStream.from_buffer(buf)
+
+
+def dump(notes, path):
+    """ write note file (atomically)
+
+    Parameters
+    ----------
+    notes: NoteStream
+    path: str
+    """
+    with atomic_open(path, 'wb') as f:
+        notes.write(f)
+
+
+class NoteCache:
+    """ two tier (memory / disk) cache of note streams """
+    KEY_VERSION = 2
+    SUFFIX = SUFFIX
+    DEF_MEM_LIMIT = 1000000  # notes
+    DEF_DISK_LIMIT = 256 * 1024 * 1024  # 256MB
+
+    LOW_WATER = 0.9  # eviction goes down to this ratio of disk_limit
+    RESCAN_SEC = 60  # the disk tier is rescanned at most this often
+
+    def __init__(self, cache_dir=None, mem_limit=DEF_MEM_LIMIT,
+                 disk_limit=DEF_DISK_LIMIT, debug=False):
+        """ Constructor
+
+        Parameters
+        ----------
+        cache_dir: str
+            directory of disk tier (None: memory only)
+        mem_limit: int
+            max number of notes in memory tier
+        disk_limit: int
+            max total bytes of disk tier
+        """
+        self._dbg = debug
+        self._log = get_logger(self.__class__.__name__, self._dbg)
+        self._log.debug('cache_dir=%s, mem_limit=%s, disk_limit=%s',
+                        cache_dir, mem_limit, disk_limit)
+
+        self._cache_dir = cache_dir
+        self._mem_limit = mem_limit
+        self._disk_limit = disk_limit
+
+        self._lock = threading.Lock()
+        self._mem = OrderedDict()
+        self._mem_notes = 0
+        self._disk = OrderedDict()  # file name -> size (LRU first)
+        self._disk_size = 0
+        self._scanned = 0
+
+        if self._cache_dir is not None:
+            self._cache_dir = os.path.expanduser(self._cache_dir)
+            os.makedirs(self._cache_dir, exist_ok=True)
+            self._scan_disk()
+            self._log.debug('disk_size=%s', self._disk_size)
+
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def key(cls, midi_digest, channel) -> str:
+        """ cache key
+
+        Parameters
+        ----------
+        midi_digest: str
+            hash of MIDI data
+        channel: list of int
+            selected MIDI channel ([]: all)
+        """
+        src = '%s:%s:%s' % (cls.KEY_VERSION, midi_digest,
+                            ','.join([str(c) for c in sorted(channel)]))
+        return hashlib.sha256(src.encode('utf-8')).hexdigest()
+
+    def path(self, key) -> str:
+        """ path name of the disk tier entry """
+        return os.path.join(self._cache_dir, key + self.SUFFIX)
+
+    def get(self, midi_file, channel=(), midi_digest=None) -> NoteStream:
+        """ get note stream, parsing MIDI file only if not cached
+
+        Parameters
+        ----------
+        midi_file: str
+        channel: list of int
+            selected MIDI channel ([]: all)
+        midi_digest: str
+            hash of MIDI data (None: computed)
+        """
+        if midi_digest is None:
+            midi_digest = file_hash(midi_file)
+        key = self.key(midi_digest, channel)
+
+        with self._lock:
+            notes = self._mem.get(key)
+            if notes is not None:
+                self._mem.move_to_end(key)
+                self._disk_touch(key)
+                self.hits += 1
+                return notes
+
+        notes = self._disk_get(key)
+        if notes is None:
+            with self._lock:
+                self.misses += 1
+            notes = self.parse(midi_file, channel)
+            self._disk_put(key, notes)
+        else:
+            with self._lock:
+                self.hits += 1
+
+        with self._lock:
+            self._mem_put(key, notes)
+        return notes
+
+    def put(self, midi_digest, channel, notes):
+        """ put note stream (e.g. a channel of cached notes)
+
+        Parameters
+        ----------
+        midi_digest: str
+            hash of MIDI data
+        channel: list of int
+            selected MIDI channel ([]: all)
+        notes: NoteStream
+        """
+        key = self.key(midi_digest, channel)
+        self._disk_put(key, notes)
+        with self._lock:
+            self._mem_put(key, notes)
+
+    def parse(self, midi_file, channel=()) -> NoteStream:
+        """ parse MIDI file (not cached) """
+        self._log.debug('midi_file=%s, channel=%s', midi_file, channel)
+
+        from midilib import Parser  # only to decode MIDI files
+        midi = Parser(debug=self._dbg).parse(midi_file, list(channel))
+        return NoteStream.from_note_info(midi['note_info'])
+
+    def _disk_get(self, key):
+        """ read disk tier entry (None: not cached) """
+        if self._cache_dir is None:
+            return None
+
+        try:
+            notes = load(self.path(key))
+        except (FileNotFoundError, ValueError):
+            return None
+
+        try:
+            os.utime(self.path(key))
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            self._disk_touch(key)
+        return notes
+
+    def _disk_put(self, key, notes):
+        """ write disk tier entry, and evict """
+        if self._cache_dir is None:
+            return
+
+        dump(notes, self.path(key))
+        size = os.path.getsize(self.path(key))
+
+        name = key + self.SUFFIX
+        with self._lock:
+            self._disk_size += size - self._disk.pop(name, 0)
+            self._disk[name] = size
+            self._disk_evict()
+
+    def _disk_touch(self, key):
+        """ mark the disk tier entry as recently used
+        (lock must be held) """
+        name = key + self.SUFFIX
+        if name in self._disk:
+            self._disk.move_to_end(name)
+
+    def _scan_disk(self):
+        """ rebuild the index of the disk tier from the directory
+        (lock must be held)
+
+        Other processes (e.g. workers) add and remove entries
+        in the same directory.
+        """
+        entries = []
+        for e in os.scandir(self._cache_dir):
+            if not e.is_file() or not e.name.endswith(self.SUFFIX):
+                continue
+            try:
+                st = e.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, e.name, st.st_size))
+        entries.sort()
+
+        self._disk = OrderedDict([(name, size)
+                                  for _, name, size in entries])
+        self._disk_size = sum(self._disk.values())
+        self._scanned = time.monotonic()
+
+    def _disk_evict(self):
+        """ remove least recently used files from disk tier
+        (lock must be held)
+
+        Files mapped by `load()` stay readable after removal.
+        """
+        if self._disk_size <= self._disk_limit:
+            return
+
+        if time.monotonic() - self._scanned > self.RESCAN_SEC:
+            self._scan_disk()
+
+        low_water = self._disk_limit * self.LOW_WATER
+        while self._disk and self._disk_size > low_water:
+            name, size = self._disk.popitem(last=False)
+            self._disk_size -= size
+            try:
+                os.remove(os.path.join(self._cache_dir, name))
+                self._log.debug('evict %s', name)
+            except FileNotFoundError:
+                pass
+
+    def _mem_put(self, key, notes):
+        """ put to memory tier (lock must be held) """
+        old = self._mem.pop(key, None)
+        if old is not None:
+            self._mem_notes -= len(old)
+
+        self._mem[key] = notes
+        self._mem_notes += len(notes)
+
+        while self._mem_notes > self._mem_limit and len(self._mem) > 1:
+            _, old = self._mem.popitem(last=False)
+            self._mem_notes -= len(old)
+
+
+_NOTE_CACHE = {}
+_NOTE_CACHE_LOCK = threading.Lock()
+
+
+def get_note_cache(cache_dir=None, debug=False) -> NoteCache:
+    """ get process-wide note cache for `cache_dir`
+
+    Parameters
+    ----------
+    cache_dir: str
+        directory of disk tier (None: memory only)
+    """
+    with _NOTE_CACHE_LOCK:
+        cache = _NOTE_CACHE.get(cache_dir)
+        if cache is None:
+            cache = NoteCache(cache_dir, debug=debug)
+            _NOTE_CACHE[cache_dir] = cache
+
+    return cache
@@ -0,0 +1,94 @@
+#
+# (c) 2021 Yoichi Tanibayashi
+#
+"""
+cProfile helpers
+
+    $ Storgan rollbook --profile a.prof a.mid
+    $ python -m pstats a.prof
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__ = '2021/01'
+
+import io
+import os
+import sys
+import marshal
+import cProfile
+import pstats
+from .fileutil import atomic_open
+
+
+DEF_TOP = 20
+DEF_SORT = 'cumulative'
+
+
+def profile(func, *args, **kwargs):
+    """ call `func(*args, **kwargs)` under cProfile
+
+    Returns
+    -------
+    ret:
+        return value of `func`
+    prof: cProfile.Profile
+    """
+    prof = cProfile.Profile()
+    prof.enable()
+    try:
+        ret = func(*args, **kwargs)
+    finally:
+        prof.disable()
+    return ret, prof
+
+
+def dump(prof, out_file):
+    """ write pstats dump (atomically)
+
+    Parameters
+    ----------
+    prof: cProfile.Profile
+    out_file: str
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(out_file)), exist_ok=True)
+    prof.create_stats()
+    with atomic_open(out_file, 'wb') as f:
+        # same as `Profile.dump_stats()`
+        marshal.dump(prof.stats, f)
+
+
+def hot_spots(prof, top=DEF_TOP, sort=DEF_SORT) -> str:
+    """ top hot spots
+
+    Parameters
+    ----------
+    prof: cProfile.Profile
+    top: int
+        number of functions
+    sort: str
+        sort key (see `pstats.Stats.sort_stats()`)
+    """
+    out = io.StringIO()
+    pstats.Stats(prof, stream=out).strip_dirs().sort_stats(
+        sort).print_stats(top)
+    return out.getvalue()
+
+
+def run(func, out_file, *args, top=DEF_TOP, stream=None, **kwargs):
+    """ call `func` under cProfile, write the dump to `out_file`,
+    and print top hot spots (CLI `--profile`)
+
+    Returns
+    -------
+    ret:
+        return value of `func`
+    """
+    stream = stream or sys.stderr
+    prof = cProfile.Profile()
+    prof.enable()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        prof.disable()
+        dump(prof, out_file)
+        print(hot_spots(prof, top), file=stream)
+        print('profile: %s' % (out_file), file=stream)
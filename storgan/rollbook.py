@@ -8,12 +8,28 @@ __author__ = 'Yoichi Tanibayashi'
 __date__ = '2021/01'
 
 import os
-import json
-from midilib import Parser
+import math
+import time
+import operator
+from array import array
+from logging import DEBUG
+from .model import Model, get_registry
+from .holeindex import HoleIndex
+from .metrics import StageStats
+from .transpose import transpose
+from .notes import NoteStream, is_note_file, load as load_notes
 from .my_logger import get_logger
 
 
 DEF_LINE_WIDTH = 0.1
+DEF_PRECISION = 2  # digits after the decimal point (compact SVG)
+WARN_COLOR = '#FF8000'  # holes after a gap too short to re-articulate
+
+FLAG_SHORT_GAP = 0x01  # the gap before the hole is too short
+FLAG_MERGED = 0x02  # merged from overlapping or touching holes
+FLAG_BRIDGED = 0x04  # a segment of a slot cut by bridges
+
+EPS = 1e-9  # mm
 
 
 def note2scale(midi_note, base_note, note_offset=[]) -> int:
@@ -64,31 +80,98 @@ def svg_square(x, y, w, h, color, line_width=DEF_LINE_WIDTH,
     return svg
 
 
+def svg_rect_d(x, y, w, h, precision=DEF_PRECISION) -> str:
+    """ path data of a rectangle (same geometry as `svg_square()`)
+
+    Parameters
+    ----------
+    x, y, w, h: float
+    precision: int
+        digits after the decimal point
+
+    Returns
+    -------
+    d: str
+    """
+    return 'M%.*f %.*fh%.*fv%.*fh%.*fZ' % (
+        precision, -x, precision, -y, precision, -w, precision, -h,
+        precision, w)
+
+
+def svg_path(d_list, color, line_width=DEF_LINE_WIDTH,
+             stroke_dasharray='none') -> str:
+    """ one `<path>` of many subpaths with a shared style
+
+    Parameters
+    ----------
+    d_list: list of str
+        path data (see `svg_rect_d()`)
+    color: str
+    line_width: float
+    stroke_dasharray: str
+
+    Returns
+    -------
+    svg: str
+    """
+    svg = '<path style="fill:none;stroke:%s;stroke-width:%s' % (
+        color, line_width)
+    if stroke_dasharray != 'none':
+        svg += ';stroke-dasharray:%s' % (stroke_dasharray)
+    svg += '" d="%s"/>\n' % (''.join(d_list))
+
+    return svg
+
+
 class HoleInfo:
     """
     Roll Book Hole data entity
 
+    A lightweight object for compatibility.
+    Use `HoleTable` for many holes.
+
     Attributes
     ----------
     note_info: midilib.NoteInfo
-        MIDI note information
+        MIDI note information (None: view of HoleTable)
+    note: int
+        MIDI note number
+    start_sec: float
+        start time in sec
     sec: float
         length in sec
     scale: int
         scale number
     x, y, w, h: float
         coordinate in mm
+    flag: int
+        FLAG_* bits
     """
+    __slots__ = ('note_info', 'conf', 'note', 'start_sec', 'sec',
+                 'scale', 'x', 'y', 'w', 'h', 'flag')
+
     def __init__(self, note_info=None, conf=None, debug=False):
-        self._dbg = debug
-        self._log = get_logger(self.__class__.__name__, self._dbg)
+        """ Constructor
 
+        Parameters
+        ----------
+        note_info: midilib.NoteInfo
+        conf: dict
+            model configuration
+        debug: bool
+            (not used)
+        """
         self.note_info = note_info
         self.conf = conf
+        self.flag = 0
+
+        if self.note_info is None:
+            return
 
+        self.note = self.note_info.note
         self.start_sec = self.note_info.abs_time
         self.sec = self.note_info.length()
-        self.scale = note2scale(self.note_info.note,
+        self.scale = note2scale(self.note,
                                 self.conf['base note'],
                                 self.conf['note offset'])
 
@@ -97,13 +180,36 @@ class HoleInfo:
         self.w = self.sec * self.conf['1sec']
         self.h = self.conf['hole height']
 
+    @classmethod
+    def from_table(cls, table, i):
+        """ view of a row of HoleTable
+
+        Parameters
+        ----------
+        table: HoleTable
+        i: int
+            row index
+        """
+        hi = cls()
+        hi.note = table.note[i]
+        hi.start_sec = table.start_sec[i]
+        hi.sec = table.sec[i]
+        hi.scale = table.scale[i]
+        hi.x = table.x[i]
+        hi.y = table.y[i]
+        hi.w = table.w[i]
+        hi.h = table.h[i]
+        hi.flag = table.flag[i]
+        return hi
+
     def __str__(self):
         """ __str__ """
         str_data = 'note:%03d start_sec:%07.2f sec:%05.2f' % (
-            self.note_info.note, self.start_sec, self.sec)
+            self.note, self.start_sec, self.sec)
         str_data += ' scale:%02d' % (self.scale)
         str_data += ' (%.2f, %.2f)-(%.2f, %.2f)' % (
             self.x, self.y, self.w, self.h)
+        str_data += ' flag:%d' % (self.flag)
         return str_data
 
     def svg(self, color='#FF0000', line_width=DEF_LINE_WIDTH,
@@ -128,39 +234,318 @@ class HoleInfo:
         return svg
 
 
+class HoleTable:
+    """
+    Roll Book Hole table
+
+    Holes are stored column by column in `array.array`,
+    instead of one Python object per note.
+
+    Attributes
+    ----------
+    note: array of int
+        MIDI note number
+    start_sec, sec: array of float
+        start time and length in sec
+    scale: array of int
+        scale number (-1: out of range)
+    x, y, w, h: array of float
+        coordinate in mm
+    flag: array of int
+        FLAG_* bits
+    """
+    def __init__(self):
+        """ Constructor (empty table) """
+        self.note = array('B')
+        self.start_sec = array('d')
+        self.sec = array('d')
+        self.scale = array('h')
+        self.x = array('d')
+        self.y = array('d')
+        self.w = array('d')
+        self.h = array('d')
+        self.flag = array('B')
+
+    @classmethod
+    def from_notes(cls, note_info, model):
+        """ make hole table from parsed notes
+
+        Parameters
+        ----------
+        note_info: list of midilib.NoteInfo
+        model: model.Model
+        """
+        return cls.from_stream(NoteStream.from_note_info(note_info), model)
+
+    @classmethod
+    def from_stream(cls, notes, model):
+        """ make hole table from note stream
+
+        Parameters
+        ----------
+        notes: notes.NoteStream
+        model: model.Model
+        """
+        table = cls()
+        table.note = array('B', notes.note)
+        table.start_sec = array('d', notes.start_sec)
+        table.sec = array('d', notes.sec)
+        table.layout(model)
+        return table
+
+    def layout(self, model):
+        """ compute scale numbers and coordinates
+
+        Parameters
+        ----------
+        model: model.Model
+        """
+        sec_len = model.sec_len
+        pitch, margin = model.pitch, model.margin
+
+        self.scale = model.scales(self.note)
+        self.x = array('d', [t * sec_len for t in self.start_sec])
+        self.y = array('d', [s * pitch + margin for s in self.scale])
+        self.w = array('d', [t * sec_len for t in self.sec])
+        self.h = array('d', [model.hole_height]) * len(self.note)
+        self.flag = array('B', [0]) * len(self.note)
+
+    def coalesce(self, model):
+        """ merge holes into slots, and insert bridges
+
+        Overlapping or touching holes of a scale are merged
+        into one slot by a sweep over the holes sorted by (scale, x).
+        Slots longer than `model.bridge_threshold` are cut by bridges,
+        and slots after a gap shorter than `model.min_gap`
+        are flagged (FLAG_SHORT_GAP).
+        Holes out of range are not changed.
+
+        O(n log n) (sort)
+
+        Parameters
+        ----------
+        model: model.Model
+
+        Returns
+        -------
+        slots: HoleTable
+            (sorted by (scale, x))
+        """
+        scale, x, w = self.scale, self.x, self.w
+        n = len(self)
+        order = sorted(range(n), key=lambda i: (scale[i], x[i]))
+
+        slots = HoleTable()
+        prev_scale, prev_end = -1, 0
+        k = 0
+        while k < n:
+            i = order[k]
+            k += 1
+
+            if scale[i] < 0:
+                slots._append(self, i, x[i], w[i], self.flag[i], model)
+                continue
+
+            start, end = x[i], x[i] + w[i]
+            flag = 0
+            while k < n and scale[order[k]] == scale[i] and \
+                    x[order[k]] <= end + EPS:
+                end = max(end, x[order[k]] + w[order[k]])
+                flag = FLAG_MERGED
+                k += 1
+
+            if scale[i] == prev_scale and start - prev_end < model.min_gap:
+                flag |= FLAG_SHORT_GAP
+            prev_scale, prev_end = scale[i], end
+
+            slots._add_slot(self, i, start, end - start, flag, model)
+
+        return slots
+
+    def simplify(self, rows, resolution, model):
+        """ coarse level of detail: holes of a scale closer than
+        `resolution` are merged into one (e.g. for a zoomed out view)
+
+        Parameters
+        ----------
+        rows: list of int
+            row indexes, sorted by x (see `HoleIndex.query()`)
+        resolution: float
+            min gap in mm (e.g. the length of a pixel)
+        model: model.Model
+
+        Returns
+        -------
+        holes: HoleTable
+            (sorted by (scale, x))
+        """
+        # scale -> [[row, start, end, flag], ..]
+        runs = {}
+        for i in rows:
+            start, end = self.x[i], self.x[i] + self.w[i]
+            scale_runs = runs.setdefault(self.scale[i], [])
+            if scale_runs and start - scale_runs[-1][2] < resolution:
+                run = scale_runs[-1]
+                run[2] = max(run[2], end)
+                run[3] |= self.flag[i] | FLAG_MERGED
+                continue
+            scale_runs.append([i, start, end, self.flag[i]])
+
+        holes = HoleTable()
+        for scale in sorted(runs):
+            for i, start, end, flag in runs[scale]:
+                holes._append(self, i, start, end - start, flag, model)
+        return holes
+
+    def _add_slot(self, src, i, x, w, flag, model):
+        """ add a slot cut by bridges
+
+        Bridges are spaced evenly, about every `model.bridge_interval`.
+        """
+        b_w = model.bridge_width
+        if b_w <= 0 or model.bridge_interval <= 0 or \
+           w <= model.bridge_threshold:
+            self._append(src, i, x, w, flag, model)
+            return
+
+        n_seg = math.ceil((w + b_w) / (model.bridge_interval + b_w))
+        seg_w = (w - (n_seg - 1) * b_w) / n_seg
+        if n_seg < 2 or seg_w <= 0:
+            self._append(src, i, x, w, flag, model)
+            return
+
+        for seg in range(n_seg):
+            self._append(src, i, x + seg * (seg_w + b_w), seg_w,
+                         flag | FLAG_BRIDGED, model)
+            flag &= ~FLAG_SHORT_GAP
+
+    def _append(self, src, i, x, w, flag, model):
+        """ append a row at x, w, taking the rest from `src[i]` """
+        self.note.append(src.note[i])
+        self.start_sec.append(x / model.sec_len)
+        self.sec.append(w / model.sec_len)
+        self.scale.append(src.scale[i])
+        self.x.append(x)
+        self.y.append(src.y[i])
+        self.w.append(w)
+        self.h.append(src.h[i])
+        self.flag.append(flag)
+
+    @property
+    def width(self) -> float:
+        """ max(x + w) """
+        return max(map(operator.add, self.x, self.w), default=0)
+
+    @property
+    def n_out_of_range(self) -> int:
+        """ number of notes out of range of the model """
+        return self.scale.count(-1)
+
+    @property
+    def n_short_gap(self) -> int:
+        """ number of holes after a gap too short to re-articulate """
+        return sum([1 for f in self.flag if f & FLAG_SHORT_GAP])
+
+    def __len__(self):
+        return len(self.note)
+
+    def __getitem__(self, i) -> HoleInfo:
+        return HoleInfo.from_table(self, i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield HoleInfo.from_table(self, i)
+
+
 class RollBook:
     """ RollBook class
+
+    Attributes
+    ----------
+    stats: metrics.StageStats
+        elapsed time of parse, layout, svg (serialization) and
+        write (file output), and counts of notes and SVG bytes,
+        since the last `load()`
+    transposition: dict
+        result of `transpose.transpose()` of the last layout
+        (None: the model does not transpose)
     """
     DEF_MODEL_NAME = 'ModelName'
     DEF_CONF_FILE = os.path.expanduser('~/bin/storgan.conf')
 
-    def __init__(self, model: str = DEF_MODEL_NAME,
-                 conf_file: str = DEF_CONF_FILE, debug=False):
+    SVG_CHUNK_HOLES = 256  # holes per chunk of `iter_svg()`
+
+    def __init__(self, model=DEF_MODEL_NAME,
+                 conf_file: str = DEF_CONF_FILE, note_cache=None,
+                 debug=False):
         """ Constructor
 
         Parameters
         ----------
-        model: str
-            Model Name
+        model: str or model.Model
+            Model Name or model object
         conf_file: str
+        note_cache: notes.NoteCache
+            cache of parsed notes (None: always parse)
         """
         self._dbg = debug
         self._log = get_logger(self.__class__.__name__, self._dbg)
         self._log.debug('model=%s', model)
 
-        self._model = model
         self._conf_file = conf_file
         self._log.debug('conf_file=%s', self._conf_file)
 
-        self._conf = self.get_conf(self._model, self._conf_file)
-        self._log.debug('conf=%s', json.dumps(self._conf))
+        if isinstance(model, Model):
+            self._model = model
+        else:
+            self._model = get_registry(self._conf_file).get(model)
+        self._conf = self._model.conf
+        self._log.debug('conf=%s', dict(self._conf))
 
         self._width = 0
-        self._height = self._conf['book height']
-        self._holes = []
+        self._height = self._model.book_height
+        self._notes = NoteStream()
+        self._holes = HoleTable()
+        self._n_notes = 0
+        self._index = None
         self._svg = ''
 
-        self._midi_parser = Parser(debug=self._dbg)
+        self._midi_parser = None
+        self._note_cache = note_cache
+        self.transposition = None
+        self.stats = StageStats()
+
+    @property
+    def model(self):
+        """ model (see model.Model) """
+        return self._model
+
+    @property
+    def conf(self):
+        """ model configuration (read only) """
+        return self._conf
+
+    @property
+    def width(self):
+        """ roll length in mm """
+        return self._width
+
+    @property
+    def notes(self) -> NoteStream:
+        """ parsed notes (see `relayout()`) """
+        return self._notes
+
+    @property
+    def n_notes(self):
+        """ number of notes (before coalescing) """
+        return self._n_notes
+
+    @property
+    def index(self) -> HoleIndex:
+        """ interval index over holes (built on demand) """
+        if self._index is None:
+            self._index = HoleIndex(self._holes)
+        return self._index
 
     def get_conf(self, model='ModelName', conf_file=DEF_CONF_FILE):
         """
@@ -174,18 +559,87 @@ class RollBook:
         self._log.debug('model=%s, conf_file=%s',
                         model, conf_file)
 
-        with open(conf_file) as f:
-            all_conf = json.load(f)
+        try:
+            return dict(get_registry(conf_file).get(model).conf)
+        except KeyError:
+            return {}
 
-        for conf in all_conf:
-            if conf['model'] == model:
-                return conf
+    def _iter_holes_svg(self, rows, hole_color, x0=0, width=None,
+                        compact=True, precision=DEF_PRECISION, holes=None):
+        """ generate SVG of holes chunk by chunk
 
-        return {}
+        Parameters
+        ----------
+        rows: iterable of int
+            row indexes of holes
+        hole_color: str
+        x0: float
+            origin of x
+        width: float
+            holes are clipped to [0, width] (None: no clipping)
+        compact: bool
+            merge holes of the same style into a few `<path>`
+        precision: int
+            digits after the decimal point (compact only)
+        holes: HoleTable
+            (None: the holes of the roll)
 
-    def svg(self, color='#0000FF', hole_color='#FF0000',
-            line_width=DEF_LINE_WIDTH, stroke_dasharray='none'):
-        """ generate SVG
+        Yields
+        ------
+        svg: str
+        """
+        # style key -> (color, stroke_dasharray)
+        styles = {0: (hole_color, 'none'),
+                  FLAG_SHORT_GAP: (WARN_COLOR, 'none'),
+                  -1: ('#000000', '3 1')}
+        bufs = {key: [] for key in styles}
+
+        if holes is None:
+            holes = self._holes
+        for i in rows:
+            x, w = holes.x[i], holes.w[i]
+            if width is not None:
+                x = max(x - x0, 0)
+                w = min(holes.x[i] + holes.w[i] - x0, width) - x
+
+            if holes.scale[i] < 0:
+                key = -1
+            elif holes.flag[i] & FLAG_SHORT_GAP:
+                key = FLAG_SHORT_GAP
+            else:
+                key = 0
+
+            if compact:
+                buf = bufs[key]
+                buf.append(svg_rect_d(x, holes.y[i], w, holes.h[i],
+                                      precision))
+                if len(buf) >= self.SVG_CHUNK_HOLES:
+                    color, dasharray = styles[key]
+                    yield svg_path(buf, color, stroke_dasharray=dasharray)
+                    buf.clear()
+                continue
+
+            color, dasharray = styles[key]
+            buf = bufs[0]
+            buf.append(svg_square(x, holes.y[i], w, holes.h[i], color,
+                                  stroke_dasharray=dasharray))
+            if len(buf) >= self.SVG_CHUNK_HOLES:
+                yield ''.join(buf)
+                buf.clear()
+
+        for key, buf in bufs.items():
+            if not buf:
+                continue
+            if compact:
+                color, dasharray = styles[key]
+                yield svg_path(buf, color, stroke_dasharray=dasharray)
+            else:
+                yield ''.join(buf)
+
+    def iter_svg(self, color='#0000FF', hole_color='#FF0000',
+                 line_width=DEF_LINE_WIDTH, stroke_dasharray='none',
+                 compact=True, precision=DEF_PRECISION):
+        """ generate SVG chunk by chunk
 
         Parameters
         ----------
@@ -193,11 +647,15 @@ class RollBook:
         hole_color: str
         line_width: float
         stroke_dasharray: str
+        compact: bool
+            merge holes of the same style into a few `<path>`
+        precision: int
+            digits after the decimal point (compact only)
 
-        Returns
-        -------
+        Yields
+        ------
         svg: str
-            SVG data
+            a chunk of SVG data
         """
         svg = '<svg xmlns="http://www.w3.org/2000/svg"'
         svg += ' width="%.2fmm" height="%.2fmm"' % (
@@ -209,49 +667,369 @@ class RollBook:
         svg += svg_square(0, 0, self._width, self._height,
                           color, line_width,
                           stroke_dasharray=stroke_dasharray)
+        yield svg
 
-        for hi in self._holes:
-            if hi.scale < 0:
-                s1 = hi.svg(color='#000000', stroke_dasharray='3 1')
-            else:
-                s1 = hi.svg(color=hole_color)
+        yield from self._iter_holes_svg(range(len(self._holes)),
+                                        hole_color, compact=compact,
+                                        precision=precision)
+
+        # yield '</g>\n'
+        yield '</svg>\n'
+
+    def write_svg(self, f, color='#0000FF', hole_color='#FF0000',
+                  line_width=DEF_LINE_WIDTH, stroke_dasharray='none',
+                  compact=True, precision=DEF_PRECISION):
+        """ write SVG to file
+
+        Parameters
+        ----------
+        f: file object
+            (text mode)
+        color: str
+        hole_color: str
+        line_width: float
+        stroke_dasharray: str
+        compact: bool
+        precision: int
+            see `iter_svg()`
+        """
+        self._write(f, self.iter_svg(color, hole_color, line_width,
+                                     stroke_dasharray, compact, precision))
+
+    def _write(self, f, chunks):
+        """ write SVG chunks to file, measuring serialization (svg)
+        and file output (write) separately
+
+        Parameters
+        ----------
+        f: file object
+        chunks: iterator of str
+        """
+        svg_sec = write_sec = 0.0
+        n_bytes = 0
 
-            svg += s1
+        start = time.perf_counter()
+        for svg in chunks:
+            mid = time.perf_counter()
+            f.write(svg)
+            end = time.perf_counter()
+            svg_sec += mid - start
+            write_sec += end - mid
+            n_bytes += len(svg)
+            start = end
+        svg_sec += time.perf_counter() - start
 
-        # svg += '</g>\n'
-        svg += '</svg>\n'
+        self.stats.add('svg', svg_sec)
+        self.stats.add('write', write_sec)
+        self.stats.count('svg_bytes', n_bytes)
+
+    def svg(self, color='#0000FF', hole_color='#FF0000',
+            line_width=DEF_LINE_WIDTH, stroke_dasharray='none',
+            compact=True, precision=DEF_PRECISION):
+        """ generate SVG
+
+        Parameters
+        ----------
+        color: str
+        hole_color: str
+        line_width: float
+        stroke_dasharray: str
+        compact: bool
+        precision: int
+            see `iter_svg()`
+
+        Returns
+        -------
+        svg: str
+            SVG data
+        """
+        with self.stats.timer('svg'):
+            svg = ''.join(self.iter_svg(color, hole_color, line_width,
+                                        stroke_dasharray, compact,
+                                        precision))
+        self.stats.count('svg_bytes', len(svg))
         return svg
 
-    def parse(self, midi_file, channel=[]):
+    def n_pages(self, page_len) -> int:
+        """ number of pages
+
+        Parameters
+        ----------
+        page_len: float
+            page length in mm
+        """
+        return max(math.ceil(self._width / page_len), 1)
+
+    def iter_page_svg(self, page, page_len,
+                      color='#0000FF', hole_color='#FF0000',
+                      line_width=DEF_LINE_WIDTH, stroke_dasharray='none',
+                      compact=True, precision=DEF_PRECISION):
+        """ generate SVG of a page chunk by chunk
+
+        The roll is cut into pages of `page_len`.
+        Only the holes on the page are rendered.
+        Holes crossing a page edge are clipped at the edge,
+        and continue on the next page.
+        Registration marks are drawn on both edges.
+
+        Parameters
+        ----------
+        page: int
+            page number (0 ..)
+        page_len: float
+            page length in mm
+        color: str
+        hole_color: str
+        line_width: float
+        stroke_dasharray: str
+        compact: bool
+        precision: int
+            see `iter_svg()`
+
+        Yields
+        ------
+        svg: str
+            a chunk of SVG data
+        """
+        x0 = page * page_len
+        width = min(page_len, self._width - x0)
+        height = self._height
+
+        svg = '<svg xmlns="http://www.w3.org/2000/svg"'
+        svg += ' width="%.2fmm" height="%.2fmm"' % (width, height)
+        svg += ' viewBox="%s %s %s %s">\n' % (-width, -height, width, height)
+
+        svg += svg_square(0, 0, width, height,
+                          color, line_width,
+                          stroke_dasharray=stroke_dasharray)
+
+        mark_len = self._model.margin / 2
+        for x in (0, width):
+            for y in (0, height - mark_len):
+                svg += '<path style="fill:none;stroke:%s;' % (color)
+                svg += 'stroke-width:%s"' % (line_width)
+                svg += ' d="M %.2f %.2f v %.2f" />\n' % (-x, -y, -mark_len)
+        svg += '<text x="%.2f" y="%.2f" font-size="%.2f"' % (
+            -width + mark_len, -height + mark_len * 2, mark_len * 2)
+        svg += ' fill="%s">%d</text>\n' % (color, page + 1)
+        yield svg
+
+        yield from self._iter_holes_svg(self.index.query(x0, x0 + width),
+                                        hole_color, x0, width,
+                                        compact, precision)
+
+        yield '</svg>\n'
+
+    def iter_window_svg(self, x0, x1, resolution=0,
+                        color='#0000FF', hole_color='#FF0000',
+                        line_width=DEF_LINE_WIDTH, compact=True,
+                        precision=DEF_PRECISION):
+        """ generate SVG of a window [x0, x1) of the roll (a tile of
+        a viewer) chunk by chunk
+
+        Only the holes in the window are rendered (see `HoleIndex`),
+        clipped at the edges of the window.
+        Unlike pages, the edges are not drawn,
+        except the ends of the roll, so that tiles are seamless.
+
+        Parameters
+        ----------
+        x0, x1: float
+            window in mm
+        resolution: float
+            level of detail (see `HoleTable.simplify()`)
+            (0: every hole)
+        color: str
+        hole_color: str
+        line_width: float
+        compact: bool
+        precision: int
+            see `iter_svg()`
+
+        Yields
+        ------
+        svg: str
+            a chunk of SVG data
         """
+        width = min(x1, self._width) - x0
+        height = self._height
+
+        svg = '<svg xmlns="http://www.w3.org/2000/svg"'
+        svg += ' width="%.2fmm" height="%.2fmm"' % (width, height)
+        svg += ' viewBox="%s %s %s %s">\n' % (-width, -height, width, height)
+
+        d = 'M 0 0 h %.2f M 0 %.2f h %.2f' % (-width, -height, -width)
+        for x, end in ((0, x0), (width, x1)):
+            if end <= 0 or end >= self._width:
+                d += ' M %.2f 0 v %.2f' % (-x, -height)
+        svg += '<path style="fill:none;stroke:%s;' % (color)
+        svg += 'stroke-width:%s" d="%s" />\n' % (line_width, d)
+        yield svg
+
+        rows = self.index.query(x0, x0 + width)
+        holes = None
+        if resolution > 0:
+            holes = self._holes.simplify(rows, resolution, self._model)
+            rows = range(len(holes))
+
+        yield from self._iter_holes_svg(rows, hole_color, x0, width,
+                                        compact, precision, holes)
+
+        yield '</svg>\n'
+
+    def write_window_svg(self, f, x0, x1, **kwargs):
+        """ write SVG of a window of the roll to file
+
+        Parameters
+        ----------
+        f: file object
+            (text mode)
+        x0, x1: float
+            window in mm
+        kwargs:
+            see `iter_window_svg()`
+        """
+        self._write(f, self.iter_window_svg(x0, x1, **kwargs))
+
+    def write_page_svg(self, f, page, page_len, **kwargs):
+        """ write SVG of a page to file
+
+        Parameters
+        ----------
+        f: file object
+            (text mode)
+        page: int
+            page number (0 ..)
+        page_len: float
+            page length in mm
+        kwargs:
+            see `iter_page_svg()`
+        """
+        self._write(f, self.iter_page_svg(page, page_len, **kwargs))
+
+    def load(self, midi_file, channel=[]) -> HoleTable:
+        """ parse MIDI file and layout holes
+
         Parameters
         ----------
         midi_file: str
-            MIDI file name
+            MIDI file name, or note file name (see `notes`)
+            (no MIDI decoding)
         channel: list of int
             selected MIDI channel ([]: all)
 
         Returns
         -------
-        svg: str
-            SVG data (text)
+        holes: HoleTable
         """
         self._log.debug('midi_file=%s', midi_file)
+        self.stats = StageStats()
+
+        with self.stats.timer('parse'):
+            if is_note_file(midi_file):
+                notes = load_notes(midi_file).select(channel)
+            elif self._note_cache is not None:
+                notes = self._note_cache.get(midi_file, channel)
+            else:
+                if self._midi_parser is None:
+                    # midilib: only to decode MIDI files
+                    from midilib import Parser
+                    self._midi_parser = Parser(debug=self._dbg)
+
+                midi = self._midi_parser.parse(midi_file, channel)
+                self._log.debug('midi[channel_set]=%s',
+                                midi['channel_set'])
+                notes = NoteStream.from_note_info(midi['note_info'])
+
+        return self.layout_notes(notes)
+
+    def layout(self, note_info) -> HoleTable:
+        """ layout holes
+
+        Holes are coalesced into slots with bridges
+        (see `HoleTable.coalesce()`).
+
+        Parameters
+        ----------
+        note_info: list of midilib.NoteInfo
+            parsed notes
+
+        Returns
+        -------
+        holes: HoleTable
+        """
+        return self.layout_notes(NoteStream.from_note_info(note_info))
 
-        midi = self._midi_parser.parse(midi_file, channel)
-        self._log.debug('midi[channel_set]=%s', midi['channel_set'])
+    def layout_notes(self, notes) -> HoleTable:
+        """ layout holes of note stream
 
-        for ni in midi['note_info']:
-            hi = HoleInfo(ni, self._conf, debug=self._dbg)
-            self._log.debug('hi=%s', hi)
+        Parameters
+        ----------
+        notes: notes.NoteStream
+
+        Returns
+        -------
+        holes: HoleTable
+        """
+        with self.stats.timer('layout'):
+            self._notes = notes
+            self.transposition = None
+            if self._model.transpose or self._model.fold_channels:
+                notes, self.transposition = transpose(
+                    notes, self._model, self._model.transpose,
+                    self._model.fold_channels)
+                self._log.debug('transposition=%s', self.transposition)
+            holes = HoleTable.from_stream(notes, self._model)
+            self._n_notes = len(holes)
+            self._holes = holes.coalesce(self._model)
+            self._index = None
+            self._width = self._holes.width
+        self.stats.count('notes', self._n_notes)
 
-            if hi:
-                self._width = max(hi.x + hi.w, self._width)
+        if self._log.isEnabledFor(DEBUG):
+            for hi in self._holes:
+                self._log.debug('hi=%s', hi)
 
-            self._holes.append(hi)
+        self._log.debug('width=%s, notes=%s, len(hole)=%s',
+                        self._width, self._n_notes, len(self._holes))
+        self._log.debug('out_of_range=%s, short_gap=%s',
+                        self._holes.n_out_of_range,
+                        self._holes.n_short_gap)
 
-        self._log.debug('width=%s, len(hole)=%s',
-                        self._width, len(self._holes))
+        return self._holes
+
+    def relayout(self, model) -> HoleTable:
+        """ layout the loaded notes again for another model
+        (e.g. tuned geometry), without parsing the MIDI file again
+
+        Parameters
+        ----------
+        model: model.Model
+
+        Returns
+        -------
+        holes: HoleTable
+        """
+        self._model = model
+        self._conf = model.conf
+        self._height = model.book_height
+        return self.layout_notes(self._notes)
+
+    def parse(self, midi_file, channel=[]):
+        """
+        Parameters
+        ----------
+        midi_file: str
+            MIDI file name
+        channel: list of int
+            selected MIDI channel ([]: all)
+
+        Returns
+        -------
+        svg: str
+            SVG data (text)
+        """
+        self.load(midi_file, channel)
 
         svg = self.svg()
         return svg
@@ -0,0 +1,154 @@
+#
+# (c) 2021 Yoichi Tanibayashi
+#
+"""
+Auto-transpose: the shift of the tune that fits the model best
+
+A pitch histogram of the tune is made once (one pass over the notes),
+and every shift in [-MAX_SHIFT, MAX_SHIFT] is scored against
+the playable notes of the model (`Model.scale_table`)
+by one correlation of two 128-entry tables.
+The cost does not depend on the number of notes.
+
+Notes of `fold_channels` still out of range after the shift
+are folded by octaves into the range of the model.
+
+Model configuration:
+    "transpose": "auto" or semitones (default: 0)
+    "fold channels": [MIDI channel, ..] (default: [])
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__ = '2021/01'
+
+from .model import MIDI_NOTES
+from .notes import NoteStream
+
+
+MAX_SHIFT = 24  # semitones
+AUTO = 'auto'
+OCTAVE = 12
+
+
+def histogram(notes) -> list:
+    """ number of notes per MIDI note number
+
+    Parameters
+    ----------
+    notes: notes.NoteStream
+    """
+    hist = [0] * MIDI_NOTES
+    for note in notes.note:
+        hist[note] += 1
+    return hist
+
+
+def playable(model) -> list:
+    """ 1: playable, 0: out of range, per MIDI note number """
+    return [int(scale >= 0) for scale in model.scale_table]
+
+
+def scores(hist, mask, max_shift=MAX_SHIFT) -> dict:
+    """ number of playable notes for each shift
+
+    Parameters
+    ----------
+    hist: list of int
+        see `histogram()`
+    mask: list of int
+        see `playable()`
+    max_shift: int
+
+    Returns
+    -------
+    scores: dict
+        shift -> number of playable notes
+    """
+    n = len(hist)
+    # pad the mask, so that every shift is a slice of it
+    padded = [0] * max_shift + mask + [0] * max_shift
+    return {shift: sum(map(int.__mul__, hist,
+                           padded[max_shift + shift:
+                                  max_shift + shift + n]))
+            for shift in range(-max_shift, max_shift + 1)}
+
+
+def best_shift(hist, mask, max_shift=MAX_SHIFT) -> int:
+    """ the shift with the most playable notes
+    (ties: the smallest shift, upward first)
+
+    Parameters
+    ----------
+    hist: list of int
+        see `histogram()`
+    mask: list of int
+        see `playable()`
+    max_shift: int
+    """
+    score = scores(hist, mask, max_shift)
+    return max(score, key=lambda s: (score[s], -abs(s), s))
+
+
+def fold(note, mask) -> int:
+    """ the nearest playable note by octaves
+    (`note` itself, if there is none) """
+    if 0 <= note < len(mask) and mask[note]:
+        return note
+
+    for octave in range(1, len(mask) // OCTAVE + 1):
+        for folded in (note + octave * OCTAVE, note - octave * OCTAVE):
+            if 0 <= folded < len(mask) and mask[folded]:
+                return folded
+    return note
+
+
+def transpose(notes, model, shift=AUTO, fold_channels=(),
+              max_shift=MAX_SHIFT) -> tuple:
+    """ transpose notes for the model
+
+    Parameters
+    ----------
+    notes: notes.NoteStream
+    model: model.Model
+    shift: int or str
+        semitones, or 'auto' (see `best_shift()`)
+    fold_channels: list of int
+        MIDI channels folded by octaves into the range
+
+    Returns
+    -------
+    notes: notes.NoteStream
+        `notes` itself, if nothing is changed
+    info: dict
+        'shift': semitones, 'folded': number of folded notes,
+        'fit_before', 'fit_after': number of playable notes,
+        'recovered': fit_after - fit_before
+    """
+    mask = playable(model)
+    hist = histogram(notes)
+    if shift == AUTO:
+        shift = best_shift(hist, mask, max_shift)
+    fit_before = sum(map(int.__mul__, hist, mask))
+    if not shift and not fold_channels:
+        return notes, {'shift': 0, 'folded': 0, 'fit_before': fit_before,
+                       'fit_after': fit_before, 'recovered': 0}
+
+    fold_channels = set(fold_channels)
+    new_note = []
+    n_folded = 0
+    for note, ch in zip(notes.note, notes.channel):
+        note = min(max(note + shift, 0), MIDI_NOTES - 1)
+        if ch in fold_channels and not mask[note]:
+            folded = fold(note, mask)
+            n_folded += folded != note
+            note = folded
+        new_note.append(note)
+
+    fit_after = sum([mask[note] for note in new_note])
+    info = {'shift': shift, 'folded': n_folded,
+            'fit_before': fit_before, 'fit_after': fit_after,
+            'recovered': fit_after - fit_before}
+
+    if not shift and not n_folded:
+        return notes, info
+    return NoteStream(new_note, notes.channel, notes.start_sec,
+                      notes.sec), info
@@ -3,36 +3,113 @@
 #
 """
 Web Interface
+
+Development mode (`processes=None`):
+    one process with autoreload.
+Production mode (`processes=N`):
+    no autoreload; the listening socket is bound once, and
+    N pre-forked server processes accept connections on it.
+    The parent process supervises them (restarts crashed ones)
+    and forwards SIGTERM/SIGINT to them.
+    Each server process has its own RenderPool (with its share of
+    the workers) and JobScheduler.
+    Output directories are shared: all files are written atomically
+    (see fileutil), and job status files are shared in `workdir/jobs`.
+
+Metrics are served at `{prefix}/metrics` in Prometheus text format.
+In production mode, each server process dumps its metrics to
+`workdir/metrics` every `METRICS_DUMP_SEC`, and they are summed up.
+
+Parsed notes of uploaded MIDI files are cached in `workdir/notes`,
+so that `{prefix}/api/render` re-renders a roll with overridden
+model geometry without parsing the MIDI file again.
+
+Conversions of Handler1 can be profiled (`profile_sample`,
+`profile_token`): profiles are written to `workdir/profile`.
+
+On SIGTERM/SIGINT, a server process stops accepting connections,
+waits for running conversions (at most `GRACE_SEC`) and exits.
 """
 __author__ = 'Yoichi Tanibayashi'
 __date__ = '2021/01'
 
 import os
+import time
+import signal
+import asyncio
 import tornado.ioloop
 import tornado.httpserver
+import tornado.netutil
+import tornado.process
 import tornado.web
-from .handler1 import Handler1, Download
+from .handler1 import Handler1, Download, Page, Render, Tile
+from .handler1 import Bundle, Channels
+from .handler1 import Metrics
+from .jobapi import JobSubmit, JobStatus, JobResult
+from .jobs import JobScheduler
+from .rollbook import RollBook
+from .model import get_registry
+from .worker import RenderPool
+from .cache import RenderCache
+from . import metrics
+from . import defaults
 from .my_logger import get_logger
 
 
+class Application(tornado.web.Application):
+    """
+    Application counting requests (see `metrics`)
+    """
+    def log_request(self, handler):
+        """ log and count a request """
+        super().log_request(handler)
+
+        name = type(handler).__name__
+        metrics.REQUESTS.inc(handler=name, method=handler.request.method,
+                             code=handler.get_status())
+        metrics.REQUEST_SECONDS.observe(handler.request.request_time(),
+                                        handler=name)
+
+
 class WebServer:
     """
     Web application server
     """
-    DEF_PORT = 10081
+    DEF_PORT = defaults.DEF_PORT
 
-    DEF_WEBROOT = './webroot'
+    DEF_WEBROOT = defaults.DEF_WEBROOT
     URL_PREFIX = '/storgan'
     URL_PREFIX_HANDLER1 = URL_PREFIX + '/handler1'
 
-    DEF_WORKDIR = '/tmp/storgan'
+    DEF_WORKDIR = defaults.DEF_WORKDIR
+
+    DEF_SIZE_LIMIT = defaults.DEF_SIZE_LIMIT
+
+    # request bodies of uploads are streamed (see Handler1),
+    # so the buffer of a connection can be small
+    MAX_BUFFER_SIZE = 1024 * 1024  # 1MB
 
-    DEF_SIZE_LIMIT = 100*1024*1024  # 100MB
+    UPLOAD_DIR = 'upload'
+    JOB_DIR = 'jobs'
+    METRICS_DIR = 'metrics'
+    PROFILE_DIR = 'profile'
+    NOTE_DIR = 'notes'
+
+    METRICS_DUMP_SEC = 10
+
+    GRACE_SEC = 30  # max time to wait for running conversions on shutdown
+    DRAIN_SEC = 1  # time to send responses on shutdown
+    MAX_RESTARTS = 100  # max restarts of crashed server processes
 
     def __init__(self, port=DEF_PORT,
                  webroot=DEF_WEBROOT, workdir=DEF_WORKDIR,
                  size_limit=DEF_SIZE_LIMIT,
                  version='current',
+                 conf_file=RollBook.DEF_CONF_FILE,
+                 workers=RenderPool.DEF_WORKERS,
+                 max_pending=RenderPool.DEF_MAX_PENDING,
+                 max_per_client=JobScheduler.DEF_MAX_PER_CLIENT,
+                 processes=None, profile_sample=0, profile_token=None,
                  debug=False):
         """ Constructor
 
@@ -48,36 +125,130 @@ class WebServer:
             max upload size
         version: str
             version string
+        conf_file: str
+            configuration file
+        workers: int
+            number of conversion workers
+            (total of all server processes, at least one per process)
+        max_pending: int
+            max number of running and queued conversions
+        max_per_client: int
+            max number of running conversion jobs per client
+        processes: int
+            number of server processes (production mode)
+            0: number of CPUs, None: development mode (autoreload)
+        profile_sample: int
+            profile one in `profile_sample` conversions (0: never)
+        profile_token: str
+            profile conversions requested with this token
+            (see `Handler1.want_profile()`)
         """
         self._dbg = debug
         self._log = get_logger(self.__class__.__name__, self._dbg)
         self._log.info('port=%s, webroot=%s, workdir=%s, size_limit=%s',
                        port, webroot, workdir, size_limit)
         self._log.info('version=%s', version)
+        self._log.info('conf_file=%s', conf_file)
+        self._log.info('workers=%s, max_pending=%s, max_per_client=%s',
+                       workers, max_pending, max_per_client)
+        self._log.info('processes=%s', processes)
+        self._log.info('profile_sample=%s, profile_token=%s',
+                       profile_sample, '***' if profile_token else None)
 
         self._port = port
         self._webroot = webroot
         self._workdir = workdir
         self._size_limit = size_limit
         self._version = version
+        self._processes = processes
+
+        # number of server processes
+        self._n_proc = 1
+        if processes is not None:
+            self._n_proc = processes or tornado.process.cpu_count()
+        workers = max(workers // self._n_proc, 1)
+        self._log.info('workers per process=%s', workers)
+
+        self._model_registry = get_registry(conf_file, debug=self._dbg)
+        self._log.info('models=%s', self._model_registry.names())
+
+        self._render_pool = RenderPool(workers, max_pending, server=True,
+                                       debug=self._dbg)
 
         try:
             os.makedirs(self._workdir, exist_ok=True)
         except Exception as ex:
             raise ex
 
-        self._app = tornado.web.Application(
+        self._upload_dir = os.path.join(self._workdir, self.UPLOAD_DIR)
+        os.makedirs(self._upload_dir, exist_ok=True)
+        for ent in os.scandir(self._upload_dir):
+            # left by a killed server
+            if ent.is_file() and ent.name.startswith('.upload-'):
+                os.remove(ent.path)
+
+        self._render_cache = RenderCache(
+            os.path.join(self._workdir, 'cache'), debug=self._dbg)
+
+        self._note_dir = os.path.join(self._workdir, self.NOTE_DIR)
+
+        self._metrics_dir = None
+        if processes is not None:
+            self._metrics_dir = os.path.join(self._workdir,
+                                             self.METRICS_DIR)
+            os.makedirs(self._metrics_dir, exist_ok=True)
+            for ent in os.scandir(self._metrics_dir):
+                # left by the previous server
+                os.remove(ent.path)
+
+        self._job_scheduler = JobScheduler(
+            self._render_pool, self._render_cache,
+            self._model_registry.conf_file, max_per_client,
+            job_dir=os.path.join(self._workdir, self.JOB_DIR),
+            note_dir=self._note_dir,
+            profile_dir=os.path.join(self._workdir, self.PROFILE_DIR),
+            debug=self._dbg)
+
+        metrics.REGISTRY.gauge(
+            'storgan_jobs_queued', 'number of queued conversion jobs',
+            func=lambda: self._job_scheduler.n_queued)
+        metrics.REGISTRY.gauge(
+            'storgan_jobs_running', 'number of running conversion jobs',
+            func=lambda: self._job_scheduler.n_running)
+        metrics.REGISTRY.gauge(
+            'storgan_render_pending',
+            'number of running and queued conversions in the worker pool',
+            func=lambda: self._render_pool.pending)
+
+        self._app = Application(
             [
                 (r'/', Handler1),
                 (r'%s' % self.URL_PREFIX, Handler1),
                 (r'%s/' % self.URL_PREFIX, Handler1),
                 (r'%s.*' % self.URL_PREFIX_HANDLER1, Handler1),
-                (r'%s/download/.*' % self.URL_PREFIX, Download),
+                (r'%s/download/([0-9a-f]{64}\.svgz?)' % self.URL_PREFIX,
+                 Download, {'path': self._render_cache.cache_dir}),
+                (r'%s/page/([0-9a-f]{64})\.svg' % self.URL_PREFIX, Page),
+                (r'%s/api/render/([0-9a-f]{64})\.svg' % self.URL_PREFIX,
+                 Render),
+                (r'%s/api/tile/([0-9a-f]{64})\.svg' % self.URL_PREFIX,
+                 Tile),
+                (r'%s/api/bundle/([0-9a-f]{64})\.zip' % self.URL_PREFIX,
+                 Bundle),
+                (r'%s/api/channels/([0-9a-f]{64})\.zip' % self.URL_PREFIX,
+                 Channels),
+                (r'%s/api/jobs' % self.URL_PREFIX, JobSubmit),
+                (r'%s/api/jobs/([0-9a-f]{32})' % self.URL_PREFIX,
+                 JobStatus),
+                (r'%s/api/jobs/([0-9a-f]{32})/result' % self.URL_PREFIX,
+                 JobResult),
+                (r'%s/metrics' % self.URL_PREFIX, Metrics),
             ],
             static_path=os.path.join(self._webroot, "static"),
             static_url_prefix=self.URL_PREFIX + '/static/',
             template_path=os.path.join(self._webroot, "templates"),
-            autoreload=True,
+            # autoreload cannot be used with forked processes
+            autoreload=processes is None,
             # xsrf_cookies=False,
 
             # url_prefix_handler1=self.URL_PREFIX_HANDLER1,
@@ -85,24 +256,144 @@ class WebServer:
 
             webroot=self._webroot,
             workdir=self._workdir,
+            upload_dir=self._upload_dir,
+            note_dir=self._note_dir,
             size_limit=self._size_limit,
             version=self._version,
+            render_pool=self._render_pool,
+            render_cache=self._render_cache,
+            job_scheduler=self._job_scheduler,
+            model_registry=self._model_registry,
+            metrics_dir=self._metrics_dir,
+            profile_sample=profile_sample,
+            profile_token=profile_token,
 
             debug=self._dbg
         )
         self._log.debug('app=%s', self._app.__dict__)
 
         self._svr = tornado.httpserver.HTTPServer(
-            self._app, max_buffer_size=self._size_limit)
+            self._app, max_buffer_size=self.MAX_BUFFER_SIZE,
+            max_body_size=self._size_limit)
         self._log.debug('svr=%s', self._svr.__dict__)
 
     def main(self):
         """ main """
         self._log.debug('')
 
-        self._svr.listen(self._port)
+        if self._processes is None:
+            self._svr.listen(self._port)
+        else:
+            sockets = tornado.netutil.bind_sockets(self._port)
+            if not self._prefork(self._n_proc):
+                # parent process: all server processes have exited
+                self._log.debug('done')
+                return
+            self._svr.add_sockets(sockets)
+            self._dump_metrics()
+            tornado.ioloop.PeriodicCallback(
+                self._dump_metrics, self.METRICS_DUMP_SEC * 1000).start()
+
         self._log.info('start server: run forever ..')
 
-        tornado.ioloop.IOLoop.current().start()
+        loop = tornado.ioloop.IOLoop.current()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.asyncio_loop.add_signal_handler(
+                signum, lambda: asyncio.ensure_future(self._shutdown()))
+
+        try:
+            loop.start()
+        finally:
+            self._render_pool.shutdown()
 
         self._log.debug('done')
+
+    def _prefork(self, n_proc) -> bool:
+        """ fork server processes and supervise them
+
+        Parameters
+        ----------
+        n_proc: int
+            number of server processes
+
+        Returns
+        -------
+        is_child: bool
+            True: in a server process,
+            False: in the parent process, after all server processes
+            have exited
+        """
+        self._log.info('fork %s server processes', n_proc)
+
+        children = {}  # pid -> process number
+        stopping = False
+
+        def fork(i) -> bool:
+            pid = os.fork()
+            if pid == 0:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                return True
+            children[pid] = i
+            return False
+
+        def stop(signum, _frame):
+            nonlocal stopping
+            stopping = True
+            for pid in children:
+                os.kill(pid, signum)
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        for i in range(n_proc):
+            if fork(i):
+                return True
+
+        n_restarts = 0
+        while children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+
+            i = children.pop(pid, None)
+            if i is None:
+                continue
+
+            if os.WIFSIGNALED(status):
+                code = -os.WTERMSIG(status)
+            else:
+                code = os.WEXITSTATUS(status)
+            self._log.info('process %s (pid=%s) exited: %s', i, pid, code)
+            if stopping or code == 0:
+                continue
+
+            n_restarts += 1
+            if n_restarts > self.MAX_RESTARTS:
+                self._log.error('too many restarts')
+                stop(signal.SIGTERM, None)
+                continue
+
+            if fork(i):
+                return True
+
+        return False
+
+    def _dump_metrics(self):
+        """ dump metrics of this process (production mode) """
+        metrics.REGISTRY.dump(metrics.dump_path(self._metrics_dir))
+
+    async def _shutdown(self):
+        """ graceful shutdown """
+        self._log.info('shutdown ..')
+        self._svr.stop()
+
+        deadline = time.monotonic() + self.GRACE_SEC
+        while (self._render_pool.pending or self._job_scheduler.n_queued) \
+                and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+
+        # let handlers send the results
+        await asyncio.sleep(self.DRAIN_SEC)
+        tornado.ioloop.IOLoop.current().stop()
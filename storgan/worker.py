@@ -0,0 +1,509 @@
+#
+# (c) 2021 Yoichi Tanibayashi
+#
+"""
+Worker pool for RollBook conversion
+
+MIDI parsing and SVG generation are CPU bound.
+They are executed in a bounded pool of worker processes
+(or threads, if processes are not available),
+so that the Tornado IOLoop is never blocked.
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__ = '2021/01'
+
+import os
+import time
+import signal
+import shutil
+import asyncio
+import threading
+import concurrent.futures
+from collections import OrderedDict
+from concurrent.futures.process import BrokenProcessPool
+from .rollbook import RollBook, DEF_PRECISION
+from .metrics import StageStats
+from .cache import RenderCache
+from .model import get_registry
+from .notes import get_note_cache
+from .fileutil import atomic_open, atomic_open_svg, file_hash, SVGZ_SUFFIX
+from . import profiler
+from .my_logger import get_logger
+
+
+class QueueFull(Exception):
+    """ too many pending jobs """
+
+
+def new_rollbook(model, conf_file, overrides=None, note_dir=None,
+                 debug=False) -> RollBook:
+    """ RollBook for worker functions
+
+    Parameters
+    ----------
+    model: str
+        Model Name
+    conf_file: str
+        configuration file
+    overrides: dict
+        configuration entries replaced (see `model.Model.replace()`)
+    note_dir: str
+        directory of the note cache (None: no note cache)
+    """
+    model = get_registry(conf_file, debug=debug).get(model)
+    note_cache = None
+    if note_dir is not None:
+        note_cache = get_note_cache(note_dir, debug=debug)
+
+    return RollBook(model.replace(overrides), conf_file,
+                    note_cache=note_cache, debug=debug)
+
+
+_ROLLBOOKS = OrderedDict()
+_ROLLBOOKS_LOCK = threading.Lock()
+ROLLBOOK_CACHE_SIZE = 4  # laid out rolls per process
+
+
+def load_rollbook(midi_file, model, conf_file, channel=(), overrides=None,
+                  note_dir=None, debug=False) -> RollBook:
+    """ RollBook with the holes laid out, kept in a small LRU per process
+
+    Pages and tiles of a roll are requested one by one.
+    The layout is computed once for all of them.
+
+    Parameters
+    ----------
+    see `new_rollbook()`
+    midi_file: str
+        MIDI file name
+    channel: list of int
+        selected MIDI channel ([]: all)
+    """
+    rollbook = new_rollbook(model, conf_file, overrides, note_dir, debug)
+    st = os.stat(midi_file)
+    key = (midi_file, st.st_mtime_ns, st.st_size, rollbook.model.name,
+           rollbook.model.fingerprint, tuple(channel))
+
+    with _ROLLBOOKS_LOCK:
+        cached = _ROLLBOOKS.get(key)
+        if cached is not None:
+            _ROLLBOOKS.move_to_end(key)
+            cached.stats = StageStats()
+            return cached
+
+    rollbook.load(midi_file, list(channel))
+    with _ROLLBOOKS_LOCK:
+        _ROLLBOOKS[key] = rollbook
+        while len(_ROLLBOOKS) > ROLLBOOK_CACHE_SIZE:
+            _ROLLBOOKS.popitem(last=False)
+    return rollbook
+
+
+def render_svg(midi_file, svg_file, model, conf_file, channel=(),
+               note_dir=None, overrides=None, profile_dir=None,
+               debug=False) -> dict:
+    """ convert MIDI file to SVG file
+
+    This function is executed in a worker process (or thread).
+    SVG data is streamed to `svg_file`, and never held as a whole.
+
+    Parameters
+    ----------
+    midi_file: str
+        MIDI file name
+    svg_file: str
+        output SVG file name
+    model: str
+        Model Name
+    conf_file: str
+        configuration file
+    channel: list of int
+        selected MIDI channel ([]: all)
+    note_dir: str
+        directory of the note cache (None: no note cache)
+    overrides: dict
+        configuration entries replaced (see `model.Model.replace()`)
+    profile_dir: str
+        run under cProfile, and write the dump to
+        '{profile_dir}/{MIDI file name}-{notes}notes-{time}.prof'
+        (None: no profiling)
+
+    Returns
+    -------
+    result: dict
+        'notes': number of notes, 'holes': number of holes (slots),
+        'out_of_range': number of notes out of the range of the model,
+        'transpose': see `RollBook.transposition`,
+        'short_gap': number of holes after a too short gap,
+        'width': roll length in mm,
+        'stats': elapsed time per stage (see `metrics.StageStats`),
+        'profile': file name of the profile (profiling only)
+    """
+    rollbook = new_rollbook(model, conf_file, overrides, note_dir, debug)
+    if profile_dir is None:
+        return _render_svg(rollbook, midi_file, svg_file, channel)
+
+    result, prof = profiler.profile(_render_svg, rollbook, midi_file,
+                                    svg_file, channel)
+
+    # MIDI files of the web server are named by hash
+    name = os.path.splitext(os.path.basename(midi_file))[0]
+    result['profile'] = '%s-%dnotes-%s.prof' % (
+        name, result['notes'], time.strftime('%Y%m%d-%H%M%S'))
+    profiler.dump(prof, os.path.join(profile_dir, result['profile']))
+    return result
+
+
+def _render_svg(rollbook, midi_file, svg_file, channel):
+    """ see `render_svg()` """
+    holes = rollbook.load(midi_file, list(channel))
+
+    with atomic_open(svg_file) as f:
+        rollbook.write_svg(f)
+
+    return {'notes': rollbook.n_notes, 'holes': len(holes),
+            'out_of_range': holes.n_out_of_range,
+            'transpose': rollbook.transposition,
+            'short_gap': holes.n_short_gap, 'width': rollbook.width,
+            'stats': rollbook.stats.as_dict()}
+
+
+def render_page(midi_file, svg_file, model, conf_file, channel,
+                page, page_len, note_dir=None, overrides=None,
+                debug=False) -> dict:
+    """ render a page of the roll to SVG file
+
+    Pages are independent of each other,
+    and can be rendered in parallel.
+
+    Parameters
+    ----------
+    midi_file: str
+        MIDI file name
+    svg_file: str
+        output SVG file name
+    model: str
+        Model Name
+    conf_file: str
+        configuration file
+    channel: list of int
+        selected MIDI channel ([]: all)
+    page: int
+        page number (0 ..)
+    page_len: float
+        page length in mm
+    note_dir: str
+        directory of the note cache (None: no note cache)
+    overrides: dict
+        configuration entries replaced (see `model.Model.replace()`)
+
+    Returns
+    -------
+    result: dict
+        'page': page number, 'pages': number of pages,
+        'stats': elapsed time per stage (see `metrics.StageStats`)
+    """
+    rollbook = load_rollbook(midi_file, model, conf_file, channel,
+                             overrides, note_dir, debug)
+
+    n_pages = rollbook.n_pages(page_len)
+    if page >= n_pages:
+        raise IndexError('page %s >= %s' % (page, n_pages))
+
+    with atomic_open(svg_file) as f:
+        rollbook.write_page_svg(f, page, page_len)
+
+    return {'page': page, 'pages': n_pages,
+            'stats': rollbook.stats.as_dict()}
+
+
+def render_tile(midi_file, svg_file, model, conf_file, channel,
+                t0, t1, resolution=0, note_dir=None, overrides=None,
+                debug=False) -> dict:
+    """ render a time range of the roll (a tile of the viewer)
+    to SVG file
+
+    Parameters
+    ----------
+    midi_file: str
+        MIDI file name
+    svg_file: str
+        output SVG file name
+    model: str
+        Model Name
+    conf_file: str
+        configuration file
+    channel: list of int
+        selected MIDI channel ([]: all)
+    t0, t1: float
+        time range in sec
+    resolution: float
+        level of detail in mm (see `RollBook.iter_window_svg()`)
+    note_dir: str
+        directory of the note cache (None: no note cache)
+    overrides: dict
+        configuration entries replaced (see `model.Model.replace()`)
+
+    Returns
+    -------
+    result: dict
+        'width': roll length in mm,
+        'stats': elapsed time per stage (see `metrics.StageStats`)
+
+    Raises
+    ------
+    IndexError
+        `t0` is after the end of the roll
+    """
+    rollbook = load_rollbook(midi_file, model, conf_file, channel,
+                             overrides, note_dir, debug)
+
+    sec_len = rollbook.model.sec_len
+    x0, x1 = t0 * sec_len, t1 * sec_len
+    if x0 >= rollbook.width > 0:
+        raise IndexError('t0 %s: after the end' % (t0))
+
+    with atomic_open(svg_file) as f:
+        rollbook.write_window_svg(f, x0, x1, resolution=resolution)
+
+    return {'width': rollbook.width, 'stats': rollbook.stats.as_dict()}
+
+
+_CACHE = {}
+NOTE_DIR = 'notes'  # note cache in render cache directory
+
+
+def convert_file(midi_file, out_file, model, conf_file, channel=(),
+                 cache_dir=None, page_len=None, precision=DEF_PRECISION,
+                 overrides=None, debug=False) -> dict:
+    """ convert MIDI file to SVG file, using render cache (optional)
+
+    This function may be executed in a worker process.
+    Models and caches are loaded once per process.
+
+    Parameters
+    ----------
+    midi_file: str
+        MIDI file name
+    out_file: str
+        output SVG file name
+        ('.svgz': gzip-compressed)
+    model: str
+        Model Name
+    conf_file: str
+        configuration file
+    channel: list of int
+        selected MIDI channel ([]: all)
+    cache_dir: str
+        render cache directory (None: no cache)
+        parsed notes are cached in '{cache_dir}/notes'
+    page_len: float
+        page length in mm (None: model default, 0: no paging)
+        pages are written to `out_file` with suffix '.p001.svg' ..,
+        and not cached
+    precision: int
+        digits after the decimal point of coordinates
+    overrides: dict
+        configuration entries replaced (see `model.Model.replace()`)
+
+    Returns
+    -------
+    result: dict
+        'notes': number of notes (None: cache hit),
+        'sec': elapsed time,
+        'stats': elapsed time per stage (see `metrics.StageStats`)
+    """
+    start = time.perf_counter()
+    note_dir = os.path.join(cache_dir, NOTE_DIR) if cache_dir else None
+    rollbook = new_rollbook(model, conf_file, overrides, note_dir, debug)
+
+    if page_len is None:
+        page_len = rollbook.model.page_len
+
+    if page_len:
+        rollbook.load(midi_file, list(channel))
+
+        out_base, suffix = os.path.splitext(out_file)
+        if suffix not in ('.svg', SVGZ_SUFFIX):
+            out_base, suffix = out_file, '.svg'
+
+        n_pages = rollbook.n_pages(page_len)
+        for page in range(n_pages):
+            with atomic_open_svg('%s.p%03d%s' % (
+                    out_base, page + 1, suffix)) as f:
+                rollbook.write_page_svg(f, page, page_len,
+                                        precision=precision)
+
+        return {'notes': rollbook.n_notes, 'pages': n_pages,
+                'sec': time.perf_counter() - start,
+                'stats': rollbook.stats.as_dict()}
+
+    if not cache_dir:
+        rollbook.load(midi_file, list(channel))
+        with atomic_open_svg(out_file) as f:
+            rollbook.write_svg(f, precision=precision)
+
+        return {'notes': rollbook.n_notes, 'sec': time.perf_counter() - start,
+                'stats': rollbook.stats.as_dict()}
+
+    cache = _CACHE.get(cache_dir)
+    if cache is None:
+        cache = RenderCache(cache_dir, debug=debug)
+        _CACHE[cache_dir] = cache
+
+    model = rollbook.model
+    variant = '' if precision == DEF_PRECISION else \
+        'precision=%d' % (precision)
+    cache_key = RenderCache.key(file_hash(midi_file), model.name,
+                                channel, model.fingerprint, variant)
+
+    n_notes = None
+    svg_f = cache.open(cache_key)
+    if svg_f is None:
+        rollbook.load(midi_file, list(channel))
+        n_notes = rollbook.n_notes
+        with cache.writer(cache_key) as f:
+            rollbook.write_svg(f, precision=precision)
+        svg_f = cache.open(cache_key)
+
+    with rollbook.stats.timer('write'), svg_f, \
+         atomic_open_svg(out_file) as f:
+        shutil.copyfileobj(svg_f, f)
+
+    return {'notes': n_notes, 'sec': time.perf_counter() - start,
+            'stats': rollbook.stats.as_dict()}
+
+
+def ignore_signals():
+    """ initializer of worker processes of a server
+
+    Worker processes are stopped by `RenderPool.shutdown()` of the
+    server process, so that they ignore SIGTERM/SIGINT sent to
+    all processes (e.g. by boot-storgan.sh)
+    and finish running conversions.
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class RenderPool:
+    """ bounded worker pool
+
+    Workers are started lazily on the first `submit()`.
+
+    Attributes
+    ----------
+    workers: int
+        number of workers
+    max_pending: int
+        max number of running and queued jobs
+    pending: int
+        number of running and queued jobs
+    """
+    DEF_WORKERS = os.cpu_count() or 1
+    DEF_MAX_PENDING = 16
+
+    def __init__(self, workers=DEF_WORKERS, max_pending=DEF_MAX_PENDING,
+                 use_process=True, server=False, debug=False):
+        """ Constructor
+
+        Parameters
+        ----------
+        workers: int
+            number of workers
+        max_pending: int
+            max number of running and queued jobs
+        use_process: bool
+            False: use threads instead of processes
+        server: bool
+            True: worker processes ignore SIGTERM/SIGINT
+            (see `ignore_signals()`)
+        """
+        self._dbg = debug
+        self._log = get_logger(self.__class__.__name__, self._dbg)
+        self._log.debug('workers=%s, max_pending=%s, use_process=%s',
+                        workers, max_pending, use_process)
+
+        self.workers = max(workers, 1)
+        self.max_pending = max(max_pending, 1)
+        self._use_process = use_process
+        self._server = server
+
+        self.pending = 0
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _new_executor(self):
+        """ create executor
+
+        fallback to thread pool, if process pool is not available
+        """
+        if self._use_process:
+            try:
+                return concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    initializer=ignore_signals if self._server else None)
+            except (ImportError, NotImplementedError, OSError) as ex:
+                self._log.warning('%s: %s: fallback to thread pool',
+                                  type(ex).__name__, ex)
+                self._use_process = False
+
+        return concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers)
+
+    def _done(self, _future):
+        """ callback: job done """
+        with self._lock:
+            self.pending -= 1
+
+    def submit(self, func, *args, **kwargs) -> concurrent.futures.Future:
+        """ submit job
+
+        Parameters
+        ----------
+        func: callable
+            picklable (module level) function
+
+        Raises
+        ------
+        QueueFull
+        """
+        with self._lock:
+            if self.pending >= self.max_pending:
+                raise QueueFull('pending=%s' % (self.pending))
+            self.pending += 1
+
+            if self._executor is None:
+                self._executor = self._new_executor()
+
+        try:
+            try:
+                future = self._executor.submit(func, *args, **kwargs)
+            except BrokenProcessPool as ex:
+                self._log.warning('%s: restart workers',
+                                  type(ex).__name__)
+                self._executor = self._new_executor()
+                future = self._executor.submit(func, *args, **kwargs)
+        except Exception:
+            self._done(None)
+            raise
+
+        future.add_done_callback(self._done)
+        return future
+
+    async def run(self, func, *args, **kwargs):
+        """ submit job and wait for the result
+
+        Raises
+        ------
+        QueueFull
+        """
+        return await asyncio.wrap_future(self.submit(func, *args, **kwargs))
+
+    def shutdown(self, wait=True):
+        """ shutdown workers """
+        self._log.debug('wait=%s', wait)
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
@@ -0,0 +1,40 @@
+#
+# (c) 2021 Yoichi Tanibayashi
+#
+"""
+bundle summary table, with values unknown in old cache entries
+
+    $ python -m pytest tests
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__ = '2021/01'
+
+from storgan import bundle
+
+RESULT = {'notes': 200, 'out_of_range': 20, 'holes': 150,
+          'short_gap': 0, 'width': 1234.56}
+
+
+def test_models():
+    data = bundle.summary('a.mid', [], 200, ['M1', 'M2'], [RESULT, {}])
+    lines = bundle.format_summary(data).split('\n')
+
+    assert lines[0].split() == ['M1', '180/200', 'notes', 'fit,',
+                                '150', 'holes,', '1234.6', 'mm']
+    assert lines[1].split() == ['M2', '-/-', 'notes', 'fit,',
+                                '-', 'holes,', '-', 'mm']
+
+
+def test_channels():
+    channels = [{'channel': [0], 'notes': 200, 'polyphony': 3},
+                {'channel': [1], 'notes': 200, 'polyphony': None}]
+    data = bundle.channel_summary('a.mid', 'M1', channels,
+                                  [RESULT, {'notes': 10}])
+    lines = bundle.format_summary(data).split('\n')
+
+    assert lines[0].split() == ['ch00', '180/200', 'notes', 'fit',
+                                '(', '90.0%),', 'polyphony', '3,',
+                                '150', 'holes']
+    assert lines[1].split() == ['ch01', '-/10', 'notes', 'fit',
+                                '(', '-%),', 'polyphony', '-,',
+                                '-', 'holes']
@@ -0,0 +1,105 @@
+#
+# (c) 2021 Yoichi Tanibayashi
+#
+"""
+RenderCache: keys, disk eviction and atomic writing
+
+    $ python -m pytest tests
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__ = '2021/01'
+
+import os
+import pytest
+from storgan.cache import RenderCache, midi_hash
+from storgan.model import get_registry
+
+CONF_FILE = os.path.join(os.path.dirname(__file__), '..',
+                         'storgan.conf-sample')
+MIDI_DATA = b'MThd\x00\x00\x00\x06\x00\x00\x00\x01\x01\xe0'
+
+
+@pytest.fixture
+def model():
+    return get_registry(CONF_FILE).get('ModelName')
+
+
+def key(model, overrides=None, channel=(), data=MIDI_DATA):
+    if overrides:
+        model = model.replace(overrides)
+    return RenderCache.key(midi_hash(data), model.name, list(channel),
+                           model.fingerprint)
+
+
+def test_key(model):
+    assert key(model) == key(model)
+    assert key(model, {'pitch': 2.1}) == key(model, {'pitch': 2.1})
+    assert key(model, channel=[1, 0]) == key(model, channel=[0, 1, 1])
+
+    keys = {key(model), key(model, {'pitch': 2.1}),
+            key(model, {'pitch': 2.2}), key(model, channel=[0]),
+            key(model, data=MIDI_DATA + b'\x00')}
+    assert len(keys) == 5
+
+
+def test_evict(tmp_path):
+    size = 1000
+    limit = 10 * size
+    cache = RenderCache(str(tmp_path), disk_limit=limit)
+
+    for i in range(10):
+        cache.put('k%d' % i, 'x' * size)
+    assert len(os.listdir(tmp_path)) == 10
+
+    cache.get('k0')  # recently used
+    cache.put('k10', 'x' * size)
+
+    names = sorted(os.listdir(tmp_path))
+    total = sum(os.path.getsize(tmp_path / name) for name in names)
+    assert total <= limit * RenderCache.LOW_WATER
+    assert len(names) == int(limit * RenderCache.LOW_WATER) // size
+    # least recently used first
+    assert 'k0.svg' in names and 'k10.svg' in names
+    assert 'k1.svg' not in names and 'k2.svg' not in names
+    assert cache.get('k1') is None
+
+
+def test_evict_meta(tmp_path):
+    cache = RenderCache(str(tmp_path), disk_limit=1500)
+    cache.put('k0', 'x' * 1000)
+    cache.put_meta('k0', {'width': 1})
+    cache.put('k1', 'x' * 1000)
+
+    assert cache.get('k0') is None
+    assert cache.get_meta('k0') is None
+    assert sorted(os.listdir(tmp_path)) == ['k1.svg']
+
+
+def test_writer_error(tmp_path):
+    cache = RenderCache(str(tmp_path))
+
+    with pytest.raises(RuntimeError):
+        with cache.writer('k0') as f:
+            f.write('<svg')
+            raise RuntimeError('killed')
+
+    assert cache.get('k0') is None
+    assert os.listdir(tmp_path) == []
+
+
+def test_writer_killed(tmp_path):
+    cache = RenderCache(str(tmp_path))
+
+    pid = os.fork()
+    if pid == 0:
+        with cache.writer('k0') as f:
+            f.write('<svg')
+            f.flush()
+            os._exit(9)  # killed while writing
+    os.waitpid(pid, 0)
+
+    # the partial temporary file is never an entry
+    assert not os.path.exists(cache.path('k0'))
+    assert cache.get('k0') is None
+    assert RenderCache(str(tmp_path)).get('k0') is None
+    assert all(name.startswith('.') for name in os.listdir(tmp_path))
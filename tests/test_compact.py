@@ -0,0 +1,93 @@
+#
+# (c) 2021 Yoichi Tanibayashi
+#
+"""
+compact SVG (merged <path>) has the same holes as the plain SVG
+
+    $ python -m pytest tests
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__ = '2021/01'
+
+import os
+import re
+import random
+from collections import Counter
+import pytest
+from storgan.rollbook import RollBook
+
+CONF_FILE = os.path.join(os.path.dirname(__file__), '..',
+                         'storgan.conf-sample')
+PAGE_LEN = 300  # mm
+PRECISION = 2  # same as `svg_square()`
+
+PATH_RE = re.compile(r'<path style="([^"]*)"\s*d="([^"]*)"\s*/>')
+NUM = r'\s*(-?\d+(?:\.\d+)?)'
+RECT_RE = re.compile(r'M%s%s\s*h%s\s*v%s\s*h%s\s*Z' % ((NUM,) * 5))
+
+
+class NoteInfo:
+    """ parsed note (as midilib.NoteInfo, without MIDI decoding) """
+    def __init__(self, note, channel, abs_time, sec):
+        self.note = note
+        self.channel = channel
+        self.abs_time = abs_time
+        self._sec = sec
+
+    def length(self):
+        return self._sec
+
+
+@pytest.fixture(scope='module')
+def rollbook():
+    """ a roll of random notes (in and out of range,
+    with gaps too short to re-articulate) """
+    rnd = random.Random(1)
+    note_info = []
+    t = 0.0
+    for _ in range(500):
+        t += rnd.choice([0.0, 0.01, 0.1, 0.25, 0.5])
+        note_info.append(NoteInfo(rnd.randint(30, 90), rnd.randint(0, 1),
+                                  t, rnd.choice([0.05, 0.2, 0.5, 2.0])))
+
+    rb = RollBook('ModelName', conf_file=CONF_FILE)
+    rb.layout(note_info)
+    return rb
+
+
+def rects(svg) -> Counter:
+    """ rectangles in SVG
+
+    Returns
+    -------
+    rects: collections.Counter
+        (stroke, stroke-dasharray, x, y, w, h) -> count
+    """
+    ret = Counter()
+    for style, d in PATH_RE.findall(svg):
+        style = dict(s.split(':', 1) for s in style.split(';') if s)
+        key = (style['stroke'], style.get('stroke-dasharray', 'none'))
+        for rect in RECT_RE.findall(d):
+            ret[key + rect[:4]] += 1
+    return ret
+
+
+def test_roll(rollbook):
+    compact = rects(rollbook.svg(compact=True, precision=PRECISION))
+    plain = rects(rollbook.svg(compact=False))
+
+    assert len(compact) > 1
+    assert compact == plain
+
+
+def test_pages(rollbook):
+    n_pages = rollbook.n_pages(PAGE_LEN)
+    assert n_pages > 1
+
+    for page in range(n_pages):
+        compact = rects(''.join(rollbook.iter_page_svg(
+            page, PAGE_LEN, compact=True, precision=PRECISION)))
+        plain = rects(''.join(rollbook.iter_page_svg(
+            page, PAGE_LEN, compact=False)))
+
+        assert compact == plain, 'page %d' % (page)
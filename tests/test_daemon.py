@@ -0,0 +1,219 @@
+#
+# (c) 2021 Yoichi Tanibayashi
+#
+"""
+resident daemon: sockets and directories of others are not trusted,
+and commands are run with the file descriptors of the client
+
+    $ python -m pytest tests
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__ = '2021/01'
+
+import os
+import sys
+import time
+import signal
+import socket
+import click
+import pytest
+from storgan import daemon as storgan_daemon
+from storgan.daemon import Daemon
+from storgan.notes import NoteStream, dump
+
+CONF_FILE = os.path.join(os.path.dirname(__file__), '..',
+                         'storgan.conf-sample')
+
+
+@click.group()
+def cli():
+    """ CLI run by the daemon """
+
+
+@cli.command()
+@click.argument('out_file')
+def rollbook(out_file):
+    """ write a file in the working directory, stdout and stderr """
+    with open(out_file, 'w') as f:
+        f.write('roll')
+    print('stdout: %s' % (out_file))
+    print('stderr: %s' % (out_file), file=sys.stderr)
+    return 3
+
+
+class CliDaemon(Daemon):
+    """ daemon of `cli` (without preloading midilib) """
+    def preload(self):
+        pass
+
+
+@pytest.fixture
+def sock_path(tmp_path):
+    sock_dir = tmp_path / 'run'
+    sock_dir.mkdir(mode=0o700)
+    return str(sock_dir / 'daemon.sock')
+
+
+@pytest.fixture
+def listening(sock_path):
+    """ a socket listened by this process """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(sock_path)
+    sock.listen(1)
+    yield sock
+    sock.close()
+
+
+def serve(daemon_class, daemon_cli, sock_path):
+    """ run the daemon in a child process
+
+    Returns
+    -------
+    pid: int
+    """
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            daemon_class(daemon_cli, CONF_FILE, sock_path).main()
+        except SystemExit as ex:  # SIGTERM
+            status = ex.code
+        except BaseException:  # pylint: disable=broad-except
+            status = 1
+        finally:
+            os._exit(status)
+
+    for _ in range(100):
+        sock = storgan_daemon.connect(sock_path)
+        if sock is not None:
+            sock.close()
+            return pid
+        time.sleep(0.05)
+    os.kill(pid, signal.SIGKILL)
+    os.waitpid(pid, 0)
+    raise RuntimeError('daemon not started')
+
+
+def stop(pid, sock_path):
+    os.kill(pid, signal.SIGTERM)
+    _, status = os.waitpid(pid, 0)
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+    assert not os.path.exists(sock_path)
+
+
+def test_own_socket(sock_path, listening):
+    sock = storgan_daemon.connect(sock_path)
+    assert sock is not None
+    sock.close()
+
+
+def test_socket_of_others(sock_path, listening, monkeypatch, capsys):
+    monkeypatch.setattr(storgan_daemon.os, 'getuid', lambda: os.geteuid() + 1)
+
+    assert storgan_daemon.connect(sock_path) is None
+    assert 'not a socket of the user' in capsys.readouterr().err
+    assert storgan_daemon.forward(['rollbook', 'a.mid'], sock_path) is None
+
+
+def test_daemon_of_others(sock_path, listening, monkeypatch, capsys):
+    uid = os.getuid()
+    monkeypatch.setattr(storgan_daemon, '_peer_uid', lambda sock: uid + 1)
+
+    assert storgan_daemon.connect(sock_path) is None
+    assert 'the daemon is not of the user' in capsys.readouterr().err
+
+
+def test_not_socket(sock_path):
+    with open(sock_path, 'w') as f:
+        f.write('x')
+
+    assert storgan_daemon.connect(sock_path) is None
+    with pytest.raises(RuntimeError, match='not a socket of the user'):
+        CliDaemon(cli, CONF_FILE, sock_path).main()
+    assert os.path.isfile(sock_path)  # not removed
+
+
+def test_writable_dir(tmp_path):
+    sock_dir = tmp_path / 'run'
+    sock_dir.mkdir()
+    sock_path = str(sock_dir / 'daemon.sock')
+
+    for mode in (0o777, 0o722, 0o770):
+        os.chmod(sock_dir, mode)
+        with pytest.raises(RuntimeError, match='writable by others'):
+            CliDaemon(cli, CONF_FILE, sock_path).main()
+    assert not os.path.exists(sock_path)
+
+    os.chmod(sock_dir, 0o1777)  # sticky (e.g. /tmp)
+    storgan_daemon._check_dir(str(sock_dir))
+
+    new_dir = str(tmp_path / 'new')
+    storgan_daemon._check_dir(new_dir)
+    assert os.stat(new_dir).st_mode & 0o777 == 0o700
+
+
+def test_other_owner_dir(tmp_path):
+    if os.geteuid() != 0:
+        pytest.skip('chown: root only')
+
+    sock_dir = tmp_path / 'run'
+    sock_dir.mkdir(mode=0o700)
+    os.chown(sock_dir, 12345, 12345)
+    with pytest.raises(RuntimeError, match='not owned by the user'):
+        CliDaemon(cli, CONF_FILE, str(sock_dir / 'daemon.sock')).main()
+
+
+def test_forward(sock_path, tmp_path, monkeypatch, capfd):
+    monkeypatch.delenv(storgan_daemon.NO_DAEMON_ENV, raising=False)
+    pid = serve(CliDaemon, cli, sock_path)
+    try:
+        with pytest.raises(RuntimeError, match='already running'):
+            CliDaemon(cli, CONF_FILE, sock_path).main()
+
+        work_dir = tmp_path / 'work'
+        work_dir.mkdir()
+        monkeypatch.chdir(work_dir)
+
+        # run in the working directory, with stdout and stderr
+        # of this process (passed by SCM_RIGHTS)
+        status = storgan_daemon.forward(['rollbook', 'a.svg'], sock_path)
+        assert status == 3
+        assert (work_dir / 'a.svg').read_text() == 'roll'
+        out, err = capfd.readouterr()
+        assert 'stdout: a.svg' in out
+        assert 'stderr: a.svg' in err
+
+        assert storgan_daemon.forward(['rollbook'], sock_path) == 2
+        assert 'Missing argument' in capfd.readouterr().err
+
+        # not forwarded
+        assert storgan_daemon.forward(['webapp'], sock_path) is None
+        monkeypatch.setenv(storgan_daemon.NO_DAEMON_ENV, '1')
+        assert storgan_daemon.forward(['rollbook', 'b.svg'],
+                                      sock_path) is None
+    finally:
+        stop(pid, sock_path)
+
+
+def test_forward_rollbook(sock_path, tmp_path, monkeypatch, capfd):
+    """ the rollbook command of the CLI, from a note file """
+    pytest.importorskip('midilib')
+    from storgan.__main__ import cli as storgan_cli
+
+    monkeypatch.delenv(storgan_daemon.NO_DAEMON_ENV, raising=False)
+    monkeypatch.chdir(tmp_path)
+    dump(NoteStream([60, 64, 67], [0, 0, 0], [0.0, 0.5, 1.0],
+                    [0.5, 0.5, 1.0]), 'a.notes')
+
+    pid = serve(Daemon, storgan_cli, sock_path)
+    try:
+        status = storgan_daemon.forward(
+            ['rollbook', '-f', os.path.abspath(CONF_FILE), '-o', 'out',
+             '-p', '0', 'a.notes'], sock_path)
+        assert status == 0, capfd.readouterr()
+    finally:
+        stop(pid, sock_path)
+
+    svg = os.listdir(tmp_path / 'out')
+    assert len(svg) == 1 and svg[0].endswith('.svg')
+    assert '<svg' in (tmp_path / 'out' / svg[0]).read_text()
@@ -0,0 +1,97 @@
+#
+# (c) 2021 Yoichi Tanibayashi
+#
+"""
+HoleIndex: holes overlapping a range, as found by a full scan
+
+    $ python -m pytest tests
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__ = '2021/01'
+
+import random
+from array import array
+import pytest
+from storgan.holeindex import HoleIndex
+
+
+class Holes:
+    """ x and w of rollbook.HoleTable """
+    def __init__(self, x, w):
+        self.x = array('d', x)
+        self.w = array('d', w)
+
+
+def brute_force(holes, x0, x1) -> list:
+    rows = [i for i, (x, w) in enumerate(zip(holes.x, holes.w))
+            if x < x1 and (x + w > x0 or x >= x0)]
+    return sorted(rows, key=holes.x.__getitem__)
+
+
+def random_holes(rnd, n) -> Holes:
+    x = [rnd.choice([rnd.uniform(0, 1000), float(rnd.randint(0, 100))])
+         for _ in range(n)]
+    w = [rnd.choice([0.0, 1.0, rnd.uniform(0, 20), rnd.uniform(0, 500)])
+         for _ in range(n)]
+    return Holes(x, w)
+
+
+def check(holes, x0, x1):
+    rows = HoleIndex(holes).query(x0, x1)
+    expected = brute_force(holes, x0, x1)
+    assert sorted(rows) == sorted(expected), (x0, x1)
+    assert [holes.x[i] for i in rows] == [holes.x[i] for i in expected]
+
+
+def test_random():
+    rnd = random.Random(1)
+    for n in (0, 1, 31, 32, 33, 100, 1000):
+        holes = random_holes(rnd, n)
+        index = HoleIndex(holes)
+        assert len(index) == n
+        for _ in range(50):
+            x0 = rnd.uniform(-10, 1100)
+            x1 = x0 + rnd.choice([0.0, 1.0, 50.0, 2000.0])
+            check(holes, x0, x1)
+        for x0 in range(-1, 102, 3):  # on the edges of the holes
+            check(holes, float(x0), float(x0 + 1))
+
+
+@pytest.mark.parametrize('x, w, x0, x1, found', [
+    (0.0, 10.0, 10.0, 20.0, False),  # end == x0
+    (5.0, 5.0, 9.0, 10.0, True),
+    (20.0, 5.0, 10.0, 20.0, False),  # start == x1
+    (19.0, 5.0, 10.0, 20.0, True),
+    (10.0, 0.0, 10.0, 20.0, True),  # zero width at x0
+    (20.0, 0.0, 10.0, 20.0, False),  # zero width at x1
+    (15.0, 0.0, 10.0, 20.0, True),
+    (15.0, 0.0, 15.0, 15.0, False),  # empty range
+    (0.0, 100.0, 10.0, 20.0, True),  # contains the range
+])
+def test_edges(x, w, x0, x1, found):
+    # among other holes in several blocks
+    holes = Holes([x] + [float(i) for i in range(100)],
+                  [w] + [0.5] * 100)
+    assert (0 in HoleIndex(holes).query(x0, x1)) == found
+    check(holes, x0, x1)
+
+
+def test_long_early_hole():
+    """ a long hole at the start (e.g. an out of range drone)
+    does not make every query scan from the start """
+    n = 100 * HoleIndex.BLOCK
+    holes = Holes([0.0] + [float(i) for i in range(1, n)],
+                  [float(n)] + [0.5] * (n - 1))
+    index = HoleIndex(holes)
+
+    scanned = []
+    end = index.end
+
+    class End:
+        def __getitem__(self, k):
+            scanned.append(k)
+            return end[k]
+    index.end = End()
+
+    assert index.query(n - 10.0, n - 9.0) == [0, n - 10]
+    assert len(scanned) <= 2 * HoleIndex.BLOCK
@@ -0,0 +1,103 @@
+#
+# (c) 2021 Yoichi Tanibayashi
+#
+"""
+JobScheduler: batch clients flooding the queue never starve
+interactive conversions
+
+    $ python -m pytest tests
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__ = '2021/01'
+
+import os
+import asyncio
+import pytest
+from storgan.cache import RenderCache
+from storgan.jobs import Job, JobScheduler
+from storgan.model import get_registry
+from storgan.worker import QueueFull
+
+CONF_FILE = os.path.join(os.path.dirname(__file__), '..',
+                         'storgan.conf-sample')
+
+
+class Pool:
+    """ RenderPool writing empty results (no worker processes) """
+    def __init__(self, workers):
+        self.workers = workers
+        self.n_runs = 0
+
+    async def run(self, _func, _midi_path, svg_path, *_args, **_kwargs):
+        self.n_runs += 1
+        await asyncio.sleep(0)
+        with open(svg_path, 'w') as f:
+            f.write('<svg/>')
+        return {'width': 0}
+
+
+@pytest.fixture
+def model():
+    return get_registry(CONF_FILE).get('ModelName')
+
+
+def submit(sched, model, client, priority, i):
+    return sched.submit(client, priority, 'x.mid', model, [],
+                        '%s-%s-%d' % (client, priority, i))
+
+
+def test_per_client_cap(tmp_path, model):
+    sched = JobScheduler(Pool(0), RenderCache(str(tmp_path)), CONF_FILE,
+                         max_queued=100, max_queued_per_client=10)
+
+    for i in range(10):
+        submit(sched, model, 'batch', JobScheduler.PRIO_BATCH, i)
+    with pytest.raises(QueueFull):
+        submit(sched, model, 'batch', JobScheduler.PRIO_BATCH, 10)
+
+    # other clients are not affected
+    submit(sched, model, 'other', JobScheduler.PRIO_BATCH, 0)
+    assert sched.n_queued == 11
+
+
+def test_interactive_reserve(tmp_path, model):
+    sched = JobScheduler(Pool(0), RenderCache(str(tmp_path)), CONF_FILE,
+                         max_queued=100, max_queued_per_client=100)
+
+    # batch clients flood the queue
+    n_batch = 0
+    with pytest.raises(QueueFull):
+        for i in range(1000):
+            submit(sched, model, 'batch%d' % (i % 3),
+                   JobScheduler.PRIO_BATCH, i)
+            n_batch += 1
+    assert n_batch == 90
+
+    # interactive uploads still get in
+    job = submit(sched, model, '10.0.0.1', JobScheduler.PRIO_INTERACTIVE, 0)
+    assert job.state == Job.QUEUED
+    assert sched.position(job) == 0
+
+
+def test_drain(tmp_path, model):
+    async def run():
+        pool = Pool(2)
+        sched = JobScheduler(pool, RenderCache(str(tmp_path)), CONF_FILE,
+                             max_queued_per_client=5)
+        # 2 running (max_per_client) and 5 queued
+        jobs = [submit(sched, model, 'batch', JobScheduler.PRIO_BATCH, i)
+                for i in range(7)]
+        assert sched.n_running == 2 and sched.n_queued == 5
+        with pytest.raises(QueueFull):
+            submit(sched, model, 'batch', JobScheduler.PRIO_BATCH, 7)
+
+        await asyncio.gather(*[job.wait() for job in jobs])
+        assert pool.n_runs == 7
+        assert sched.n_queued == 0 and sched.n_running == 0
+
+        # the cap is per queued job, not per submitted job
+        job = submit(sched, model, 'batch', JobScheduler.PRIO_BATCH, 7)
+        await job.wait()
+        assert job.state == Job.DONE
+
+    asyncio.run(run())
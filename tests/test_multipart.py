@@ -0,0 +1,221 @@
+#
+# (c) 2021 Yoichi Tanibayashi
+#
+"""
+streaming multipart/form-data parser, and its errors (400, 413)
+in an upload handler
+
+    $ python -m pytest tests
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__ = '2021/01'
+
+import os
+import json
+import tempfile
+import pytest
+import tornado.web
+from tornado.testing import AsyncHTTPTestCase
+from storgan.cache import midi_hash
+from storgan.handler1 import UploadHandler
+from storgan.multipart import StreamingFormData, StreamingBody
+from storgan.multipart import MultipartError, MultipartTooLarge
+
+BOUNDARY = b'----xyz'
+# CRLF and partial delimiters in the data
+FILE_DATA = b'MThd\r\n--\r\n----xy\r\r\n\x00\xff' * 10 + b'\r'
+
+
+def part(name, value, filename=None):
+    disposition = 'form-data; name="%s"' % (name)
+    if filename is not None:
+        disposition += '; filename="%s"' % (filename)
+    return (b'--' + BOUNDARY + b'\r\n' +
+            ('Content-Disposition: %s\r\n\r\n' % (
+                disposition)).encode('utf-8') +
+            value + b'\r\n')
+
+
+def form_data(*parts) -> bytes:
+    return b'preamble\r\n' + b''.join(parts) + b'--' + BOUNDARY + b'--\r\n'
+
+
+BODY = form_data(part('model', b'ModelName'),
+                 part('file1', FILE_DATA, 'a.mid'),
+                 part('page_len', b''))
+
+
+def parse(chunks, tmp_dir, size_limit=None) -> StreamingFormData:
+    form = StreamingFormData(BOUNDARY, tmp_dir, size_limit)
+    for chunk in chunks:
+        form.feed(chunk)
+    form.close()
+    return form
+
+
+def check_form(form):
+    assert form.fields == {'model': 'ModelName', 'page_len': ''}
+    upload = form.files['file1']
+    assert upload.filename == 'a.mid'
+    with open(upload.path, 'rb') as f:
+        assert f.read() == FILE_DATA
+    assert upload.size == len(FILE_DATA)
+    assert upload.digest == midi_hash(FILE_DATA)
+
+
+def uploads(tmp_dir) -> list:
+    """ temporary files left """
+    return [name for name in os.listdir(tmp_dir)
+            if name.startswith('.upload-')]
+
+
+def test_split_everywhere(tmp_path):
+    """ boundaries and CRLFs split at every position """
+    for i in range(len(BODY) + 1):
+        form = parse([BODY[:i], BODY[i:]], str(tmp_path))
+        check_form(form)
+        form.cleanup()
+    assert uploads(tmp_path) == []
+
+
+def test_byte_by_byte(tmp_path):
+    form = parse([BODY[i:i + 1] for i in range(len(BODY))], str(tmp_path))
+    check_form(form)
+    form.cleanup()
+    assert uploads(tmp_path) == []
+
+
+def test_crlf_at_chunk_edge(tmp_path):
+    pos = BODY.index(b'\r\n--' + BOUNDARY + b'\r\nContent-Disposition: '
+                     b'form-data; name="page_len"')
+    for chunks in ([BODY[:pos + 1], BODY[pos + 1:]],
+                   [BODY[:pos + 2], BODY[pos + 2:]],
+                   [BODY[:pos], BODY[pos:pos + 1], BODY[pos + 1:]]):
+        form = parse(chunks, str(tmp_path))
+        check_form(form)
+        form.cleanup()
+
+
+@pytest.mark.parametrize('body, error', [
+    (form_data(*[part('f%d' % i, b'x')
+                 for i in range(StreamingFormData.MAX_PARTS + 1)]),
+     MultipartError),
+    (form_data(part('file1', FILE_DATA, 'a.mid'),
+               part('f', b'x' * (StreamingFormData.FIELD_LIMIT + 1))),
+     MultipartTooLarge),
+    (form_data(part('file1', FILE_DATA * 100, 'a.mid')),
+     MultipartTooLarge),
+])
+def test_errors(tmp_path, body, error):
+    form = StreamingFormData(BOUNDARY, str(tmp_path), len(FILE_DATA) * 10)
+    with pytest.raises(error):
+        for i in range(0, len(body), 100):
+            form.feed(body[i:i + 100])
+    form.cleanup()
+    assert uploads(tmp_path) == []
+
+
+def test_truncated(tmp_path):
+    form = StreamingFormData(BOUNDARY, str(tmp_path))
+    form.feed(BODY[:BODY.index(b'page_len')])
+    with pytest.raises(MultipartError):
+        form.close()
+    form.cleanup()
+    assert uploads(tmp_path) == []
+
+
+def test_body(tmp_path):
+    body = StreamingBody('file1', 'a.mid', str(tmp_path), len(FILE_DATA))
+    body.feed(FILE_DATA[:7])
+    body.feed(FILE_DATA[7:])
+    body.close()
+    assert body.files['file1'].digest == midi_hash(FILE_DATA)
+
+    with pytest.raises(MultipartTooLarge):
+        body.feed(b'x')
+    body.cleanup()
+    assert uploads(tmp_path) == []
+
+
+class EchoUpload(UploadHandler):
+    """ reply the fields and the hash of the uploaded file """
+    def post(self):
+        upload_file, _ = self.store_midi()
+        self.write(json.dumps({'fields': self.upload.fields,
+                               'digest': upload_file.digest}))
+
+
+class TestUploadHandler(AsyncHTTPTestCase):
+    SIZE_LIMIT = StreamingFormData.FIELD_LIMIT * 4
+
+    def get_app(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.upload_dir = os.path.join(self._tmp.name, 'upload')
+        os.makedirs(self.upload_dir)
+        os.makedirs(os.path.join(self._tmp.name, 'midi'))
+        return tornado.web.Application(
+            [(r'/upload', EchoUpload)],
+            webroot=self._tmp.name, upload_dir=self.upload_dir,
+            size_limit=self.SIZE_LIMIT, debug=False)
+
+    def tearDown(self):
+        super().tearDown()
+        self._tmp.cleanup()
+
+    def post(self, body, boundary=BOUNDARY, chunked=False):
+        kwargs = {'body': body}
+        if chunked:
+            # no Content-Length: the size is checked while streaming
+            async def producer(write):
+                for i in range(0, len(body), 4096):
+                    await write(body[i:i + 4096])
+            kwargs = {'body_producer': producer}
+
+        return self.fetch(
+            '/upload', method='POST',
+            headers={'Content-Type': 'multipart/form-data; boundary=%s' % (
+                boundary.decode('utf-8'))}, **kwargs)
+
+    def test_ok(self):
+        res = self.post(BODY)
+        self.assertEqual(res.code, 200)
+        self.assertEqual(json.loads(res.body)['digest'],
+                         midi_hash(FILE_DATA))
+        self.assertEqual(uploads(self.upload_dir), [])
+
+    def test_too_many_parts(self):
+        res = self.post(form_data(*[
+            part('f%d' % i, b'x')
+            for i in range(StreamingFormData.MAX_PARTS + 1)]))
+        self.assertEqual(res.code, 400)
+        self.assertEqual(uploads(self.upload_dir), [])
+
+    def test_too_large_field(self):
+        res = self.post(form_data(
+            part('file1', FILE_DATA, 'a.mid'),
+            part('f', b'x' * (StreamingFormData.FIELD_LIMIT + 1))))
+        self.assertEqual(res.code, 413)
+        self.assertEqual(uploads(self.upload_dir), [])
+
+    def test_too_large_file(self):
+        body = form_data(part('file1', b'x' * (self.SIZE_LIMIT + 1),
+                              'a.mid'))
+        for chunked in (False, True):
+            res = self.post(body, chunked=chunked)
+            self.assertEqual(res.code, 413)
+            self.assertEqual(uploads(self.upload_dir), [])
+
+    def test_split(self):
+        res = self.post(BODY, chunked=True)
+        self.assertEqual(res.code, 200)
+        self.assertEqual(json.loads(res.body)['fields'],
+                         {'model': 'ModelName', 'page_len': ''})
+
+    def test_truncated(self):
+        res = self.post(BODY[:BODY.index(b'page_len')])
+        self.assertEqual(res.code, 400)
+        self.assertEqual(uploads(self.upload_dir), [])
+
+    def test_no_boundary(self):
+        res = self.post(BODY, boundary=b'')
+        self.assertEqual(res.code, 400)
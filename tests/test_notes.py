@@ -0,0 +1,84 @@
+#
+# (c) 2021 Yoichi Tanibayashi
+#
+"""
+note file: round trip, and invalid files
+
+    $ python -m pytest tests
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__ = '2021/01'
+
+import io
+import pytest
+from storgan import notes as notes_mod
+from storgan.notes import NoteStream
+
+NOTES = NoteStream([60, 62, 64, 127, 0],
+                   [0, 1, 0, 9, 15],
+                   [0.0, 0.5, 0.5, 1.25, 3.0],
+                   [0.5, 0.25, 1.0 / 3, 0.0, 10.0])
+
+
+def columns(notes) -> tuple:
+    return (list(notes.note), list(notes.channel),
+            list(notes.start_sec), list(notes.sec))
+
+
+def data(notes=NOTES) -> bytes:
+    f = io.BytesIO()
+    notes.write(f)
+    return f.getvalue()
+
+
+def test_round_trip():
+    buf = data()
+    assert len(buf) == NoteStream.HEADER.size + len(NOTES) * (8 + 8 + 1 + 1)
+    assert columns(NoteStream.from_buffer(buf)) == columns(NOTES)
+
+    empty = NoteStream.from_buffer(data(NoteStream()))
+    assert len(empty) == 0
+
+
+def test_dump_load(tmp_path):
+    path = str(tmp_path / ('a' + notes_mod.SUFFIX))
+    notes_mod.dump(NOTES, path)
+
+    assert notes_mod.is_note_file(path)
+    loaded = notes_mod.load(path)
+    assert columns(loaded) == columns(NOTES)
+    assert columns(loaded.select([0])) == (
+        [60, 64], [0, 0], [0.0, 0.5], [0.5, 1.0 / 3])
+    assert loaded.select([]) is loaded
+
+
+def header(magic=NoteStream.MAGIC, version=NoteStream.VERSION,
+           offset=NoteStream.HEADER.size, n_notes=len(NOTES)) -> bytes:
+    return NoteStream.HEADER.pack(magic, version, offset, n_notes, 0)
+
+
+@pytest.mark.parametrize('buf, msg', [
+    (b'', 'not a note file'),
+    (data()[:NoteStream.HEADER.size - 1], 'not a note file'),
+    (b'MThd' + data()[4:], 'not a note file'),
+    (header(version=NoteStream.VERSION + 1) +
+     data()[NoteStream.HEADER.size:], 'unsupported'),
+    (data()[:-1], 'truncated'),
+    (header(n_notes=len(NOTES) + 1) + data()[NoteStream.HEADER.size:],
+     'truncated'),
+    (header(offset=NoteStream.HEADER.size + 1) +
+     data()[NoteStream.HEADER.size:], 'truncated'),
+])
+def test_invalid(buf, msg):
+    with pytest.raises(ValueError, match=msg):
+        NoteStream.from_buffer(buf)
+
+
+def test_invalid_file(tmp_path):
+    path = str(tmp_path / ('a' + notes_mod.SUFFIX))
+    with open(path, 'wb') as f:
+        f.write(data()[:-1])
+
+    with pytest.raises(ValueError):
+        notes_mod.load(path)
+    assert not notes_mod.is_note_file(str(tmp_path / 'none'))
@@ -0,0 +1,98 @@
+#
+# (c) 2021 Yoichi Tanibayashi
+#
+"""
+auto-transpose: the best shift, and folding by octaves
+
+    $ python -m pytest tests
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__ = '2021/01'
+
+import os
+import pytest
+from storgan import transpose as transpose_mod
+from storgan.model import get_registry
+from storgan.notes import NoteStream
+
+CONF_FILE = os.path.join(os.path.dirname(__file__), '..',
+                         'storgan.conf-sample')
+# C major, 3 octaves below the range of 'ModelName' (41 .. 81)
+TUNE = [n - 36 for n in (60, 62, 64, 65, 67, 69, 71, 72, 74, 76, 77, 79)]
+
+
+@pytest.fixture
+def model():
+    return get_registry(CONF_FILE).get('ModelName')
+
+
+def stream(note, channel=None) -> NoteStream:
+    if channel is None:
+        channel = [0] * len(note)
+    return NoteStream(note, channel, range(len(note)), [0.5] * len(note))
+
+
+def fit(notes, model) -> int:
+    """ number of playable notes (one by one) """
+    return sum([model.scale_table[n] >= 0 for n in notes.note])
+
+
+def test_scores(model):
+    notes = stream(TUNE)
+    score = transpose_mod.scores(transpose_mod.histogram(notes),
+                                 transpose_mod.playable(model))
+
+    assert sorted(score) == list(range(-transpose_mod.MAX_SHIFT,
+                                       transpose_mod.MAX_SHIFT + 1))
+    for shift, n_fit in score.items():
+        assert n_fit == fit(stream([n + shift for n in TUNE]), model), shift
+
+
+def test_best_shift(model):
+    notes, info = transpose_mod.transpose(stream(TUNE), model)
+
+    # 24, 19 and 17 fit all the notes: the smallest shift
+    assert info['shift'] == 17
+    assert list(notes.note) == [n + 17 for n in TUNE]
+    assert info['fit_before'] == fit(stream(TUNE), model) == 2
+    assert info['fit_after'] == fit(notes, model) == len(TUNE)
+    assert info['recovered'] == info['fit_after'] - info['fit_before']
+    assert info['folded'] == 0
+
+
+def test_no_change(model):
+    notes = stream([n + 36 for n in TUNE])
+    ret, info = transpose_mod.transpose(notes, model)
+    assert ret is notes
+    assert info['shift'] == 0 and info['recovered'] == 0
+
+    ret, info = transpose_mod.transpose(notes, model, shift=0)
+    assert ret is notes
+
+
+def test_fold(model):
+    # the same out of range notes in channel 0 and 1
+    notes = stream(TUNE * 2, [0] * len(TUNE) + [1] * len(TUNE))
+    ret, info = transpose_mod.transpose(notes, model, shift=0,
+                                        fold_channels=[1])
+
+    n_out = len(TUNE) - fit(stream(TUNE), model)
+    assert info['shift'] == 0
+    assert info['folded'] == n_out
+    assert info['recovered'] == info['fit_after'] - info['fit_before']
+    assert info['recovered'] == n_out
+
+    assert list(ret.note[:len(TUNE)]) == TUNE  # not folded
+    for note, folded in zip(TUNE, ret.note[len(TUNE):]):
+        assert model.scale_table[folded] >= 0
+        assert (folded - note) % transpose_mod.OCTAVE == 0
+    assert list(ret.channel) == list(notes.channel)
+
+
+def test_fold_unreachable():
+    mask = [0] * 128
+    assert transpose_mod.fold(60, mask) == 60
+    mask[66] = 1
+    assert transpose_mod.fold(60, mask) == 60
+    mask[84] = mask[36] = 1
+    assert transpose_mod.fold(60, mask) == 84  # upward first
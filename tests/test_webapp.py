@@ -0,0 +1,35 @@
+#
+# (c) 2021 Yoichi Tanibayashi
+#
+"""
+WebServer: conversion workers are split among server processes
+
+    $ python -m pytest tests
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__ = '2021/01'
+
+import os
+import pytest
+import tornado.process
+from storgan.webapp import WebServer
+
+CONF_FILE = os.path.join(os.path.dirname(__file__), '..',
+                         'storgan.conf-sample')
+
+
+@pytest.mark.parametrize('workers, processes, per_process', [
+    (8, None, 8),  # development mode: one process
+    (8, 4, 2),
+    (8, 3, 2),
+    (2, 4, 1),  # at least one
+    (tornado.process.cpu_count(), 0, 1),  # the defaults of `-n 0`
+])
+def test_workers(tmp_path, workers, processes, per_process):
+    server = WebServer(webroot=str(tmp_path), workdir=str(tmp_path / 'work'),
+                       conf_file=CONF_FILE, workers=workers,
+                       processes=processes)
+    try:
+        assert server._render_pool.workers == per_process
+    finally:
+        server._render_pool.shutdown()
@@ -3,3 +3,119 @@
  *
  *   (c) 2021 Yoichi Tanibayashi
  */
+
+/**
+ * Roll viewer
+ *
+ * The roll is not inlined in the page.
+ * It is cut into tiles of TILE_PX pixels (time ranges of the roll),
+ * and only the tiles near the viewport are loaded
+ * (api/tile/{MIDI hash}.svg?t0=..&t1=..&lod=..).
+ * A tile is at most maxTileSec long (the limit of the server):
+ * tiles are narrower at low zoom, if the roll is short per sec.
+ * At low zoom, the tiles are coarse (lod: the length of a pixel).
+ *
+ * The beginning of the tune is on the right (x = 0).
+ */
+const RollViewer = {
+  TILE_PX: 1024,
+  MARGIN_PX: 1024,  // tiles are loaded ahead of scrolling
+  MIN_ZOOM: 1 / 16,  // px/mm
+  MAX_ZOOM: 8,
+  DEF_ZOOM: 2,
+
+  init(el) {
+    this.el = el;
+    this.tileUrl = el.dataset.tileUrl;
+    this.width = parseFloat(el.dataset.width);  // mm
+    this.height = parseFloat(el.dataset.height);  // mm
+    this.secLen = parseFloat(el.dataset.secLen);  // mm/sec
+    this.maxTileSec = parseFloat(el.dataset.maxTileSec);  // sec
+    this.zoom = this.DEF_ZOOM;  // px/mm
+
+    el.style.position = 'relative';
+    el.style.overflowX = 'auto';
+    el.style.overflowY = 'hidden';
+
+    this.observer = new IntersectionObserver(
+      (entries) => this.onIntersect(entries),
+      {root: el, rootMargin: '0px ' + this.MARGIN_PX + 'px'});
+
+    this.build(1);
+  },
+
+  /**
+   * @param {number} pos position of the viewport (0: start, 1: end)
+   */
+  build(pos) {
+    this.observer.disconnect();
+
+    const zoom = this.zoom;
+    const tileSec = Math.min(this.TILE_PX / zoom / this.secLen,
+                             this.maxTileSec);
+    const tileMm = tileSec * this.secLen;
+    const tilePx = tileMm * zoom;
+    const lod = zoom < 1 ? 1 / zoom : 0;
+    const nTiles = Math.max(Math.ceil(this.width / tileMm), 1);
+
+    const inner = document.createElement('div');
+    inner.style.position = 'relative';
+    inner.style.width = Math.ceil(this.width * zoom) + 'px';
+    inner.style.height = Math.ceil(this.height * zoom) + 'px';
+
+    for (let i = 0; i < nTiles; i++) {
+      const tileW = Math.min(tileMm, this.width - i * tileMm);
+      const img = document.createElement('img');
+      img.style.position = 'absolute';
+      img.style.top = '0';
+      img.style.right = (i * tilePx) + 'px';
+      img.style.width = (tileW * zoom) + 'px';
+      img.style.height = (this.height * zoom) + 'px';
+      img.dataset.src = this.tileUrl +
+        '&t0=' + (i * tileSec) + '&t1=' + ((i + 1) * tileSec) +
+        '&lod=' + lod;
+      inner.appendChild(img);
+      this.observer.observe(img);
+    }
+
+    this.el.replaceChildren(inner);
+    const el = this.el;
+    el.scrollLeft = (el.scrollWidth - el.clientWidth) * pos;
+  },
+
+  onIntersect(entries) {
+    for (const entry of entries) {
+      if (entry.isIntersecting) {
+        entry.target.src = entry.target.dataset.src;
+        this.observer.unobserve(entry.target);
+      }
+    }
+  },
+
+  setZoom(factor) {
+    const zoom = Math.min(Math.max(this.zoom * factor, this.MIN_ZOOM),
+                          this.MAX_ZOOM);
+    if (zoom === this.zoom) {
+      return;
+    }
+
+    const el = this.el;
+    const range = el.scrollWidth - el.clientWidth;
+    const pos = range > 0 ? el.scrollLeft / range : 1;
+    this.zoom = zoom;
+    this.build(pos);
+  },
+};
+
+document.addEventListener('DOMContentLoaded', () => {
+  const el = document.querySelector('.roll-viewer');
+  if (el === null) {
+    return;
+  }
+
+  RollViewer.init(el);
+  for (const button of document.querySelectorAll('.roll-zoom')) {
+    button.addEventListener(
+      'click', () => RollViewer.setZoom(parseFloat(button.dataset.zoom)));
+  }
+});